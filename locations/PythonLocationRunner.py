@@ -12,9 +12,58 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Submits a indexing job for a data location."""
+import os
 import sys
+import glob
 import json
 import collections
+
+
+def time_imports():
+    """Record how long each module takes to import and write the breakdown to stderr on exit.
+    Enabled with --import-time or the VOYAGER_IMPORT_TIME environment variable (which worker processes inherit).
+    """
+    import time
+    import atexit
+    try:
+        import __builtin__ as builtins
+    except ImportError:
+        import builtins
+    builtin_import = builtins.__import__
+    timings = []
+    child_times = [0.0]
+
+    def timed_import(name, *args, **kwargs):
+        loaded = len(sys.modules)
+        child_times.append(0.0)
+        start = time.time()
+        try:
+            return builtin_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = child_times.pop()
+            if len(sys.modules) > loaded:
+                # Only imports that loaded a module count; cached imports only add their lookup time.
+                fromlist = args[2] if len(args) > 2 else kwargs.get('fromlist')
+                label = '{0} ({1})'.format(name, ', '.join(fromlist)) if fromlist else name
+                timings.append((elapsed - children, elapsed, len(child_times) - 1, label))
+            child_times[-1] += elapsed
+
+    def report():
+        sys.stderr.write('import time: self [us] | cumulative | imported package\n')
+        for self_time, cumulative, depth, name in timings:
+            sys.stderr.write('import time: {0:>9} | {1:>10} | {2}{3}\n'.format(int(self_time * 1e6), int(cumulative * 1e6), '  ' * depth, name))
+
+    builtins.__import__ = timed_import
+    atexit.register(report)
+
+
+if '--import-time' in sys.argv:
+    sys.argv.remove('--import-time')
+    os.environ['VOYAGER_IMPORT_TIME'] = '1'
+if os.environ.get('VOYAGER_IMPORT_TIME'):
+    time_imports()
+
 import workers
 
 modules = {'arcpy': 'esri_worker', 'cx_Oracle': 'oracle_worker',
@@ -23,50 +72,170 @@ modules = {'arcpy': 'esri_worker', 'cx_Oracle': 'oracle_worker',
            'ogr': 'gdal_worker'}
 
 
+def get_worker_info_full():
+    """Return worker availability by importing the module each worker requires."""
+    worker_info = collections.defaultdict(list)
+    for module, worker in modules.items():
+        try:
+            __import__(module)
+            worker_info['workers'].append({'name': worker, 'available': True})
+        except ImportError as ie:
+            worker_info['workers'].append({'name': worker, 'available': False, 'warning': str(ie)})
+    return worker_info
+
+
+def get_worker_info():
+    """Return worker availability by finding the modules they import without loading them.
+    The result is cached in a manifest until the workers or the Python installation change.
+    """
+    from workers.utils import module_info
+    workers_dir = os.path.dirname(workers.__file__)
+    files = [workers_dir] + glob.glob(os.path.join(workers_dir, '*.py')) + glob.glob(os.path.join(workers_dir, 'utils', '*.py'))
+    manifest_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.info_manifest.json')
+    worker_info = module_info.read_manifest(manifest_file, files)
+    if worker_info is not None:
+        return worker_info
+
+    worker_info = collections.defaultdict(list)
+    for module, worker in modules.items():
+        missing = module_info.missing_imports(os.path.join(workers_dir, '{0}.py'.format(worker)), [workers_dir])
+        if not module_info.module_available(module):
+            missing = sorted(set(missing + [module]))
+        if missing:
+            warning = 'No module named {0}'.format(', '.join(missing))
+            worker_info['workers'].append({'name': worker, 'available': False, 'warning': warning})
+        else:
+            worker_info['workers'].append({'name': worker, 'available': True})
+    module_info.write_manifest(manifest_file, files, worker_info)
+    return worker_info
+
+
+def run_job(job_file):
+    """Run the worker for a job file."""
+    from workers import base_job
+    job = base_job.Job(job_file)
+    if job.path or job.service_connection:
+        from workers import esri_worker
+        esri_worker.run_job(job)
+    elif job.url:
+        from workers import gdal_worker
+        gdal_worker.run_job(job.job_file)
+    elif job.dynamodb_region:
+        from workers import dynamodb_worker
+        dynamodb_worker.run_job(job)
+    elif job.mongodb_client_info:
+        from workers import mongodb_worker
+        mongodb_worker.run_job(job)
+    elif job.sql_connection_info:
+        if job.sql_driver == 'SQL Server':
+            from workers import sql_worker
+            sql_worker.run_job(job)
+        elif job.sql_driver == 'Oracle':
+            from workers import oracle_worker
+            oracle_worker.run_job(job)
+        elif 'MySQL' in job.sql_driver:
+            from workers import mysql_worker
+            mysql_worker.run_job(job)
+    else:
+        sys.stdout.write("No job information.")
+        return False
+    job.metrics.summary()
+    return True
+
+
+def job_process(jobs):
+    """Run queued jobs one at a time in a resident process.
+    Available worker modules are imported once and database connections are kept open between jobs.
+    """
+    from workers import base_job
+    from workers.utils import status
+    for module, worker in modules.items():
+        try:
+            __import__(module)
+            __import__('workers.{0}'.format(worker))
+        except ImportError:
+            pass
+    base_job.enable_connection_pool()
+    status_writer = status.Writer()
+
+    for job_file in iter(jobs.get, None):
+        try:
+            status.job_id = json.load(open(job_file, 'r'))['id']
+        except (IOError, ValueError, KeyError):
+            status.job_id = job_file
+        try:
+            if run_job(job_file):
+                status_writer.send_state(status.STAT_SUCCESS)
+            else:
+                status_writer.send_state(status.STAT_FAILED, 'No job information.')
+        except SystemExit as se:
+            # Workers exit on fatal errors; only the job ends.
+            if se.code:
+                status_writer.send_state(status.STAT_FAILED, 'Exit code {0}'.format(se.code))
+            else:
+                status_writer.send_state(status.STAT_SUCCESS)
+        except Exception as ex:
+            status_writer.send_state(status.STAT_FAILED, repr(ex))
+        finally:
+            status.job_id = None
+
+
+def read_jobs(address=None):
+    """Yield job files sent to a ZMQ PULL socket bound to address, or written one per line to stdin.
+    A job file of --stop ends the runner.
+    """
+    if address:
+        import zmq
+        socket = zmq.Context.instance().socket(zmq.PULL)
+        socket.bind(address)
+        messages = iter(socket.recv, None)
+    else:
+        messages = iter(sys.stdin.readline, '')
+    for message in messages:
+        job_file = message.strip()
+        if job_file == '--stop':
+            break
+        elif job_file:
+            yield job_file
+
+
+def serve(address=None, processes=None):
+    """Run jobs as they are received in resident processes, up to the number of processes at once."""
+    import multiprocessing
+    processes = processes or multiprocessing.cpu_count()
+    jobs = multiprocessing.Queue()
+    # Workers create their own process pools, so the resident processes can not be daemons.
+    runners = [multiprocessing.Process(target=job_process, args=(jobs,)) for i in range(processes)]
+    for runner in runners:
+        runner.start()
+    try:
+        for job_file in read_jobs(address):
+            jobs.put(job_file)
+    finally:
+        for runner in runners:
+            jobs.put(None)
+        for runner in runners:
+            runner.join()
+
+
 if __name__ == '__main__':
     if sys.argv[1] == '--info':
-        worker_info = collections.defaultdict(list)
         try:
             __import__('zmq')
         except ImportError as ie:
             sys.stdout.write('{0}. Please contact Voyager Search support.'.format(ie.message))
             sys.exit(1)
-
-        for module, worker in modules.items():
-            try:
-                __import__(module)
-                worker_info['workers'].append({'name': worker, 'available': True})
-            except ImportError as ie:
-                worker_info['workers'].append({'name': worker, 'available': False, 'warning': str(ie)})
-                pass
+        if '--full' in sys.argv:
+            worker_info = get_worker_info_full()
+        else:
+            worker_info = get_worker_info()
         sys.stdout.write(json.dumps(worker_info, indent=2))
         sys.stdout.flush()
-    else:
-        from workers import base_job
-        job = base_job.Job(sys.argv[1])
-        if job.path or job.service_connection:
-            from workers import esri_worker
-            esri_worker.run_job(job)
-        elif job.url:
-            from workers import gdal_worker
-            gdal_worker.run_job(job.job_file)
-        elif job.dynamodb_region:
-            from workers import dynamodb_worker
-            dynamodb_worker.run_job(job)
-        elif job.mongodb_client_info:
-            from workers import mongodb_worker
-            mongodb_worker.run_job(job)
-        elif job.sql_connection_info:
-            if job.sql_driver == 'SQL Server':
-                from workers import sql_worker
-                sql_worker.run_job(job)
-            elif job.sql_driver == 'Oracle':
-                from workers import oracle_worker
-                oracle_worker.run_job(job)
-            elif 'MySQL' in job.sql_driver:
-                from workers import mysql_worker
-                mysql_worker.run_job(job)
-        else:
-            sys.stdout.write("No job information.")
-            sys.exit(1)
+    elif sys.argv[1] == '--serve':
+        # Usage: --serve [zmq address] [max concurrent jobs]
+        address = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].isdigit() else None
+        processes = int(sys.argv[-1]) if sys.argv[-1].isdigit() else None
+        serve(address, processes)
+    elif not run_job(sys.argv[1]):
+        sys.exit(1)
     sys.exit(0)
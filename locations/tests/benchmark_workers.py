@@ -0,0 +1,540 @@
+"""Benchmark of the location workers against local stand-ins for the servers they index.
+
+Synthetic tables of a configurable row count, width (number of attribute fields) and geometry
+complexity (vertices per polygon, 1 for points) are loaded into each stand-in and indexed by a worker.
+The entries are counted by a local ZMQ PULL socket in place of the indexer. Each configuration runs
+the worker in a new process and reports its rows per second, CPU time and peak memory.
+
+Stand-ins:
+    sqlite    the DB-API row loop of the SQL workers (sql_worker.index_rows) against an SQLite database.
+              The SQL Server, Oracle and MySQL catalog queries do not run on SQLite.
+    mongodb   mongodb_worker against a local mongod, started on a free port unless --mongodb is given.
+    dynamodb  dynamodb_worker against DynamoDB Local (--dynamodb).
+    arcgis    esri_worker against a local HTTP stub of an ArcGIS REST map service (point layers only).
+
+Stand-ins that are not available are skipped. Run from this folder, for example:
+    python benchmark_workers.py --backends sqlite,arcgis --rows 10000,100000 --width 10,50 --vertices 1,100
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import shutil
+import sqlite3
+import decimal
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import collections
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+LOCATIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LOCATIONS_DIR)
+from workers.utils import module_info
+
+SQLITE_TYPES = {'TEXT': unicode, 'INTEGER': int, 'REAL': float}
+ESRI_TYPES = {unicode: 'esriFieldTypeString', int: 'esriFieldTypeInteger', float: 'esriFieldTypeDouble'}
+
+# The worker module imported before a run is timed.
+WORKERS = {'sqlite': 'sql_worker', 'mongodb': 'mongodb_worker', 'dynamodb': 'dynamodb_worker', 'arcgis': 'esri_worker'}
+
+
+# ---------------------------------------------------------------------------------------------------
+# Synthetic tables.
+# ---------------------------------------------------------------------------------------------------
+def get_fields(width):
+    """Return the names and types of the synthetic attribute fields."""
+    field_types = (unicode, int, float)
+    return [('field{0}'.format(n), field_types[n % len(field_types)]) for n in range(width)]
+
+
+def make_values(rnd, fields):
+    values = []
+    for name, field_type in fields:
+        if field_type is int:
+            values.append(rnd.randint(0, 1000000))
+        elif field_type is float:
+            values.append(round(rnd.uniform(-1000, 1000), 6))
+        else:
+            values.append(u'value {0}'.format(rnd.randint(0, 1000000)))
+    return values
+
+
+def make_coordinates(rnd, vertices):
+    """Return a point, or the closed ring of a polygon with the number of vertices."""
+    x, y = rnd.uniform(-170, 170), rnd.uniform(-80, 80)
+    if vertices < 3:
+        return [[round(x, 6), round(y, 6)]]
+    ring = []
+    for n in range(vertices):
+        angle = 2 * math.pi * n / vertices
+        radius = rnd.uniform(0.05, 0.1)
+        ring.append([round(x + radius * math.cos(angle), 6), round(y + radius * math.sin(angle), 6)])
+    return ring + [ring[0]]
+
+
+def to_wkt(coordinates):
+    if len(coordinates) == 1:
+        return 'POINT ({0} {1})'.format(*coordinates[0])
+    return 'POLYGON (({0}))'.format(', '.join('{0} {1}'.format(x, y) for x, y in coordinates))
+
+
+def to_bbox(coordinates):
+    xs, ys = zip(*coordinates)
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def generate_rows(rows, width, vertices, seed=0):
+    """Yield the id, attribute values and coordinates of each synthetic row."""
+    rnd = random.Random(seed)
+    fields = get_fields(width)
+    for i in xrange(1, rows + 1):
+        yield i, make_values(rnd, fields), make_coordinates(rnd, vertices)
+
+
+def batches(iterable, size=1000):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+# ---------------------------------------------------------------------------------------------------
+# Stand-ins. load() fills a table and returns the location config for the job, unload() drops it.
+# ---------------------------------------------------------------------------------------------------
+class SQLiteStandIn(object):
+    """An SQLite database indexed through the DB-API path."""
+    def __init__(self, args, folder):
+        self.database = os.path.join(folder, 'benchmark.sqlite')
+
+    def available(self):
+        return True
+
+    def load(self, table, rows, width, vertices):
+        fields = get_fields(width)
+        types = dict((t, n) for n, t in SQLITE_TYPES.items())
+        connection = sqlite3.connect(self.database)
+        columns = ['id INTEGER PRIMARY KEY', 'WKT TEXT'] + ['{0} {1}'.format(name, types[t]) for name, t in fields]
+        connection.execute('CREATE TABLE {0} ({1})'.format(table, ', '.join(columns)))
+        insert = 'INSERT INTO {0} VALUES ({1})'.format(table, ', '.join('?' * (width + 2)))
+        connection.executemany(insert, ([i, to_wkt(coordinates)] + values
+                                        for i, values, coordinates in generate_rows(rows, width, vertices)))
+        connection.commit()
+        connection.close()
+        return {'sqlite': {'database': self.database, 'table': table}}
+
+    def unload(self, table):
+        connection = sqlite3.connect(self.database)
+        connection.execute('DROP TABLE {0}'.format(table))
+        connection.commit()
+        connection.close()
+
+    def close(self):
+        pass
+
+
+class MongoDBStandIn(object):
+    """A local mongod; documents have their geometry in the loc field as GeoJSON."""
+    def __init__(self, args, folder):
+        self.client_info = args.mongodb
+        self.processes = args.processes
+        self.folder = folder
+        self.server = None
+        self.client = None
+
+    def available(self):
+        try:
+            import pymongo
+        except ImportError:
+            return False
+        if not self.client_info:
+            mongod = find_executable('mongod')
+            if not mongod:
+                return False
+            port = free_port()
+            db_path = os.path.join(self.folder, 'mongod')
+            os.mkdir(db_path)
+            self.server = subprocess.Popen([mongod, '--dbpath', db_path, '--port', str(port), '--bind_ip', '127.0.0.1'],
+                                           stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            self.client_info = 'mongodb://127.0.0.1:{0}/'.format(port)
+        self.client = pymongo.MongoClient(self.client_info, serverSelectionTimeoutMS=30000)
+        try:
+            self.client.admin.command('ping')
+        except pymongo.errors.PyMongoError:
+            return False
+        return True
+
+    def load(self, table, rows, width, vertices):
+        names = [name for name, field_type in get_fields(width)]
+        collection = self.client.benchmark[table]
+        for batch in batches(generate_rows(rows, width, vertices)):
+            documents = []
+            for i, values, coordinates in batch:
+                document = dict(zip(names, values), _id=i)
+                if len(coordinates) == 1:
+                    document['loc'] = {'type': 'Point', 'coordinates': coordinates[0]}
+                else:
+                    document['loc'] = {'type': 'Polygon', 'coordinates': [coordinates], 'bbox': to_bbox(coordinates)}
+                documents.append(document)
+            collection.insert_many(documents)
+        return {'mongodb': {'client': self.client_info, 'database': 'benchmark', 'processes': self.processes}, 'wkt': 'true'}
+
+    def unload(self, table):
+        self.client.benchmark.drop_collection(table)
+
+    def close(self):
+        if self.client:
+            self.client.close()
+        if self.server:
+            self.server.terminate()
+            self.server.wait()
+
+
+class DynamoDBStandIn(object):
+    """DynamoDB Local; items have their geometry as WKT in the geo attribute."""
+    def __init__(self, args, folder):
+        self.endpoint_url = args.dynamodb
+        self.processes = args.processes
+        self.dynamodb = None
+
+    def available(self):
+        try:
+            import boto3
+        except ImportError:
+            return False
+        address = urlparse.urlparse(self.endpoint_url)
+        try:
+            socket.create_connection((address.hostname, address.port or 80), 2).close()
+        except socket.error:
+            return False
+        # DynamoDB Local accepts any credentials; the worker processes inherit these.
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-1', endpoint_url=self.endpoint_url)
+        return True
+
+    def load(self, table, rows, width, vertices):
+        names = [name for name, field_type in get_fields(width)]
+        dynamodb_table = self.dynamodb.create_table(TableName=table,
+                                                    KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                                                    AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'N'}],
+                                                    ProvisionedThroughput={'ReadCapacityUnits': 1000, 'WriteCapacityUnits': 1000})
+        dynamodb_table.meta.client.get_waiter('table_exists').wait(TableName=table)
+        with dynamodb_table.batch_writer() as writer:
+            for i, values, coordinates in generate_rows(rows, width, vertices):
+                values = [decimal.Decimal(repr(v)) if isinstance(v, float) else v for v in values]
+                writer.put_item(Item=dict(zip(names, values), id=i, geo=to_wkt(coordinates)))
+        return {'dynamodb': {'endpoint_url': self.endpoint_url, 'region': 'us-east-1',
+                             'segments': self.processes, 'processes': self.processes}}
+
+    def unload(self, table):
+        self.dynamodb.Table(table).delete()
+
+    def close(self):
+        pass
+
+
+class StubServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers like an ArcGIS map service with one paged point layer of the loaded features."""
+    layer = None
+
+    def do_GET(self):
+        self.answer(dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query)))
+
+    def do_POST(self):
+        self.answer(dict(urlparse.parse_qsl(self.rfile.read(int(self.headers['Content-Length'])))))
+
+    def answer(self, query):
+        path = urlparse.urlparse(self.path).path
+        layer = self.layer
+        if path.endswith('/generateToken'):
+            data = {'token': 'benchmark', 'expires': (time.time() + 3600) * 1000}
+        elif path.endswith('/MapServer'):
+            data = {'layers': [{'id': 0, 'name': layer['name']}], 'tables': []}
+        elif path.endswith('/MapServer/0'):
+            data = {'objectIdField': 'OBJECTID', 'maxRecordCount': 1000, 'supportedQueryFormats': 'JSON',
+                    'advancedQueryCapabilities': {'supportsPagination': True}, 'fields': layer['fields']}
+        elif 'returnCountOnly' in query:
+            data = {'count': len(layer['features'])}
+        elif 'resultOffset' in query:
+            offset = int(query['resultOffset'])
+            data = {'geometryType': 'esriGeometryPoint', 'spatialReference': {'wkid': 4326},
+                    'features': layer['features'][offset:offset + int(query['resultRecordCount'])]}
+        else:
+            data = {'error': {'code': 400, 'message': 'Unsupported request.'}}
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ArcGISStandIn(object):
+    """A local HTTP stub of an ArcGIS REST map service.
+    Layers are served as points; esri_worker only sends the entries of polygon service layers with missing keys.
+    """
+    def __init__(self, args, folder):
+        self.server = None
+
+    def available(self):
+        if not module_info.module_available('requests'):
+            return False
+        self.server = StubServer(('127.0.0.1', 0), StubServiceHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def load(self, table, rows, width, vertices):
+        fields = get_fields(width)
+        features = []
+        for i, values, coordinates in generate_rows(rows, width, 1):
+            attributes = dict(zip([name for name, field_type in fields], values), OBJECTID=i)
+            features.append({'attributes': attributes, 'geometry': {'x': coordinates[0][0], 'y': coordinates[0][1]}})
+        StubServiceHandler.layer = {'name': table, 'features': features,
+                                    'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}] +
+                                              [{'name': name, 'type': ESRI_TYPES[t]} for name, t in fields]}
+        return {'service_connection': {'server_url': 'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+                                       'user_name': '', 'password': '', 'token': '', 'generate_token': 'false',
+                                       'service_name': 'Benchmark', 'service_type': 'Map Service', 'folder_name': ''}}
+
+    def unload(self, table):
+        StubServiceHandler.layer = None
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+
+
+STAND_INS = collections.OrderedDict([('sqlite', SQLiteStandIn), ('mongodb', MongoDBStandIn),
+                                     ('dynamodb', DynamoDBStandIn), ('arcgis', ArcGISStandIn)])
+
+
+def find_executable(name):
+    for folder in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# ---------------------------------------------------------------------------------------------------
+# The indexer stand-in.
+# ---------------------------------------------------------------------------------------------------
+class EntrySink(threading.Thread):
+    """Counts the entries pushed by a worker, in place of the indexer."""
+    def __init__(self):
+        import zmq
+        super(EntrySink, self).__init__()
+        self.daemon = True
+        self._socket = zmq.Context.instance().socket(zmq.PULL)
+        self.address = 'tcp://127.0.0.1:{0}'.format(self._socket.bind_to_random_port('tcp://127.0.0.1'))
+        self._stopping = threading.Event()
+        self.entries = 0
+        self.bytes = 0
+        self.last_received = time.time()
+        self.start()
+
+    def run(self):
+        while not self._stopping.is_set():
+            if self._socket.poll(100):
+                self.bytes += len(self._socket.recv())
+                self.entries += 1
+                self.last_received = time.time()
+        self._socket.close(linger=0)
+
+    def drain(self, quiet=0.5):
+        """Stop once no entry has been received for the quiet period."""
+        while time.time() - self.last_received < quiet:
+            time.sleep(0.1)
+        self._stopping.set()
+        self.join()
+
+
+# ---------------------------------------------------------------------------------------------------
+# Worker processes.
+# ---------------------------------------------------------------------------------------------------
+def index_sqlite(job):
+    """Index an SQLite table with the row loop of the SQL workers."""
+    from workers import sql_worker
+    config = job.job['location']['config']['sqlite']
+    table = config['table']
+    job.connect_to_zmq()
+    metrics = job.metrics
+    metrics.table(table)
+    connection = sqlite3.connect(config['database'])
+    cursor = connection.cursor()
+    column_types = dict((c[1], SQLITE_TYPES[c[2]]) for c in cursor.execute('PRAGMA table_info({0})'.format(table)))
+    row_count = float(cursor.execute('select count(*) from {0}'.format(table)).fetchone()[0])
+
+    started = metrics.clock()
+    rows = cursor.execute('select * from {0}'.format(table))
+    metrics.add('query', started)
+
+    columns = [d[0] for d in cursor.description]
+    mapped_fields = job.map_fields(table, columns, column_types)
+    sql_worker.index_rows(job, table, rows, columns, mapped_fields, row_count, {})
+    connection.close()
+
+
+def run_worker(backend, job_file, result_file):
+    """Run the worker of a benchmark job and write its run time and resource use.
+    CPU time and peak memory include the worker's pool processes; peak memory is that of the largest process.
+    """
+    import resource
+    import PythonLocationRunner
+    from workers import base_job
+    __import__('workers.{0}'.format(WORKERS[backend]))
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    if backend == 'sqlite':
+        job = base_job.Job(job_file)
+        index_sqlite(job)
+        job.metrics.summary()
+    else:
+        PythonLocationRunner.run_job(job_file)
+    seconds = time.time() - started
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime - before.ru_utime - before.ru_stime + children.ru_utime + children.ru_stime
+    peak = max(usage.ru_maxrss, children.ru_maxrss)
+    if sys.platform == 'darwin':
+        peak /= 1024  # Bytes rather than kilobytes.
+    with open(result_file, 'w') as fp:
+        json.dump({'seconds': seconds, 'cpu': cpu, 'peak_kb': peak}, fp)
+
+
+def read_stages(output):
+    """Sum the stage times of the last metric record of each worker process in the status output."""
+    records = {}
+    for line in output.splitlines():
+        if '>>R=' in line:
+            record = json.loads(line.split('>>R=', 1)[1].split('>>STATUS', 1)[0])
+            records[record['pid']] = record
+    stages = collections.defaultdict(float)
+    for record in records.values():
+        for table in record['tables'].values():
+            for stage, seconds in table['stages'].items():
+                stages[stage] += seconds
+    return dict((stage, round(seconds, 3)) for stage, seconds in stages.items())
+
+
+def benchmark(backend, stand_in, folder, rows, width, vertices, generalize, verbose=False):
+    """Load a synthetic table into a stand-in, index it in a new process and return the measurements."""
+    table = 'bench_{0}_{1}_{2}'.format(rows, width, vertices)
+    config = {'fields': {'include': ['*']}, 'tables': [{'name': table, 'action': 'INCLUDE'}], 'metrics': {'interval': 3600}}
+    config.update(stand_in.load(table, rows, width, vertices))
+    sink = EntrySink()
+    job = {'id': 'BENCHMARK',
+           'connection': {'indexer': sink.address},
+           'location': {'id': 'benchmark', 'name': table, 'type': 'table', 'config': config,
+                        'settings': {'geometry': {'generalize': generalize}}}}
+    job_file = os.path.join(folder, '{0}_{1}.json'.format(backend, table))
+    result_file = os.path.join(folder, '{0}_{1}.result'.format(backend, table))
+    with open(job_file, 'w') as fp:
+        json.dump(job, fp)
+
+    try:
+        worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', backend, job_file, result_file],
+                                  cwd=LOCATIONS_DIR, stdout=subprocess.PIPE)
+        output = worker.communicate()[0]
+        sink.drain()
+    finally:
+        stand_in.unload(table)
+    if verbose:
+        sys.stderr.write(output)
+    result = {'backend': backend, 'rows': rows, 'width': width, 'vertices': vertices,
+              'entries': sink.entries, 'mb_sent': round(sink.bytes / 1048576.0, 2)}
+    if worker.returncode or not os.path.exists(result_file):
+        result['error'] = 'worker exited with {0}'.format(worker.returncode)
+        return result
+    with open(result_file, 'r') as fp:
+        usage = json.load(fp)
+    result['seconds'] = round(usage['seconds'], 3)
+    result['rows_per_sec'] = round(rows / usage['seconds'], 1) if usage['seconds'] else None
+    result['cpu_seconds'] = round(usage['cpu'], 3)
+    result['peak_mb'] = round(usage['peak_kb'] / 1024.0, 1)
+    result['stages'] = read_stages(output)
+    return result
+
+
+def write_table(results, out=sys.stdout):
+    columns = ['backend', 'rows', 'width', 'vertices', 'entries', 'seconds', 'rows_per_sec', 'cpu_seconds', 'peak_mb', 'mb_sent']
+    lines = [columns] + [[str(r.get(c, r.get('error', '') if c == 'seconds' else '')) for c in columns] for r in results]
+    widths = [max(len(line[n]) for line in lines) for n in range(len(columns))]
+    for line in lines:
+        out.write('  '.join(value.rjust(widths[n]) for n, value in enumerate(line)) + '\n')
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the location workers against local stand-ins.')
+    parser.add_argument('--backends', default=','.join(STAND_INS), help='stand-ins to run (default: all available)')
+    parser.add_argument('--rows', type=int_list, default=[10000], help='row counts, comma separated')
+    parser.add_argument('--width', type=int_list, default=[10], help='attribute field counts, comma separated')
+    parser.add_argument('--vertices', type=int_list, default=[1], help='polygon vertex counts (1 for points), comma separated')
+    parser.add_argument('--generalize', type=float, default=0, help='geometry generalize setting (above 0 needs OGR)')
+    parser.add_argument('--processes', type=int, default=1, help='MongoDB processes and DynamoDB scan segments')
+    parser.add_argument('--mongodb', help='client URI of a running MongoDB (default: start mongod from the PATH)')
+    parser.add_argument('--dynamodb', default='http://localhost:8000', help='DynamoDB Local endpoint')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='write the worker status output to stderr')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='voyager_benchmark_')
+    results = []
+    try:
+        for backend in args.backends.split(','):
+            stand_in = STAND_INS[backend](args, folder)
+            try:
+                if not stand_in.available():
+                    sys.stderr.write('Skipping {0}: the stand-in is not available.\n'.format(backend))
+                    continue
+                for rows, width, vertices in itertools.product(args.rows, args.width, args.vertices):
+                    results.append(benchmark(backend, stand_in, folder, rows, width, vertices, args.generalize, args.verbose))
+            finally:
+                stand_in.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    write_table(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--run':
+        run_worker(*sys.argv[2:])
+    else:
+        main()
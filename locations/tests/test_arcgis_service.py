@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import struct
+import urlparse
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+sys.path.append(os.path.join(os.path.dirname(os.getcwd()), 'workers'))
+from utils import worker_utils
+
+OBJECT_IDS = range(1, 1001)
+# Layer 1 has its own object id field and ids.
+FIDS = range(2001, 2501)
+
+
+def pbf_field(number, wire_type, payload):
+    """Encode a protocol buffer field (payload is an int for varints, else bytes)."""
+    def varint(value):
+        out = ''
+        while True:
+            b = value & 0x7f
+            value >>= 7
+            if value:
+                out += chr(b | 0x80)
+            else:
+                return out + chr(b)
+    key = varint(number << 3 | wire_type)
+    if wire_type == 0:
+        return key + varint(payload)
+    elif wire_type == 1:
+        return key + payload
+    return key + varint(len(payload)) + payload
+
+
+def pbf_points(oids):
+    """Encode a point feature collection with an OBJECTID field; points are at (oid, oid)."""
+    zigzag = lambda v: (v << 1) ^ (v >> 63)
+    transform = pbf_field(1, 0, 1)
+    transform += pbf_field(2, 2, pbf_field(1, 1, struct.pack('<d', 0.5)) + pbf_field(2, 1, struct.pack('<d', 0.5)))
+    result = pbf_field(1, 2, 'OBJECTID') + pbf_field(7, 0, 0) + pbf_field(12, 2, transform)
+    result += pbf_field(13, 2, pbf_field(1, 2, 'OBJECTID') + pbf_field(2, 0, 6))
+    for oid in oids:
+        coords = ''.join(pbf_field(0, 0, zigzag(oid * 2))[1:] for _ in range(2))
+        geometry = pbf_field(3, 2, coords)
+        result += pbf_field(15, 2, pbf_field(1, 2, pbf_field(5, 0, oid)) + pbf_field(2, 2, geometry))
+    return pbf_field(2, 2, pbf_field(1, 2, result))
+
+
+class StubServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers layer queries like an ArcGIS map service, failing the first JSON feature query once."""
+    failed = set()
+    tokens = 0
+
+    def do_POST(self):
+        query = dict(urlparse.parse_qsl(self.rfile.read(int(self.headers['Content-Length']))))
+        paged = '/PagedServer/' in self.path
+        if '/generateToken' in self.path:
+            StubServiceHandler.tokens += 1
+            data = {'token': 'token{0}'.format(self.tokens), 'expires': (time.time() + 3600) * 1000}
+        elif self.path.endswith('/0'):
+            data = {'objectIdField': 'OBJECTID', 'maxRecordCount': 300, 'supportedQueryFormats': 'JSON, PBF',
+                    'advancedQueryCapabilities': {'supportsPagination': paged},
+                    'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}]}
+        elif self.path.endswith('/1'):
+            data = {'maxRecordCount': 100, 'fields': [{'name': 'FID', 'type': 'esriFieldTypeInteger'}]}
+        elif '/1/query' in self.path and 'returnIdsOnly' in query:
+            data = {'objectIdFieldName': 'FID', 'objectIds': FIDS}
+        elif '/1/query' in self.path:
+            field, ids = query['where'].split(' IN ')
+            if not field == 'FID':
+                data = {'error': {'code': 400, 'message': 'Invalid field {0}.'.format(field)}}
+            else:
+                data = {'geometryType': 'esriGeometryPoint',
+                        'features': [{'attributes': {'FID': int(oid)}, 'geometry': {'x': 0, 'y': 0}}
+                                     for oid in ids.strip('()').split(',')]}
+        elif 'returnCountOnly' in query:
+            data = {'count': len(OBJECT_IDS)}
+        elif 'resultOffset' in query:
+            offset = int(query['resultOffset'])
+            body = pbf_points(OBJECT_IDS[offset:offset + int(query['resultRecordCount'])])
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-protobuf')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif 'returnIdsOnly' in query:
+            data = {'objectIdFieldName': 'OBJECTID', 'objectIds': OBJECT_IDS}
+        elif 'where' in query and ' IN ' in query['where']:
+            ids = [int(oid) for oid in query['where'].split('(')[1].rstrip(')').split(',')]
+            if not query['where'].startswith('OBJECTID '):
+                data = {'error': {'code': 400, 'message': 'Invalid field.'}}
+            elif query['f'] == 'pbf':
+                data = {'error': {'code': 400, 'message': 'Invalid format.'}}
+            elif ids[0] == 1 and not self.failed:
+                self.failed.add(ids[0])
+                self.send_response(503)
+                self.end_headers()
+                return
+            else:
+                data = {'geometryType': 'esriGeometryPoint',
+                        'features': [{'attributes': {'OBJECTID': oid}, 'geometry': {'x': oid, 'y': oid}} for oid in ids]}
+        else:
+            data = {}
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestArcGISService(unittest.TestCase):
+    """Test case for querying a map service layer (run against a local HTTP stub)."""
+    @classmethod
+    def setUpClass(self):
+        self.server = StubServer(('127.0.0.1', 0), StubServiceHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.portal_url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+
+    def test_concurrent_groups(self):
+        """Test concurrent group queries are retried and returned in order."""
+        helper = worker_utils.ArcGISServiceHelper(self.portal_url, '', '', instance='arcgis', concurrency=8, backoff=0.01)
+        url = '{0}/arcgis/rest/services/Test/MapServer'.format(self.portal_url)
+        row_count, row_batches = helper.get_item_row_batches(url, 0, helper.token)
+        self.assertEqual(1000, row_count)
+        features = [f for rows in row_batches for f in rows['features']]
+        self.assertEqual(OBJECT_IDS, [f['attributes']['OBJECTID'] for f in features])
+        self.assertEqual({'x': 1, 'y': 1}, features[0]['geometry'])
+        self.assertEqual(set([1]), StubServiceHandler.failed)
+
+    def test_layers_sharing_helper(self):
+        """Test layers with different object id fields are queried at the same time with one helper."""
+        helper = worker_utils.ArcGISServiceHelper(self.portal_url, '', '', instance='arcgis', concurrency=2, backoff=0.01)
+        url = '{0}/arcgis/rest/services/Test/MapServer'.format(self.portal_url)
+        first_count, first_batches = helper.get_item_row_batches(url, 0, helper.token)
+        second_count, second_batches = helper.get_item_row_batches(url, 1, helper.token)
+        self.assertEqual((1000, 500), (first_count, second_count))
+        first, second = [], []
+        for first_rows, second_rows in map(None, first_batches, second_batches):
+            if first_rows:
+                first += [f['attributes']['OBJECTID'] for f in first_rows['features']]
+            if second_rows:
+                second += [f['attributes']['FID'] for f in second_rows['features']]
+        self.assertEqual(OBJECT_IDS, first)
+        self.assertEqual(FIDS, second)
+
+    def test_paged_pbf_rows(self):
+        """Test layers supporting pagination are paged and decoded from the protocol buffer format."""
+        helper = worker_utils.ArcGISServiceHelper(self.portal_url, '', '', instance='arcgis', concurrency=4)
+        url = '{0}/arcgis/rest/services/Test/PagedServer'.format(self.portal_url)
+        row_count, row_batches = helper.get_item_row_batches(url, 0, helper.token)
+        self.assertEqual(1000, row_count)
+        features = [f for rows in row_batches for f in rows['features']]
+        self.assertEqual(OBJECT_IDS, [f['attributes']['OBJECTID'] for f in features])
+        self.assertEqual({'x': 5.0, 'y': 5.0}, features[4]['geometry'])
+        self.assertEqual('esriGeometryPoint', helper.get_item_rows(url, 0, helper.token, pbf=True, resultOffset=0,
+                                                                   resultRecordCount=1)['geometryType'])
+
+    def test_bounded_queries(self):
+        """Test queries are started only a bounded number of items ahead of a slow consumer."""
+        helper = worker_utils.ArcGISServiceHelper(self.portal_url, '', '', instance='arcgis', concurrency=4)
+        started = []
+        ahead = 0
+        results = []
+        for result in helper._imap(lambda item: started.append(item) or item, range(100)):
+            time.sleep(0.002)
+            ahead = max(ahead, len(started) - len(results))
+            results.append(result)
+        self.assertEqual(range(100), results)
+        self.assertLessEqual(ahead, 2 * helper.concurrency)
+
+    def test_token_cache(self):
+        """Test tokens are shared by helpers for the same portal and user and refreshed before they expire."""
+        worker_utils._tokens.clear()
+        StubServiceHandler.tokens = 0
+        helper = worker_utils.ArcGISServiceHelper(self.portal_url, 'user', 'password', instance='arcgis')
+        other = worker_utils.ArcGISServiceHelper(self.portal_url, 'user', 'password', instance='arcgis')
+        self.assertEqual('token1', helper.token)
+        self.assertEqual('token1', other.token)
+        self.assertEqual(1, StubServiceHandler.tokens)
+
+        # Less than the refresh fraction of the lifetime is left.
+        token, expires, lifetime = worker_utils._tokens[helper._token_key]
+        worker_utils._tokens[helper._token_key] = (token, worker_utils.time.time() + lifetime * 0.1, lifetime)
+        self.assertEqual('token2', other.token)
+        self.assertEqual('token2', helper.token)
@@ -1,5 +1,7 @@
 import os
 import sys
+import json
+import tempfile
 import unittest
 sys.path.append(os.path.dirname(os.getcwd()))
 from workers import base_job, mongodb_worker
@@ -29,3 +31,34 @@ class TestMongoDBCollections(unittest.TestCase):
         job = base_job.Job(os.path.join(os.getcwd(), 'mongodb_include_exclude.json'))
         job.connect_to_database()
         self.assertEqual(['fs.chunks', 'fs.files'], mongodb_worker.get_collections(job))
+
+    def test_id_ranges_cover_collection(self):
+        """Test the _id ranges of a split collection cover every document exactly once."""
+        job = base_job.Job(os.path.join(os.getcwd(), 'mongodb_one.json'))
+        job.connect_to_database()
+        col = job.db_connection['zips']
+        boundaries = mongodb_worker.get_id_boundaries(job, col, 8)
+        id_ranges = mongodb_worker.get_id_ranges(boundaries)
+        self.assertEqual(len(boundaries) + 1, len(id_ranges))
+        self.assertEqual(col.count(), sum(col.find(id_range).count() for id_range in id_ranges))
+
+    def test_range_query_and_map(self):
+        """Test range processes index only the documents of the table query, with the fields mapped."""
+        job = base_job.Job(os.path.join(os.getcwd(), 'mongodb_one.json'))
+        job.job['location']['config']['tables'] = [{'name': 'zips', 'action': 'INCLUDE', 'query': '{"state": "RI"}',
+                                                    'map': {'city': 'fs_city_name'}}]
+        fd, job_file = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(job.job, fp)
+        try:
+            mongodb_worker.init_process(job_file)
+            entries = []
+            mongodb_worker.job.send_entry = entries.append
+            col = mongodb_worker.job.db_connection['zips']
+            id_ranges = mongodb_worker.get_id_ranges(mongodb_worker.get_id_boundaries(mongodb_worker.job, col, 4))
+            count = sum(mongodb_worker.index_range(('zips', id_range, {}))[0] for id_range in id_ranges)
+        finally:
+            os.remove(job_file)
+        self.assertEqual(col.find({'state': 'RI'}).count(), count)
+        self.assertEqual(count, len(entries))
+        self.assertTrue(all('fs_city_name' in entry['entry']['fields'] for entry in entries))
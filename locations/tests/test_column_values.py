@@ -0,0 +1,24 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.getcwd()), 'workers'))
+import numpy
+from utils import worker_utils
+
+
+class TestColumnValues(unittest.TestCase):
+    """Test case for converting the columns of Arrow record batches read with masked arrays."""
+    def test_masked_integers(self):
+        """Test null integers are returned as None instead of 0."""
+        column = numpy.ma.array([7, 0, 9], mask=[False, True, False], dtype='i4')
+        self.assertEqual([7, None, 9], worker_utils.column_values(column))
+
+    def test_masked_reals(self):
+        """Test null and NaN reals are returned as None."""
+        column = numpy.ma.array([1.5, 0.0, float('nan')], mask=[False, True, False], dtype='f8')
+        self.assertEqual([1.5, None, None], worker_utils.column_values(column))
+
+    def test_unmasked(self):
+        """Test columns without nulls are returned unchanged."""
+        self.assertEqual([1, 2], worker_utils.column_values(numpy.array([1, 2], dtype='i8')))
+        self.assertEqual([u'a', None], worker_utils.column_values(numpy.array([u'a', None], dtype=object)))
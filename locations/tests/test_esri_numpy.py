@@ -0,0 +1,43 @@
+import os
+import sys
+import datetime
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.getcwd()), 'workers'))
+import numpy
+import esri_worker
+
+
+class TestNumPyColumns(unittest.TestCase):
+    """Test case for converting NumPy columns read with null values to Python values."""
+    def test_numbers(self):
+        """Test integer and double null values are returned as None."""
+        integers = numpy.array([1, esri_worker.NUMPY_NULL_VALUES['Integer'], 3], 'i4')
+        self.assertEqual([1, None, 3], esri_worker.numpy_column_values(integers, 'Integer'))
+        doubles = numpy.array([1.5, float('nan')], 'f8')
+        self.assertEqual([1.5, None], esri_worker.numpy_column_values(doubles, 'Double'))
+
+    def test_strings(self):
+        """Test empty strings are kept and only null strings are returned as None."""
+        strings = numpy.array([esri_worker.NUMPY_NULL_VALUES['String'], u'', u'road'], 'U5')
+        self.assertEqual([None, u'', u'road'], esri_worker.numpy_column_values(strings, 'String'))
+
+    def test_dates(self):
+        """Test dates are returned as datetimes and the null date as None."""
+        dates = numpy.array([datetime.datetime(2016, 5, 1, 12, 30), esri_worker.NUMPY_NULL_VALUES['Date']], 'M8[us]')
+        self.assertEqual([datetime.datetime(2016, 5, 1, 12, 30), None], esri_worker.numpy_column_values(dates, 'Date'))
+
+    def test_coded_values(self):
+        """Test coded values are decoded and nulls stay None."""
+        codes = numpy.array([1, 2, esri_worker.NUMPY_NULL_VALUES['SmallInteger'], 1], 'i2')
+        self.assertEqual(['Paved', 2, None, 'Paved'], esri_worker.numpy_column_values(codes, 'SmallInteger', {1: 'Paved'}))
+
+
+class TestOIDRangeExpression(unittest.TestCase):
+    """Test case for restricting a where clause to an ObjectID range."""
+    def test_range(self):
+        self.assertEqual('OBJECTID >= 1 AND OBJECTID < 100',
+                         esri_worker.get_oid_range_expression(None, None, (1, 100), 'OBJECTID'))
+
+    def test_expression(self):
+        self.assertEqual('(TYPE = 1 OR TYPE = 2) AND "OID" >= 100 AND "OID" < 200',
+                         esri_worker.get_oid_range_expression(None, 'TYPE = 1 OR TYPE = 2', (100, 200), '"OID"'))
@@ -0,0 +1,29 @@
+import os
+import sys
+import datetime
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.getcwd()), 'workers'))
+from utils import worker_utils
+
+
+class TestFieldTypeSketch(unittest.TestCase):
+    """Test case for the sampled schema inference."""
+    def test_stable_types(self):
+        """Test mixed numbers and strings widen and other fields take their most common type."""
+        sketch = worker_utils.FieldTypeSketch()
+        sketch.add({'count': 1, 'name': 'a', 'date': datetime.datetime.now(), 'note': None})
+        sketch.add({'count': 2.5, 'name': u'b', 'date': 'unknown'})
+        sketch.add({'count': 3L, 'date': datetime.datetime.now()})
+        self.assertEqual({'count': float, 'name': unicode, 'date': datetime.datetime}, dict(sketch.field_types))
+
+    def test_bounded_fields(self):
+        """Test fields beyond the maximum are not tracked and merged sketches add their counts."""
+        sketch = worker_utils.FieldTypeSketch(max_fields=2)
+        sketch.add({'a': 1, 'b': 2})
+        other = worker_utils.FieldTypeSketch()
+        other.add({'a': 1L, 'c': 3})
+        sketch.merge(other)
+        self.assertEqual(2, sketch.documents)
+        self.assertEqual(1, sketch.skipped_fields)
+        self.assertEqual(['a', 'b'], sketch.field_types.keys())
+        self.assertEqual(long, sketch.field_types['a'])
@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.getcwd()), 'workers'))
+from utils import worker_utils
+
+
+class TestSpatialKeys(unittest.TestCase):
+    """Test case for the precomputed geohash and tile keys."""
+    @classmethod
+    def setUpClass(self):
+        self.geometry_ops = worker_utils.GeometryOps()
+
+    def test_geohash(self):
+        """Test a point is encoded to the expected geohash."""
+        self.assertEqual('ezs42', self.geometry_ops.geohash(-5.6, 42.6, 5))
+        self.assertEqual('u4pruydqqvj', self.geometry_ops.geohash(10.40744, 57.64911, 11))
+
+    def test_tile_key(self):
+        """Test a point is placed in the expected slippy map tile."""
+        self.assertEqual('10/550/335', self.geometry_ops.tile_key(13.405, 52.52, 10))
+
+    def test_envelope_keys(self):
+        """Test keys for an envelope use its center and coarser levels are prefixes."""
+        geo = {'xmin': 13.3, 'xmax': 13.5, 'ymin': 52.5, 'ymax': 52.54}
+        keys = self.geometry_ops.spatial_keys(geo, [3, 5], [4, 10])
+        self.assertEqual({'fs_geohash_3': 'u33', 'fs_geohash_5': 'u33db',
+                          'fs_tile_4': '4/8/5', 'fs_tile_10': '10/550/335'}, keys)
+
+    def test_batch_keys(self):
+        """Test the batch keys match the keys computed one point at a time."""
+        lons, lats = [-5.6, 10.40744, 179.9], [42.6, 57.64911, -89.9]
+        batch = self.geometry_ops.spatial_keys_batch(lons, lats, [2, 7], [0, 12])
+        single = [self.geometry_ops.spatial_keys({'lon': x, 'lat': y}, [2, 7], [0, 12]) for x, y in zip(lons, lats)]
+        self.assertEqual(single, batch)
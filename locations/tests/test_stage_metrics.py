@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.getcwd()), 'workers'))
+from utils import worker_utils
+
+
+class RecordWriter(object):
+    """Keeps the metric records instead of writing status lines."""
+    def __init__(self):
+        self.records = []
+
+    def send_metrics(self, name, metrics):
+        self.records.append(metrics)
+
+
+class TestStageMetrics(unittest.TestCase):
+    """Test case for the stage timings and throughput reported by workers."""
+    def test_disabled(self):
+        """Test nothing is collected or reported when metrics are disabled."""
+        writer = RecordWriter()
+        metrics = worker_utils.StageMetrics(writer)
+        metrics.table('roads')
+        metrics.add('map', metrics.clock())
+        metrics.sent(100)
+        metrics.summary()
+        self.assertEqual([1, 2], list(metrics.timed('fetch', [1, 2])))
+        self.assertEqual([], writer.records)
+
+    def test_tables(self):
+        """Test rows, bytes and stage times are counted per table and the summary is final."""
+        writer = RecordWriter()
+        metrics = worker_utils.StageMetrics(writer, interval=3600)
+        metrics.table('roads')
+        self.assertEqual([[1], [2]], list(metrics.timed('fetch', [[1], [2]])))
+        metrics.sent(10)
+        metrics.sent(20)
+        metrics.table('rivers')
+        metrics.add('geometry', metrics.clock())
+        metrics.sent(5)
+        self.assertEqual([], writer.records)
+
+        metrics.summary()
+        self.assertEqual(1, len(writer.records))
+        record = writer.records[0]
+        self.assertTrue(record['final'])
+        self.assertEqual(['roads', 'rivers'], list(record['tables']))
+        self.assertEqual((2, 30), (record['tables']['roads']['rows'], record['tables']['roads']['bytes']))
+        self.assertEqual((1, 5), (record['tables']['rivers']['rows'], record['tables']['rivers']['bytes']))
+        self.assertEqual(set(worker_utils.StageMetrics.STAGES), set(record['tables']['roads']['stages']))
+
+    def test_interval(self):
+        """Test a record is sent once the interval has passed."""
+        writer = RecordWriter()
+        metrics = worker_utils.StageMetrics(writer, interval=0)
+        metrics.sent(10)
+        self.assertEqual(1, len(writer.records))
+        self.assertFalse(writer.records[0]['final'])
+
+    def test_merge(self):
+        """Test the counts collected in pool processes are added to the summary of the parent."""
+        writer = RecordWriter()
+        parent = worker_utils.StageMetrics(writer, interval=3600)
+        parent.table('roads')
+        parent.sent(10)
+        for size in (20, 30):
+            child = worker_utils.StageMetrics(RecordWriter(), interval=3600)
+            child.table('roads')
+            child.add('fetch', child.clock() - 1)
+            child.sent(size)
+            child.table('rivers')
+            child.sent(size)
+            parent.merge(child.collect())
+            self.assertEqual({}, child.collect())
+
+        parent.summary()
+        tables = writer.records[0]['tables']
+        self.assertEqual(['roads', 'rivers'], list(tables))
+        self.assertEqual((3, 60), (tables['roads']['rows'], tables['roads']['bytes']))
+        self.assertEqual((2, 50), (tables['rivers']['rows'], tables['rivers']['bytes']))
+        self.assertGreaterEqual(tables['roads']['stages']['fetch'], 2)
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+sys.path.append(os.path.dirname(os.getcwd()))
+from workers import base_job, dynamodb_worker
+
+
+class TestDynamoDBTables(unittest.TestCase):
+    """Test case for indexing DynamoDB tables (run against DynamoDB Local)."""
+    @classmethod
+    def setUpClass(self):
+        self.job = base_job.Job(os.path.join(os.getcwd(), 'dynamodb_local.json'))
+        self.job.connect_to_database()
+        self.table = self.job.dynamodb.create_table(TableName='voyager_test',
+                                                    KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                                                    AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'N'}],
+                                                    ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+        self.table.wait_until_exists()
+        with self.table.batch_writer() as batch:
+            for i in range(500):
+                batch.put_item(Item={'id': i, 'name': 'item {0}'.format(i)})
+
+    @classmethod
+    def tearDownClass(self):
+        self.table.delete()
+
+    def test_segments_cover_table(self):
+        """Test the segments of a parallel scan return every item exactly once."""
+        total_segments = self.job.dynamodb_segments
+        ids = []
+        for segment in range(total_segments):
+            items = dynamodb_worker.scan_items(self.table, Segment=segment, TotalSegments=total_segments)
+            ids += [item['id'] for item in items]
+        self.assertEqual(500, len(ids))
+        self.assertEqual(500, len(set(ids)))
+
+    def test_projection_and_filter(self):
+        """Test the fields to keep and the table query are pushed down to the scan."""
+        job = base_job.Job(os.path.join(os.getcwd(), 'dynamodb_local.json'))
+        job.job['location']['config']['fields'] = {'include': ['name']}
+        query = '{"FilterExpression": "id < :n", "ExpressionAttributeValues": {":n": 10}}'
+        job.job['location']['config']['tables'] = [{'name': 'voyager_test', 'action': 'INCLUDE', 'query': query}]
+        job.tables_to_keep()
+        job.connect_to_database()
+        scan_arguments = dynamodb_worker.get_scan_arguments(job, self.table)
+        items = list(dynamodb_worker.scan_items(self.table, **scan_arguments))
+        self.assertEqual(10, len(items))
+        self.assertEqual(set(['id', 'name']), set(items[0].keys()))
+
+    def test_segment_field_map(self):
+        """Test segment processes map the fields as configured, like the single process scan."""
+        job = base_job.Job(os.path.join(os.getcwd(), 'dynamodb_local.json'))
+        job.job['location']['config']['tables'] = [{'name': 'voyager_test', 'action': 'INCLUDE',
+                                                    'map': {'name': 'fs_item_name'}}]
+        fd, job_file = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(job.job, fp)
+        try:
+            dynamodb_worker.init_process(job_file)
+            entries = []
+            dynamodb_worker.job.send_entry = entries.append
+            total_segments = job.dynamodb_segments
+            count = sum(dynamodb_worker.index_segment(('voyager_test', segment, total_segments, {}, {}))[0]
+                        for segment in range(total_segments))
+        finally:
+            os.remove(job_file)
+        self.assertEqual(500, count)
+        self.assertEqual(500, len(entries))
+        self.assertTrue(all('fs_item_name' in entry['entry']['fields'] for entry in entries))
+
+    def test_stream_changes(self):
+        """Test new, modified and removed items are read from the table stream."""
+        table = self.job.dynamodb.create_table(TableName='voyager_test_stream',
+                                               KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                                               AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'N'}],
+                                               ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+                                               StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'NEW_IMAGE'})
+        table.wait_until_exists()
+        try:
+            table.put_item(Item={'id': 1, 'name': 'one'})
+            table.put_item(Item={'id': 1, 'name': 'uno'})
+            table.delete_item(Key={'id': 1})
+            reader = dynamodb_worker.StreamReader(dynamodb_worker.get_streams_client(self.job), table)
+            changes = list(reader.changes())
+            self.assertEqual(['ADD', 'ADD', 'DELETE'], [c[0] for c in changes])
+            self.assertEqual('uno', changes[1][2]['name'])
+
+            # Nothing is read again from the saved positions.
+            reader = dynamodb_worker.StreamReader(dynamodb_worker.get_streams_client(self.job), table, reader.state)
+            self.assertEqual([], list(reader.changes()))
+        finally:
+            table.delete()
+
+    def test_key_only_stream_changes(self):
+        """Test the current item is read for the records of a stream without new images."""
+        table = self.job.dynamodb.create_table(TableName='voyager_test_keys',
+                                               KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                                               AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'N'}],
+                                               ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+                                               StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'KEYS_ONLY'})
+        table.wait_until_exists()
+        try:
+            table.put_item(Item={'id': 1, 'name': 'one'})
+            table.put_item(Item={'id': 1, 'name': 'uno'})
+            table.put_item(Item={'id': 2, 'name': 'two'})
+            table.delete_item(Key={'id': 2})
+            reader = dynamodb_worker.StreamReader(dynamodb_worker.get_streams_client(self.job), table)
+            changes = list(reader.changes())
+            # Item 2 has been deleted since it was added, so its insert is sent as a delete.
+            self.assertEqual(['ADD', 'ADD', 'DELETE', 'DELETE'], [c[0] for c in changes])
+            self.assertEqual('uno', changes[0][2]['name'])
+            self.assertEqual({'id': 2}, changes[2][1])
+        finally:
+            table.delete()
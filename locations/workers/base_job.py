@@ -18,7 +18,49 @@ import copy
 import math
 import sys
 import decimal
-import zmq
+
+
+# Connections kept open between jobs by a resident runner, keyed by connection information.
+_connection_pool = None
+_connection_pool_pid = None
+
+
+def enable_connection_pool():
+    """Keep database connections open after a job so later jobs with the same connection reuse them."""
+    global _connection_pool, _connection_pool_pid
+    _connection_pool = {}
+    _connection_pool_pid = os.getpid()
+
+
+def get_pooled_connection(key, connect, alive=None):
+    """Return the pooled connection for a key, connecting if there is none or it is no longer usable.
+    :param key: a hashable key for the connection information
+    :param connect: function returning a new connection
+    :param alive: optional function returning False if a pooled connection can no longer be used
+    """
+    global _connection_pool, _connection_pool_pid
+    if _connection_pool is None:
+        return connect()
+    if not _connection_pool_pid == os.getpid():
+        # Connections inherited by a forked process belong to the parent.
+        _connection_pool = {}
+        _connection_pool_pid = os.getpid()
+    connection = _connection_pool.get(key)
+    if connection is None or (alive and not alive(connection)):
+        connection = _connection_pool[key] = connect()
+    return connection
+
+
+def connection_alive(connection):
+    """Return True if a DB-API connection can still be used."""
+    try:
+        if hasattr(connection, 'ping'):
+            connection.ping()
+        else:
+            connection.cursor().close()
+        return True
+    except Exception:
+        return False
 
 
 class ObjectEncoder(json.JSONEncoder):
@@ -50,18 +92,45 @@ class ObjectEncoder(json.JSONEncoder):
             else:
                 return None
 
-        try:
-            os.environ["NLS_LANG"] = ".AL32UTF8"
-            import cx_Oracle
-            if isinstance(obj, cx_Oracle.LOB):
-                if not is_binary_string(cx_Oracle.LOB.read(obj, 1024)):
-                    return str(obj)
-                else:
-                    return None
-            elif isinstance(obj, cx_Oracle.CLOB):
-                return str(obj)
-        except ImportError:
+        # Oracle LOBs only come from an Oracle job, which has already imported cx_Oracle.
+        cx_Oracle = sys.modules.get('cx_Oracle')
+        if cx_Oracle is None:
             return
+        os.environ["NLS_LANG"] = ".AL32UTF8"
+        if isinstance(obj, cx_Oracle.LOB):
+            if not is_binary_string(cx_Oracle.LOB.read(obj, 1024)):
+                return str(obj)
+            else:
+                return None
+        elif isinstance(obj, cx_Oracle.CLOB):
+            return str(obj)
+
+
+class FieldMapper(object):
+    """Maps record fields to Voyager field names, fixed per table once a field is first mapped.
+    Field types from a sampled schema keep the mapping stable for fields whose value types vary.
+    """
+    def __init__(self, job, table_name, field_types=None):
+        self._job = job
+        self._table_name = table_name
+        self.field_types = dict(field_types) if field_types else {}
+        self._mapped_names = {}
+        if self.field_types:
+            names = self.field_types.keys()
+            self._mapped_names = dict(zip(names, job.map_fields(table_name, names, self.field_types)))
+
+    def map(self, record):
+        """Return a dictionary of mapped field names and values."""
+        mapped_fields = {}
+        mapped_names = self._mapped_names
+        for name, value in record.iteritems():
+            try:
+                mapped_fields[mapped_names[name]] = value
+            except KeyError:
+                self.field_types.setdefault(name, type(value))
+                mapped_names[name] = self._job.map_fields(self._table_name, [name], self.field_types)[0]
+                mapped_fields[mapped_names[name]] = value
+        return mapped_fields
 
 
 class Job(object):
@@ -86,13 +155,19 @@ class Job(object):
         self.__get_domains()
         self.__related_tables = []
         self.__format = None
+        self.__geometry_ops = None
+        self.__metrics = None
+        self.__geohash_levels = self.geohash_levels
+        self.__tile_levels = self.tile_levels
+        self.__spatial_key_names = ['fs_geohash_{0}'.format(p) for p in self.__geohash_levels] + \
+                                   ['fs_tile_{0}'.format(z) for z in self.__tile_levels]
 
     def __del__(self):
         """Close open connections, streams, etc. after all references to Job are deleted."""
         try:
             if self.zmq_socket:
                 self.zmq_socket.close()
-            if self.db_connection:
+            if self.db_connection and _connection_pool is None:
                 self.db_connection.close()
         except TypeError:
             pass
@@ -248,6 +323,14 @@ class Job(object):
         except KeyError:
             return False
 
+    @property
+    def chunk_size(self):
+        """The number of rows above which a table is split into ObjectID ranges indexed by several processes."""
+        try:
+            return int(self.job['location']['config']['chunk_size'])
+        except KeyError:
+            return 1000000
+
     @property
     def path(self):
         """Catalog path for esri data types."""
@@ -264,6 +347,38 @@ class Job(object):
         else:
             return ''
 
+    @property
+    def service_concurrency(self):
+        """The number of concurrent queries to a map or feature service."""
+        try:
+            return int(self.job['location']['config']['service_connection']['concurrency'])
+        except (KeyError, TypeError):
+            return 4
+
+    @property
+    def service_retries(self):
+        """The number of times a failed service query is retried."""
+        try:
+            return int(self.job['location']['config']['service_connection']['retries'])
+        except (KeyError, TypeError):
+            return 3
+
+    @property
+    def service_layer_concurrency(self):
+        """The number of layers and tables of a map or feature service indexed concurrently."""
+        try:
+            return int(self.job['location']['config']['service_connection']['layers'])
+        except (KeyError, TypeError):
+            return 4
+
+    @property
+    def service_max_requests(self):
+        """The maximum number of requests sent to a map or feature service at the same time."""
+        try:
+            return int(self.job['location']['config']['service_connection']['max_requests'])
+        except (KeyError, TypeError):
+            return 8
+
     @property
     def url(self):
         """URL for GDAL/OGR dataset."""
@@ -272,6 +387,14 @@ class Job(object):
         except KeyError:
             return ''
 
+    @property
+    def gdal_processes(self):
+        """The number of processes indexing the layers of a datasource concurrently."""
+        try:
+            return int(self.job['location']['config']['gdal']['processes'])
+        except KeyError:
+            return 1
+
     @property
     def include_wkt(self):
         """Include well-known text (wkt) to geo information."""
@@ -283,6 +406,47 @@ class Job(object):
         except KeyError:
             return False
 
+    @property
+    def schema_sample_size(self):
+        """The number of records sampled to infer field types before indexing (0 disables sampling)."""
+        try:
+            return int(self.job['location']['config']['schema']['sample_size'])
+        except KeyError:
+            return 1000
+
+    @property
+    def metrics_interval(self):
+        """Seconds between throughput and stage timing metric records (None disables metrics)."""
+        try:
+            return float(self.job['location']['config']['metrics']['interval'])
+        except KeyError:
+            return None
+
+    @property
+    def metrics(self):
+        """The stage timings and throughput collected for this job."""
+        if not self.__metrics:
+            from utils import worker_utils
+            from utils import status
+            self.__metrics = worker_utils.StageMetrics(status.Writer(), self.metrics_interval)
+        return self.__metrics
+
+    @property
+    def geohash_levels(self):
+        """Geohash precisions to precompute for each point or envelope (i.e. [3, 5, 7])."""
+        try:
+            return sorted(int(p) for p in self.job['location']['config']['spatial_keys']['geohash'])
+        except KeyError:
+            return []
+
+    @property
+    def tile_levels(self):
+        """Slippy map zoom levels of the tile keys to precompute for each point or envelope."""
+        try:
+            return sorted(int(z) for z in self.job['location']['config']['spatial_keys']['tiles'])
+        except KeyError:
+            return []
+
     @property
     def dynamodb_endpoint_url(self):
         """The DynamoDB endpoint URL"""
@@ -299,6 +463,61 @@ class Job(object):
         except KeyError:
             return ''
 
+    @property
+    def dynamodb_segments(self):
+        """The number of segments of a parallel table scan (1 scans the table sequentially)."""
+        try:
+            return int(self.job['location']['config']['dynamodb']['segments'])
+        except KeyError:
+            return 1
+
+    @property
+    def dynamodb_processes(self):
+        """The number of processes scanning segments concurrently (defaults to one per segment, up to the CPU count)."""
+        try:
+            return int(self.job['location']['config']['dynamodb']['processes'])
+        except KeyError:
+            import multiprocessing
+            return min(self.dynamodb_segments, multiprocessing.cpu_count())
+
+    @property
+    def dynamodb_read_capacity(self):
+        """The read capacity units per second a scan may consume across all processes (0 is unlimited)."""
+        try:
+            return float(self.job['location']['config']['dynamodb']['read_capacity'])
+        except KeyError:
+            return 0
+
+    @property
+    def dynamodb_incremental(self):
+        """Index only the changes since the last run by reading the table streams."""
+        try:
+            if self.job['location']['config']['dynamodb']['incremental'] == 'true':
+                return True
+            else:
+                return False
+        except KeyError:
+            return False
+
+    @property
+    def dynamodb_follow(self):
+        """Keep following the table streams after catching up instead of exiting."""
+        try:
+            if self.job['location']['config']['dynamodb']['follow'] == 'true':
+                return True
+            else:
+                return False
+        except KeyError:
+            return False
+
+    @property
+    def dynamodb_state_file(self):
+        """The file storing the stream shard positions between runs."""
+        try:
+            return self.job['location']['config']['dynamodb']['state_file']
+        except KeyError:
+            return os.path.join(os.path.dirname(os.path.abspath(self.job_file)), '{0}.dynamodb.state'.format(self.location_id))
+
     @property
     def mongodb_client_info(self):
         """The mongoDB client connection string."""
@@ -314,6 +533,60 @@ class Job(object):
         except KeyError:
             return ''
 
+    @property
+    def mongodb_processes(self):
+        """The number of processes scanning _id ranges of a collection concurrently (1 scans it with one cursor)."""
+        try:
+            return int(self.job['location']['config']['mongodb']['processes'])
+        except KeyError:
+            return 1
+
+    @property
+    def mongodb_split_method(self):
+        """How a collection is split into _id ranges: auto, splitVector, sample or time."""
+        try:
+            return self.job['location']['config']['mongodb']['split_method']
+        except KeyError:
+            return 'auto'
+
+    @property
+    def mongodb_batch_size(self):
+        """The number of documents returned per cursor batch (0 uses the server default)."""
+        try:
+            return int(self.job['location']['config']['mongodb']['batch_size'])
+        except KeyError:
+            return 0
+
+    @property
+    def mongodb_incremental(self):
+        """Index only the changes since the last run using change streams (or the oplog)."""
+        try:
+            if self.job['location']['config']['mongodb']['incremental'] == 'true':
+                return True
+            else:
+                return False
+        except KeyError:
+            return False
+
+    @property
+    def mongodb_follow(self):
+        """Keep following the changes after catching up instead of exiting."""
+        try:
+            if self.job['location']['config']['mongodb']['follow'] == 'true':
+                return True
+            else:
+                return False
+        except KeyError:
+            return False
+
+    @property
+    def mongodb_state_file(self):
+        """The file storing the change stream resume tokens between runs."""
+        try:
+            return self.job['location']['config']['mongodb']['state_file']
+        except KeyError:
+            return os.path.join(os.path.dirname(os.path.abspath(self.job_file)), '{0}.mongodb.state'.format(self.location_id))
+
     @property
     def has_gridfs(self):
         try:
@@ -368,14 +641,15 @@ class Job(object):
         if self.mongodb_client_info:
             import pymongo
             import bson
-            client = pymongo.MongoClient(self.mongodb_client_info)
+            client = get_pooled_connection(('mongodb', self.mongodb_client_info), lambda: pymongo.MongoClient(self.mongodb_client_info))
             self.db_connection = client[self.mongodb_database]
         elif 'dynamodb' in self.job['location']['config']:
             import boto3
             if self.dynamodb_endpoint_url:
-                self.dynamodb = boto3.resource('dynamodb', region_name=self.dynamodb_region, endpoint_url=self.dynamodb_endpoint_url)
+                connect = lambda: boto3.resource('dynamodb', region_name=self.dynamodb_region, endpoint_url=self.dynamodb_endpoint_url)
             else:
-                self.dynamodb = boto3.resource('dynamodb', region_name=self.dynamodb_region)
+                connect = lambda: boto3.resource('dynamodb', region_name=self.dynamodb_region)
+            self.dynamodb = get_pooled_connection(('dynamodb', self.dynamodb_region, self.dynamodb_endpoint_url), connect)
         else:
             self.drvr = self.sql_connection_info['connection']['driver']
             srvr = self.sql_connection_info['connection']['server']
@@ -385,31 +659,34 @@ class Job(object):
 
             if self.drvr == 'Oracle':
                 import cx_Oracle
-                try:
-                    self.db_connection = cx_Oracle.connect("{0}/{1}@{2}/{3}".format(un, pw, srvr, db))
-                except Exception:
-                    port = self.sql_connection_info['connection']['port']
-                    sid = self.sql_connection_info['connection']['sid']
-                    dsn_string = cx_Oracle.makedsn(srvr, port, sid)
+
+                def connect():
                     try:
-                        self.db_connection = cx_Oracle.connect(user=un, password=pw, dsn=dsn_string)
-                    except cx_Oracle.DatabaseError:
-                        # Try - uid/pwd@server:port/sid
+                        return cx_Oracle.connect("{0}/{1}@{2}/{3}".format(un, pw, srvr, db))
+                    except Exception:
                         port = self.sql_connection_info['connection']['port']
                         sid = self.sql_connection_info['connection']['sid']
-                        self.db_connection = cx_Oracle.connect("{0}/{1}@{2}:{3}/{4}".format(un, pw, srvr, port, sid))
+                        dsn_string = cx_Oracle.makedsn(srvr, port, sid)
+                        try:
+                            return cx_Oracle.connect(user=un, password=pw, dsn=dsn_string)
+                        except cx_Oracle.DatabaseError:
+                            # Try - uid/pwd@server:port/sid
+                            return cx_Oracle.connect("{0}/{1}@{2}:{3}/{4}".format(un, pw, srvr, port, sid))
+                self.db_connection = get_pooled_connection((self.drvr, srvr, db, un, pw), connect, connection_alive)
                 self.db_cursor = self.db_connection.cursor()
             elif self.drvr == 'SQL Server':
                 import pyodbc
                 self.__sql_server_connection_str = "DRIVER={0};SERVER={1};DATABASE={2};UID={3};PWD={4}".format(self.drvr, srvr, db, un, pw)
-                self.db_connection = pyodbc.connect(self.__sql_server_connection_str)
+                connection_str = self.__sql_server_connection_str
+                self.db_connection = get_pooled_connection(connection_str, lambda: pyodbc.connect(connection_str), connection_alive)
                 self.db_cursor = self.db_connection.cursor()
                 self.__sql_server_connection_str = "DRIVER={0};SERVER={1};DATABASE={2};UID={3};PWD={4};OPTION=3".format(self.drvr, srvr, db, '', '')
             elif 'MySQL' in self.drvr:
                 import pyodbc
                 # Ex. "DRIVER={MySQL ODBC 5.3 ANSI Driver}; SERVER=localhost; DATABASE=test; UID=root;OPTION=3"
                 self.__sql_server_connection_str = "DRIVER={0};SERVER={1};DATABASE={2};UID={3};PWD={4};OPTION=3".format(self.drvr, srvr, db, un, pw)
-                self.db_connection = pyodbc.connect(self.__sql_server_connection_str)
+                connection_str = self.__sql_server_connection_str
+                self.db_connection = get_pooled_connection(connection_str, lambda: pyodbc.connect(connection_str), connection_alive)
                 self.db_cursor = self.db_connection.cursor()
                 self.__sql_server_connection_str = "DRIVER={0};SERVER={1};DATABASE={2};UID={3};PWD={4};OPTION=3".format(self.drvr, srvr, db, '', '')
 
@@ -588,6 +865,22 @@ class Job(object):
                     break
         return constraint
 
+    def get_table_bbox(self, table_name):
+        """Get and return the bounding box (xmin, ymin, xmax, ymax) for a table, or None."""
+        bbox = None
+        try:
+            for table in self.job['location']['config']['tables']:
+                if 'bbox' not in table:
+                    continue
+                if table['name'] == '*':
+                    bbox = table['bbox']
+                elif table['name'].lower() == table_name.lower():
+                    bbox = table['bbox']
+                    break
+        except KeyError:
+            pass
+        return [float(v) for v in bbox] if bbox else None
+
     def get_table_query(self, table_name):
         """Get and return the query for a table."""
         query = ''
@@ -607,16 +900,73 @@ class Job(object):
     def connect_to_zmq(self):
         """Connect to zmq instance."""
         try:
+            import zmq
             self.zmq_socket = zmq.Context.instance().socket(zmq.PUSH)
             self.zmq_socket.connect(self.job['connection']['indexer'])
         except Exception as ex:
             sys.stdout.write(repr(ex))
             sys.exit(1)
 
+    @property
+    def spatial_keys_enabled(self):
+        """True if geohash prefixes or tile keys are configured."""
+        return bool(self.__spatial_key_names)
+
+    def __get_geometry_ops(self):
+        if not self.__geometry_ops:
+            from utils import worker_utils
+            self.__geometry_ops = worker_utils.GeometryOps()
+        return self.__geometry_ops
+
+    def spatial_keys_batch(self, lons, lats):
+        """Return the geohash prefix and tile key fields of a batch of points, computed at once.
+        Points without coordinates get no keys. Returns None if no keys are configured.
+        Entries whose fields already have the keys are not keyed again by send_entry.
+        """
+        if not self.__spatial_key_names:
+            return None
+        keys = [{} for _ in lons]
+        valid = [k for k in range(len(lons)) if lons[k] is not None and lats[k] is not None]
+        if valid:
+            batch = self.__get_geometry_ops().spatial_keys_batch([lons[k] for k in valid], [lats[k] for k in valid],
+                                                                 self.__geohash_levels, self.__tile_levels)
+            for k, key in zip(valid, batch):
+                keys[k] = key
+        return keys
+
+    def spatial_keys_envelopes(self, xmins, ymins, xmaxs, ymaxs):
+        """Return the spatial key fields of a batch of envelopes (keyed by their centers) or None."""
+        centers = [((x1 + x2) / 2.0, (y1 + y2) / 2.0) if None not in (x1, y1, x2, y2) else (None, None)
+                   for x1, y1, x2, y2 in zip(xmins, ymins, xmaxs, ymaxs)]
+        return self.spatial_keys_batch([c[0] for c in centers], [c[1] for c in centers])
+
+    def add_spatial_keys(self, entry):
+        """Adds the configured geohash prefixes and tile keys to the fields of an entry."""
+        try:
+            geo = entry['entry']['geo']
+            fields = entry['entry']['fields']
+        except KeyError:
+            return
+        if not geo or [name for name in self.__spatial_key_names if name in fields]:
+            return
+        fields.update(self.__get_geometry_ops().spatial_keys(geo, self.__geohash_levels, self.__tile_levels))
+
     def send_entry(self, entry):
         """Sends an entry to be indexed using pyzmq."""
         try:
-            self.zmq_socket.send_json(entry, cls=ObjectEncoder)
+            if self.__geohash_levels or self.__tile_levels:
+                self.add_spatial_keys(entry)
+            metrics = self.metrics
+            if metrics.enabled:
+                started = metrics.clock()
+                message = json.dumps(entry, cls=ObjectEncoder)
+                metrics.add('encode', started)
+                started = metrics.clock()
+                self.zmq_socket.send(message)
+                metrics.add('send', started)
+                metrics.sent(len(message))
+            else:
+                self.zmq_socket.send_json(entry, cls=ObjectEncoder)
         except Exception as ex:
             print(ex)
 
@@ -11,9 +11,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from __future__ import division
+import time
 import decimal
 import json
+import os
+import fnmatch
+import multiprocessing
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
 import base_job
 from utils import status
 from utils import worker_utils
@@ -49,6 +56,422 @@ def get_tables(job):
     return table_names
 
 
+def get_scan_arguments(job, table):
+    """Return the scan arguments pushing the fields to keep and the table query down to DynamoDB.
+    The table query is either a FilterExpression or a JSON object of FilterExpression,
+    ExpressionAttributeNames and ExpressionAttributeValues.
+    """
+    kwargs = {}
+    attribute_names = {}
+    fields_to_keep = job.fields_to_keep
+    fields_to_skip = job.fields_to_skip or []
+    if not fields_to_keep == ['*'] and not [f for f in fields_to_keep if '*' in f]:
+        key_names = [k['AttributeName'] for k in table.key_schema]
+        projected = [f for f in fields_to_keep if f not in fields_to_skip]
+        projected += [k for k in key_names if k not in projected]
+        # Placeholders avoid conflicts with DynamoDB reserved words.
+        for i, name in enumerate(projected):
+            attribute_names['#p{0}'.format(i)] = name
+        kwargs['ProjectionExpression'] = ', '.join('#p{0}'.format(i) for i in range(len(projected)))
+
+    query = job.get_table_query(table.name)
+    if query:
+        if query.strip().startswith('{'):
+            query = json.loads(query, parse_float=decimal.Decimal, parse_int=decimal.Decimal)
+            kwargs['FilterExpression'] = query['FilterExpression']
+            attribute_names.update(query.get('ExpressionAttributeNames', {}))
+            if 'ExpressionAttributeValues' in query:
+                kwargs['ExpressionAttributeValues'] = query['ExpressionAttributeValues']
+        else:
+            kwargs['FilterExpression'] = query
+    if attribute_names:
+        kwargs['ExpressionAttributeNames'] = attribute_names
+    return kwargs
+
+
+def get_field_filter(job):
+    """Return a function removing the fields that cannot be excluded by a projection, or None if there are none."""
+    fields_to_keep = [f.lower() for f in job.fields_to_keep]
+    fields_to_skip = [f.lower() for f in job.fields_to_skip or []]
+    keep_all = fields_to_keep == ['*']
+    if not fields_to_skip and (keep_all or not [f for f in fields_to_keep if '*' in f]):
+        return None
+
+    def keep(name):
+        name = name.lower()
+        if not keep_all and not [f for f in fields_to_keep if fnmatch.fnmatch(name, f)]:
+            return False
+        return not [f for f in fields_to_skip if fnmatch.fnmatch(name, f)]
+
+    def field_filter(item):
+        return dict((k, v) for k, v in item.iteritems() if keep(k))
+    return field_filter
+
+
+def sample_field_types(job, table, scan_arguments=None, field_filter=None):
+    """Infer the field types of a table from a single scan page of its first items.
+    Only one page is read, so a selective filter returns fewer items instead of scanning the whole table.
+    """
+    sample_size = job.schema_sample_size
+    if not sample_size:
+        return {}
+    sketch = worker_utils.FieldTypeSketch()
+    for item in table.scan(Limit=sample_size, **scan_arguments or {})['Items']:
+        sketch.add(field_filter(item) if field_filter else item)
+    return sketch.field_types
+
+
+def send_schema(job, table, field_types):
+    """Send an entry for the table itself with the sampled schema."""
+    key_names = [k['AttributeName'] for k in table.key_schema]
+    schema = {}
+    schema['name'] = table.name
+    schema['rows'] = table.item_count
+    schema_columns = []
+    for n, t in field_types.items():
+        column = {}
+        column['name'] = n
+        column['type'] = t
+        if n in key_names:
+            column['properties'] = ['INDEXED', 'NOTNULLABLE', 'PRIMARY KEY']
+        else:
+            column['properties'] = ['NULLABLE']
+        schema_columns.append(column)
+    schema['fields'] = schema_columns
+
+    table_entry = {}
+    table_entry['id'] = '{0}_{1}'.format(job.location_id, table.name)
+    table_entry['location'] = job.location_id
+    table_entry['action'] = job.action_type
+    table_entry['format_type'] = 'Schema'
+    table_entry['entry'] = {'fields': {'_discoveryID': job.discovery_id, 'name': table.name}}
+    table_entry['entry']['fields']['schema'] = schema
+    job.send_entry(table_entry)
+
+
+class ReadThrottle(object):
+    """Sleeps between scan pages to keep consumed read capacity under a rate (units per second)."""
+    def __init__(self, units_per_second):
+        self.units_per_second = units_per_second
+        self._start = time.time()
+        self._consumed = 0
+
+    def consume(self, units):
+        """Record consumed capacity units and wait until the rate allows the next request."""
+        if not self.units_per_second:
+            return
+        self._consumed += units
+        wait = self._consumed / self.units_per_second - (time.time() - self._start)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def scan_items(table, throttle=None, **kwargs):
+    """Yield the items of a table (or of a scan segment) following LastEvaluatedKey."""
+    if throttle and throttle.units_per_second:
+        kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+    while True:
+        scan = table.scan(**kwargs)
+        for item in scan['Items']:
+            yield item
+        if throttle and 'ConsumedCapacity' in scan:
+            throttle.consume(scan['ConsumedCapacity']['CapacityUnits'])
+        if 'LastEvaluatedKey' not in scan:
+            break
+        kwargs['ExclusiveStartKey'] = scan['LastEvaluatedKey']
+
+
+def get_item_id(table, item):
+    """Return the entry id of an item from its key attributes."""
+    return '_'.join([table.name] + [str(item[k['AttributeName']]) for k in table.key_schema])
+
+
+def index_item(job, table, item, field_mapper, field_filter=None):
+    """Index a table item."""
+    entry = {}
+    entry['id'] = get_item_id(table, item)
+    if field_filter:
+        item = field_filter(item)
+
+    # Map fields to voyager fields and to those specified in the configuration.
+    metrics = job.metrics
+    started = metrics.clock()
+    mapped_fields = field_mapper.map(item)
+    metrics.add('map', started)
+
+    # TODO: Fetch geographic information from mapped fields.
+    started = metrics.clock()
+    geo = {}
+    if 'geo' in mapped_fields:
+        geo['wkt'] = mapped_fields['geo']
+    metrics.add('geometry', started)
+
+    mapped_fields['_discoveryID'] = job.discovery_id
+    mapped_fields['title'] = table.name
+    mapped_fields['format_type'] = 'Record'
+    mapped_fields['format'] = 'application/vnd.dynamodb.record'
+    entry['location'] = job.location_id
+    entry['action'] = job.action_type
+    entry['entry'] = {'geo': geo, 'fields': mapped_fields}
+    job.send_entry(entry)
+
+
+def index_items(job, table, items, field_mapper, field_filter=None, report=True):
+    """Index each item. Returns the number of items and the field types of the table."""
+    # The item count is updated about every six hours, so it can be 0 for a table with items.
+    item_count = table.item_count
+    increment = job.get_increment(max(item_count, 1))
+    i = 0
+    for item in job.metrics.timed('fetch', items):
+        index_item(job, table, item, field_mapper, field_filter)
+        i += 1
+        if report and item_count and (i % increment) == 0:
+            status_writer.send_percent(min(i / item_count, 1.0),
+                                       '{0}: {1:.2%}'.format(table.name, min(i / item_count, 1.0)),
+                                       'DynamoDB')
+    return i, field_mapper.field_types
+
+
+def init_process(job_file):
+    """Create a job with its own DynamoDB client and ZMQ socket in each worker process."""
+    global job
+    job = base_job.Job(job_file)
+    # Load the table queries and field mapping of the location.
+    job.tables_to_keep()
+    job.connect_to_zmq()
+    job.connect_to_database()
+
+
+def index_segment(args):
+    """Index the items of one segment of a parallel scan (runs in a worker process)."""
+    table_name, segment, total_segments, scan_arguments, field_types = args
+    job.metrics.table(table_name)
+    table = job.dynamodb.Table(table_name)
+    throttle = ReadThrottle(job.dynamodb_read_capacity / job.dynamodb_processes)
+    items = scan_items(table, throttle, Segment=segment, TotalSegments=total_segments, **scan_arguments)
+    field_mapper = base_job.FieldMapper(job, table_name, field_types)
+    count, field_types = index_items(job, table, items, field_mapper, get_field_filter(job), report=False)
+    return count, field_types, job.metrics.collect()
+
+
+def index_table_segments(dynamodb_job, table, scan_arguments, field_types):
+    """Scan the segments of a table concurrently in worker processes."""
+    total_segments = dynamodb_job.dynamodb_segments
+    status_writer.send_status('Indexing {0} in {1} segments...'.format(table.name, total_segments))
+    processed = 0
+    field_types = dict(field_types)
+    item_count = table.item_count
+    pool = multiprocessing.Pool(dynamodb_job.dynamodb_processes, initializer=init_process, initargs=(dynamodb_job.job_file,))
+    try:
+        segments = [(table.name, s, total_segments, scan_arguments, field_types) for s in range(total_segments)]
+        for count, segment_field_types, segment_metrics in pool.imap_unordered(index_segment, segments):
+            processed += count
+            dynamodb_job.metrics.merge(segment_metrics)
+            for name, field_type in segment_field_types.items():
+                field_types.setdefault(name, field_type)
+            if item_count:
+                status_writer.send_percent(min(processed / item_count, 1.0),
+                                           '{0}: {1:.2%}'.format(table.name, min(processed / item_count, 1.0)),
+                                           'DynamoDB')
+    finally:
+        pool.close()
+        pool.join()
+    return processed, field_types
+
+
+def index_table(job, table):
+    """Index the items of a table and send its schema. Returns the field types of the table."""
+    job.metrics.table(table.name)
+    scan_arguments = get_scan_arguments(job, table)
+    field_filter = get_field_filter(job)
+    # Fix the field mapping from a sample before the full scan.
+    field_types = sample_field_types(job, table, scan_arguments, field_filter)
+    if job.dynamodb_segments > 1:
+        row_count, field_types = index_table_segments(job, table, scan_arguments, field_types)
+    else:
+        items = scan_items(table, ReadThrottle(job.dynamodb_read_capacity), **scan_arguments)
+        field_mapper = base_job.FieldMapper(job, table.name, field_types)
+        row_count, field_types = index_items(job, table, items, field_mapper, field_filter)
+    if row_count:
+        send_schema(job, table, field_types)
+    return field_types
+
+
+def load_state(job):
+    """Return the saved stream positions by table."""
+    try:
+        with open(job.dynamodb_state_file, 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(job, state):
+    """Save the stream positions so the next run continues where this one stopped."""
+    temp_file = '{0}.tmp'.format(job.dynamodb_state_file)
+    with open(temp_file, 'w') as fp:
+        json.dump(state, fp)
+    if os.path.exists(job.dynamodb_state_file):
+        os.remove(job.dynamodb_state_file)
+    os.rename(temp_file, job.dynamodb_state_file)
+
+
+NEW_IMAGE_VIEW_TYPES = ('NEW_IMAGE', 'NEW_AND_OLD_IMAGES')
+
+
+class StreamReader(object):
+    """Reads the records of a table stream, shard by shard, from saved sequence numbers.
+    Shards without a saved position are read from the oldest record (TRIM_HORIZON). Records
+    older than a full load are sent again, which leaves the index with the latest item values.
+    """
+    def __init__(self, client, table, state=None):
+        self._client = client
+        self._table = table
+        self._deserializer = TypeDeserializer()
+        self._iterators = {}
+        if state and state.get('stream_arn') == table.latest_stream_arn:
+            self.state = state
+        else:
+            self.state = {'stream_arn': table.latest_stream_arn, 'loaded': False, 'shards': {}, 'closed': []}
+
+    def _shards(self):
+        """Return the shards of the stream, parents before children."""
+        shards = []
+        kwargs = {'StreamArn': self.state['stream_arn']}
+        while True:
+            description = self._client.describe_stream(**kwargs)['StreamDescription']
+            shards += description['Shards']
+            if 'LastEvaluatedShardId' not in description:
+                break
+            kwargs['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+        shard_ids = set(s['ShardId'] for s in shards)
+        ordered = []
+        done = set()
+        while shards:
+            ready = [s for s in shards if s.get('ParentShardId') not in shard_ids or s['ParentShardId'] in done]
+            if not ready:
+                ready = shards
+            for shard in ready:
+                ordered.append(shard['ShardId'])
+                done.add(shard['ShardId'])
+            shards = [s for s in shards if s['ShardId'] not in done]
+        return ordered
+
+    def _shard_iterator(self, shard_id):
+        """Return a new iterator positioned after the saved sequence number of a shard."""
+        kwargs = {'StreamArn': self.state['stream_arn'], 'ShardId': shard_id}
+        sequence_number = self.state['shards'].get(shard_id)
+        if sequence_number:
+            kwargs['ShardIteratorType'] = 'AFTER_SEQUENCE_NUMBER'
+            kwargs['SequenceNumber'] = sequence_number
+        else:
+            kwargs['ShardIteratorType'] = 'TRIM_HORIZON'
+        return self._client.get_shard_iterator(**kwargs)['ShardIterator']
+
+    def changes(self):
+        """Yield (action, keys, item) for the records available now; action is 'ADD' or 'DELETE'."""
+        closed = self.state['closed']
+        for shard_id in self._shards():
+            if shard_id in closed:
+                continue
+            iterator = self._iterators.get(shard_id) or self._shard_iterator(shard_id)
+            while iterator:
+                try:
+                    response = self._client.get_records(ShardIterator=iterator)
+                except ClientError as ce:
+                    if ce.response['Error']['Code'] == 'ExpiredIteratorException':
+                        iterator = self._shard_iterator(shard_id)
+                        continue
+                    raise
+                for record in response['Records']:
+                    stream_record = record['dynamodb']
+                    keys = self._deserialize(stream_record['Keys'])
+                    if record['eventName'] == 'REMOVE':
+                        yield 'DELETE', keys, None
+                    elif 'NewImage' in stream_record:
+                        yield 'ADD', keys, self._deserialize(stream_record['NewImage'])
+                    else:
+                        # Without a new image the current item is read; it may have been deleted since.
+                        item = self._table.get_item(Key=keys).get('Item')
+                        yield ('ADD', keys, item) if item else ('DELETE', keys, None)
+                    self.state['shards'][shard_id] = stream_record['SequenceNumber']
+                iterator = response.get('NextShardIterator')
+                if not response['Records']:
+                    # The open shard has no more records for now.
+                    break
+            if iterator:
+                self._iterators[shard_id] = iterator
+            else:
+                # A closed shard has been read to the end.
+                self._iterators.pop(shard_id, None)
+                closed.append(shard_id)
+                self.state['shards'].pop(shard_id, None)
+
+    def _deserialize(self, image):
+        return dict((k, self._deserializer.deserialize(v)) for k, v in image.iteritems())
+
+
+def get_streams_client(job):
+    """Return a DynamoDB Streams client for the location's region and endpoint."""
+    if job.dynamodb_endpoint_url:
+        return boto3.client('dynamodbstreams', region_name=job.dynamodb_region, endpoint_url=job.dynamodb_endpoint_url)
+    else:
+        return boto3.client('dynamodbstreams', region_name=job.dynamodb_region)
+
+
+def index_changes(job, table_names):
+    """Index the stream records of each table since the last run (and keep following them in follow mode).
+    Tables without a saved position are fully scanned first. Tables without a stream are only scanned.
+    For streams without new images (KEYS_ONLY or OLD_IMAGE), the current item of each change is read from the table.
+    """
+    client = get_streams_client(job)
+    state = load_state(job)
+    readers = []
+    for table_name in table_names:
+        table = job.dynamodb.Table(table_name)
+        if not table.latest_stream_arn:
+            status_writer.send_state(status.STAT_WARNING, 'Streams are not enabled for {0}.'.format(table_name))
+            index_table(job, table)
+            continue
+        view_type = (table.stream_specification or {}).get('StreamViewType')
+        if view_type not in NEW_IMAGE_VIEW_TYPES:
+            status_writer.send_state(status.STAT_WARNING, 'The stream of {0} is {1}; the item of each change is read '
+                                                          'from the table.'.format(table_name, view_type))
+        reader = StreamReader(client, table, state.get(table_name))
+        field_filter = get_field_filter(job)
+        if not reader.state['loaded']:
+            field_types = index_table(job, table)
+            reader.state['loaded'] = True
+        else:
+            field_types = sample_field_types(job, table, get_scan_arguments(job, table), field_filter)
+        field_mapper = base_job.FieldMapper(job, table.name, field_types)
+        readers.append((table, reader, field_mapper, field_filter))
+
+    try:
+        while readers:
+            processed = 0
+            for table, reader, field_mapper, field_filter in readers:
+                for action, keys, item in reader.changes():
+                    if action == 'DELETE':
+                        job.send_entry({'id': get_item_id(table, keys), 'location': job.location_id, 'action': 'DELETE'})
+                    else:
+                        index_item(job, table, item, field_mapper, field_filter)
+                    processed += 1
+                state[table.name] = reader.state
+                save_state(job, state)
+            if processed:
+                status_writer.send_status('Indexed {0} changes.'.format(processed))
+            if not job.dynamodb_follow:
+                break
+            if not processed:
+                time.sleep(1)
+    finally:
+        for table, reader, field_mapper, field_filter in readers:
+            state[table.name] = reader.state
+        if readers:
+            save_state(job, state)
+
+
 def run_job(dynamodb_job):
     """Worker function to index each document in each table in the database."""
     job = dynamodb_job
@@ -56,48 +479,11 @@ def run_job(dynamodb_job):
     job.connect_to_database()
     tables = get_tables(job)
 
+    if job.dynamodb_incremental:
+        index_changes(job, tables)
+        return
+
     for table_name in tables:
         table = job.dynamodb.Table(table_name)
-        has_start_key = True
         if not table.item_count == 0:
-            i = 0
-            increment = job.get_increment(table.item_count)
-            scan = table.scan()
-            items = scan['Items']
-            while has_start_key:
-                for item in items:
-                    field_names = item.keys()
-                    field_types = dict((k, type(v)) for k, v in item.items())
-                    field_values = item.values()
-
-                    entry = {}
-
-                    # Map fields to voyager fields and to those specified in the configuration.
-                    mapped_fields = job.map_fields (table.name, field_names, field_types)
-                    mapped_fields = dict(zip(mapped_fields, field_values))
-
-                    # TODO: Fetch geographic information from mapped fields.
-                    geo = {}
-                    if 'geo' in mapped_fields:
-                        geo['wkt'] = mapped_fields['geo']
-
-                    mapped_fields['_discoveryID'] = job.discovery_id
-                    mapped_fields['title'] = table.name
-                    mapped_fields['format_type'] = 'Record'
-                    mapped_fields['format'] = 'application/vnd.dynamodb.record'
-                    entry['location'] = job.location_id
-                    entry['action'] = job.action_type
-                    entry['entry'] = {'geo': geo, 'fields': mapped_fields}
-                    job.send_entry(entry)
-                    i += 1
-                    if (i % increment) == 0:
-                        status_writer.send_percent(float(i) / table.item_count,
-                                                   '{0}: {1:.2f}%'.format(table.name, float(i) / table.item_count),
-                                                   'DynamoDB')
-
-                # Fetch all other items remaining in the table.
-                if 'LastEvaluatedKey' not in scan:
-                    has_start_key = False
-                else:
-                    scan = table.scan(ExclusiveStartKey=scan['LastEvaluatedKey'])
-                    items = scan['Items']
+            index_table(job, table)
@@ -13,6 +13,7 @@
 # limitations under the License.
 from __future__ import division
 import os
+import math
 import sys
 import copy
 import datetime
@@ -20,11 +21,33 @@ import itertools
 from collections import OrderedDict
 import logging
 import multiprocessing
-import arcpy
-import _server_admin as arcrest
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from utils import status
+from utils import worker_utils
+
+# ArcGIS is only loaded once a dataset or geometry is read, so service layers can be indexed without it.
+arcpy = worker_utils.LazyModule('arcpy')
+arcrest = worker_utils.LazyModule('_server_admin')
 
 status_writer = status.Writer()
+# Rows per NumPy array read; field types that can be read into NumPy arrays with their null values.
+NUMPY_CHUNK_SIZE = 100000
+# Strings use a Unicode noncharacter: NumPy strips trailing NULs, so '\x00' would also match empty strings.
+NUMPY_NULL_VALUES = {'OID': -2147483648,
+                     'Integer': -2147483648,
+                     'SmallInteger': -32768,
+                     'Double': float('nan'),
+                     'Single': float('nan'),
+                     'String': u'\uffff',
+                     'GUID': u'\uffff',
+                     'GlobalID': u'\uffff',
+                     'Date': datetime.datetime(1, 1, 1)}
+_send_lock = threading.Lock()
 
 
 class NullGeometry(Exception):
@@ -88,6 +111,21 @@ def make_feature(feature):
         raise NullGeometry
 
 
+def get_feature_extent(feature):
+    """Return the geometry type and (xmin, xmax, ymin, ymax) of a feature's JSON geometry,
+    or None if it has no coordinates.
+    """
+    geometry = feature.get('geometry') or {}
+    for key, geometry_type in (('paths', 'polyline'), ('rings', 'polygon'), ('points', 'multipoint')):
+        if key in geometry:
+            parts = [geometry[key]] if key == 'points' else geometry[key]
+            xs = [coords[0] for part in parts for coords in part]
+            ys = [coords[1] for part in parts for coords in part]
+            if xs:
+                return geometry_type, (min(xs), max(xs), min(ys), max(ys))
+    return None
+
+
 def query_layer(layer, spatial_rel='esriSpatialRelIntersects', count_only=False, where='1=1',
                 out_fields='*', out_sr=4326, return_geometry=True, token=''):
     """Returns a GPFeatureRecordSetLayer from a feature service layer or
@@ -117,15 +155,56 @@ def query_layer(layer, spatial_rel='esriSpatialRelIntersects', count_only=False,
     return qry_layer
 
 
-def update_row(fields, rows, row):
-    """Updates the coded values in a row with the coded value descriptions."""
-    field_domains = {f.name: f.domain for f in fields if f.domain}
-    fields_values = zip(rows.fields, row)
-    for j, x in enumerate(fields_values):
-        if x[0] in field_domains:
-            domain_name = field_domains[x[0]]
-            row[j] = job.domains[domain_name][x[1]]
-    return row
+def compile_domains(dsc, cursor_fields):
+    """Compile the coded value domains of the cursor fields into a function replacing the codes of a row
+    with their descriptions, or return None if no field has a coded value domain.
+    Domains assigned to subtypes are used for the rows of that subtype.
+    """
+    def lookups(field_domains):
+        return [(j, job.domains[field_domains[name]]) for j, name in enumerate(cursor_fields)
+                if field_domains.get(name) in job.domains]
+
+    field_domains = dict((f.name, f.domain) for f in dsc.fields if f.domain)
+    default_lookups = lookups(field_domains)
+
+    # Subtype specific domains.
+    subtype_lookups = {}
+    subtype_index = None
+    try:
+        subtypes = arcpy.da.ListSubtypes(dsc.catalogPath)
+    except (AttributeError, RuntimeError, IOError):
+        subtypes = {}
+    for code, subtype in subtypes.iteritems():
+        if not subtype['SubtypeField'] or subtype['SubtypeField'] not in cursor_fields:
+            continue
+        subtype_index = list(cursor_fields).index(subtype['SubtypeField'])
+        subtype_domains = dict(field_domains)
+        for name, (default, domain) in subtype['FieldValues'].iteritems():
+            if domain and domain.domainType == 'CodedValue':
+                if domain.name not in job.domains:
+                    job.domains[domain.name] = domain.codedValues
+                subtype_domains[name] = domain.name
+        subtype_lookups[code] = lookups(subtype_domains)
+
+    if not default_lookups and not [l for l in subtype_lookups.values() if l]:
+        return None
+
+    def decode(row):
+        row = list(row)
+        if subtype_index is None:
+            row_lookups = default_lookups
+        else:
+            row_lookups = subtype_lookups.get(row[subtype_index], default_lookups)
+        for j, coded_values in row_lookups:
+            try:
+                row[j] = coded_values[row[j]]
+            except KeyError:
+                # Null values and codes missing from the domain are kept.
+                pass
+        return row
+    decode.lookups = default_lookups
+    decode.by_subtype = subtype_index is not None
+    return decode
 
 
 def index_service(connection_info):
@@ -133,7 +212,6 @@ def index_service(connection_info):
     from utils import worker_utils
     geometry_ops = worker_utils.GeometryOps()
     job.connect_to_zmq()
-    entry = {}
     items = {}
     url = ''
 
@@ -154,7 +232,9 @@ def index_service(connection_info):
         instance = 'arcgis'
 
     # Create the ArcGIS service helper and get the service url and the service items (layers/tables).
-    ags_helper = worker_utils.ArcGISServiceHelper(connection_url, user_name, password, instance=instance)
+    ags_helper = worker_utils.ArcGISServiceHelper(connection_url, user_name, password, instance=instance,
+                                                  concurrency=job.service_concurrency, retries=job.service_retries,
+                                                  max_requests=job.service_max_requests)
     try:
         if token == '' and generate_token == 'false':
             url, items = ags_helper.find_item_url(service_name, service_type, folder_name)
@@ -191,96 +271,126 @@ def index_service(connection_info):
             layers = [l for l in layers if lk[0] == l['name']]
 
     # Index the records for each layer and table within a feature or map service.
-    for layer in layers:
-        i = 0.
-        geo = {}
-        layer_id = layer['id']
-        layer_name = layer['name']
-        mapped_attributes = OrderedDict()
+    progress = ServiceProgress(layers)
+    concurrency = min(job.service_layer_concurrency, len(layers))
+    if concurrency > 1:
+        pool = ThreadPool(concurrency)
+        try:
+            for _ in pool.imap_unordered(lambda layer: index_service_layer(ags_helper, url, layer, geometry_ops, progress), layers):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for layer in layers:
+            index_service_layer(ags_helper, url, layer, geometry_ops, progress)
 
-        status_writer.send_status('Indexing {0}...'.format((url, layer_name)))
 
-        # Get the list of fields and field types.
-        fields_types = {}
-        try:
-            fields = ags_helper.get_item_fields(url, layer_id, ags_helper.token)
-        except KeyError:
-            status_writer.send_status("Layer {0} has no fields.".format(layer_name))
-            continue
-        for f in fields:
-            fields_types[f['name']] = f['type']
+def send_entry(entry):
+    """Send an entry; layers indexed on several threads share the job's ZMQ socket."""
+    with _send_lock:
+        job.send_entry(entry)
 
-        # Check if the layer is empty and ensure to get all features, not just first 1000 (esri default).
-        objectid_groups, row_count = ags_helper.get_item_row_count(url, layer_id, ags_helper.token)
-        oid_field_name = ags_helper.oid_field_name
-        if not row_count:
+
+class ServiceProgress(object):
+    """Merges the progress of the layers of a service indexed concurrently into one job percentage."""
+    def __init__(self, layers):
+        self._lock = threading.Lock()
+        self._layers = len(layers)
+        self._progress = {}
+
+    def update(self, layer_name, processed, row_count):
+        """Record the processed rows of a layer and send the overall percentage."""
+        with self._lock:
+            self._progress[layer_name] = min(processed / row_count, 1.0)
+            percent = sum(self._progress.values()) / self._layers
+        status_writer.send_percent(percent, "{0} {1:%}".format(layer_name, percent), 'esri_worker')
+
+
+def index_service_layer(ags_helper, url, layer, geometry_ops, progress):
+    """Index the records of a service layer or table. Returns the number of rows."""
+    entry = {}
+    i = 0.
+    geo = {}
+    layer_id = layer['id']
+    layer_name = layer['name']
+    job.metrics.table(layer_name)
+    mapped_attributes = OrderedDict()
+
+    status_writer.send_status('Indexing {0}...'.format((url, layer_name)))
+
+    # Get the list of fields and field types.
+    fields_types = {}
+    try:
+        fields = ags_helper.get_item_fields(url, layer_id, ags_helper.token)
+    except KeyError:
+        status_writer.send_status("Layer {0} has no fields.".format(layer_name))
+        progress.update(layer_name, 1, 1)
+        return 0
+    for f in fields:
+        fields_types[f['name']] = f['type']
+
+    # Check if the layer is empty and ensure to get all features, not just first 1000 (esri default).
+    row_count, row_batches = ags_helper.get_item_row_batches(url, layer_id, ags_helper.token)
+    if not row_count:
+        status_writer.send_status("Layer {0} has no features.".format(layer_name))
+        progress.update(layer_name, 1, 1)
+        return 0
+    else:
+        increment = float(job.get_increment(row_count))
+
+    metrics = job.metrics
+    for rows in metrics.timed('fetch', row_batches):
+        features = None
+        if 'features' in rows:
+            features = rows['features']
+        if not features:
             status_writer.send_status("Layer {0} has no features.".format(layer_name))
             continue
+        if 'attributes' in features[0]:
+            attributes = OrderedDict(features[0]['attributes'])
         else:
-            increment = float(job.get_increment(row_count))
-
-        for group in objectid_groups:
-            group = [oid for oid in group if not oid == None]
-            rows = ags_helper.get_item_rows(url, layer_id, ags_helper.token, where='{0} IN {1}'.format(oid_field_name, tuple(group)))
-            features = None
-            if 'features' in rows:
-                features = rows['features']
-            if not features:
-                status_writer.send_status("Layer {0} has no features.".format(layer_name))
-                continue
-            if 'attributes' in features[0]:
-                attributes = OrderedDict(features[0]['attributes'])
-            else:
-                status_writer.send_status("Layer {0} has no attributes.".format(layer_name))
+            status_writer.send_status("Layer {0} has no attributes.".format(layer_name))
 
-            if 'geometryType' in rows:
-                geometry_type = rows['geometryType']
-            else:
-                geometry_type = 'Table'
-            if 'spatialReference' in rows:
-                geo['srid'] = rows['spatialReference']['wkid']
-
-            # Map the field and it's value.
-            if not job.fields_to_keep == ['*']:
-                for fk in job.fields_to_keep:
-                    mapped_fields = dict((name, val) for name, val in attributes.items() if fk in name)
-                    if job.fields_to_skip:
-                        for fs in job.fields_to_skip:
-                            [mapped_fields.pop(name) for name in attributes if name in fs]
-            else:
-                mapped_fields = copy.deepcopy(attributes)
+        if 'geometryType' in rows:
+            geometry_type = rows['geometryType']
+        else:
+            geometry_type = 'Table'
+        if 'spatialReference' in rows:
+            geo['srid'] = rows['spatialReference']['wkid']
 
-            # This will generate the field mapping dictionary.
-            job.tables_to_keep()
+        # Map the field and it's value.
+        if not job.fields_to_keep == ['*']:
+            for fk in job.fields_to_keep:
+                mapped_fields = dict((name, val) for name, val in attributes.items() if fk in name)
+                if job.fields_to_skip:
+                    for fs in job.fields_to_skip:
+                        [mapped_fields.pop(name) for name in attributes if name in fs]
+        else:
+            mapped_fields = copy.deepcopy(attributes)
 
-            date_fields = set()
-            field_map = None
+        # This will generate the field mapping dictionary.
+        job.tables_to_keep()
+
+        date_fields = set()
+        field_map = None
+        for mapping in job.field_mapping:
+            if mapping['name'] == layer_name:
+                field_map = mapping['map']
+                break
+
+        if not field_map:
             for mapping in job.field_mapping:
-                if mapping['name'] == layer_name:
+                if mapping['name'] == '*':
                     field_map = mapping['map']
                     break
 
-            if not field_map:
-                for mapping in job.field_mapping:
-                    if mapping['name'] == '*':
-                        field_map = mapping['map']
-                        break
-
-            if field_map:
-                for k, v in mapped_fields.items():
-                    if k in field_map:
-                        new_field = field_map[k]
-                        mapped_attributes[new_field] = mapped_fields.pop(k)
-                    else:
-                        field_type = job.default_mapping(fields_types[k])
-                        if field_type == 'fd_':
-                            # Because dates are being returned as longs.
-                            mapped_attributes[field_type + k] = v
-                            date_fields.add(field_type + k)
-                        else:
-                            mapped_attributes[field_type + k] = mapped_fields.pop(k)
-            else:
-                for k, v in mapped_fields.items():
+        if field_map:
+            for k, v in mapped_fields.items():
+                if k in field_map:
+                    new_field = field_map[k]
+                    mapped_attributes[new_field] = mapped_fields.pop(k)
+                else:
                     field_type = job.default_mapping(fields_types[k])
                     if field_type == 'fd_':
                         # Because dates are being returned as longs.
@@ -288,106 +398,249 @@ def index_service(connection_info):
                         date_fields.add(field_type + k)
                     else:
                         mapped_attributes[field_type + k] = mapped_fields.pop(k)
+        else:
+            for k, v in mapped_fields.items():
+                field_type = job.default_mapping(fields_types[k])
+                if field_type == 'fd_':
+                    # Because dates are being returned as longs.
+                    mapped_attributes[field_type + k] = v
+                    date_fields.add(field_type + k)
+                else:
+                    mapped_attributes[field_type + k] = mapped_fields.pop(k)
 
-            i += len(features)
-            if geometry_type == 'Table':
-                for x, row in enumerate(features):
-                    entry['id'] = '{0}_{1}_{2}_{3}'.format(job.location_id, layer_name, i, x)
+        i += len(features)
+        if geometry_type == 'Table':
+            for x, row in enumerate(features):
+                entry['id'] = '{0}_{1}_{2}_{3}'.format(job.location_id, layer_name, i, x)
+                entry['location'] = job.location_id
+                entry['action'] = job.action_type
+                mapped_fields = dict(zip(mapped_attributes.keys(), row['attributes'].values()))
+                # Convert longs to datetime.
+                for df in date_fields:
+                    mapped_fields[df] = get_date(mapped_fields[df])
+                mapped_fields['title'] = layer_name
+                mapped_fields['meta_table_name'] = layer_name
+                mapped_fields['_discoveryID'] = job.discovery_id
+                mapped_fields['format_category'] = 'GIS'
+                mapped_fields['format_type'] = 'Service Layer Record'
+                mapped_fields['format'] = 'application/vnd.esri.service.layer.record'
+                entry['entry'] = {'fields': mapped_fields}
+                send_entry(entry)
+                if (i % increment) == 0:
+                    progress.update(layer_name, i, row_count)
+        else:
+            # Faster to do one if check for geometry type then to condense code and check in every iteration.
+            if geometry_type == 'esriGeometryPoint':
+                for x, feature in enumerate(features):
+                    pt = feature['geometry']
+                    geo['lon'] = pt['x']
+                    geo['lat'] = pt['y']
+                    entry['id'] = '{0}_{1}_{2}_{3}'.format(job.location_id, layer_name, int(i), x)
                     entry['location'] = job.location_id
                     entry['action'] = job.action_type
-                    mapped_fields = dict(zip(mapped_attributes.keys(), row['attributes'].values()))
+                    mapped_fields = dict(zip(mapped_attributes.keys(), feature['attributes'].values()))
                     # Convert longs to datetime.
                     for df in date_fields:
                         mapped_fields[df] = get_date(mapped_fields[df])
+                    mapped_fields['_discoveryID'] = job.discovery_id
                     mapped_fields['title'] = layer_name
+                    mapped_fields['geometry_type'] = 'Point'
                     mapped_fields['meta_table_name'] = layer_name
-                    mapped_fields['_discoveryID'] = job.discovery_id
                     mapped_fields['format_category'] = 'GIS'
-                    mapped_fields['format_type'] = 'Service Layer Record'
+                    mapped_fields['format_type'] = 'Service Layer Feature'
                     mapped_fields['format'] = 'application/vnd.esri.service.layer.record'
-                    entry['entry'] = {'fields': mapped_fields}
-                    job.send_entry(entry)
+                    entry['entry'] = {'geo': geo, 'fields': mapped_fields}
+                    send_entry(entry)
                     if (i % increment) == 0:
-                        status_writer.send_percent(i / row_count, "{0} {1:%}".format(layer_name, i / row_count), 'esri_worker')
+                        progress.update(layer_name, i, row_count)
             else:
-                # Faster to do one if check for geometry type then to condense code and check in every iteration.
-                if geometry_type == 'esriGeometryPoint':
-                    for x, feature in enumerate(features):
-                        pt = feature['geometry']
-                        geo['lon'] = pt['x']
-                        geo['lat'] = pt['y']
-                        entry['id'] = '{0}_{1}_{2}_{3}'.format(job.location_id, layer_name, int(i), x)
-                        entry['location'] = job.location_id
-                        entry['action'] = job.action_type
-                        mapped_fields = dict(zip(mapped_attributes.keys(), feature['attributes'].values()))
+                generalize_value = job.generalize_value
+                for x, feature in enumerate(features):
+                    started = metrics.clock()
+                    if generalize_value > 0.9:
+                        # The extent is read from the coordinates, without building an ArcGIS geometry.
+                        extent = get_feature_extent(feature)
+                        if not extent:
+                            continue
+                        geometry_type, (geo['xmin'], geo['xmax'], geo['ymin'], geo['ymax']) = extent
+                    else:
+                        try:
+                            geometry = make_feature(feature)  # Catch possible null geometries.
+                        except RuntimeError:
+                            continue
+                        geometry_type = geometry.type
+                        if generalize_value == 0 or generalize_value == 0.0:
+                            geo['wkt'] = geometry.WKT
+                        elif geometry_ops:
+                            geo['wkt'] = geometry_ops.generalize_wkb(geometry.WKB, generalize_value)
+                        else:
+                            geo['xmin'], geo['xmax'] = geometry.extent.XMin, geometry.extent.XMax
+                            geo['ymin'], geo['ymax'] = geometry.extent.YMin, geometry.extent.YMax
+                    metrics.add('geometry', started)
+
+                    entry['id'] = '{0}_{1}_{2}_{3}'.format(job.location_id, layer_name, int(i), x)
+                    entry['location'] = job.location_id
+                    entry['action'] = job.action_type
+                    mapped_fields = dict(zip(mapped_attributes.keys(), OrderedDict(feature['attributes']).values()))
+                    try:
                         # Convert longs to datetime.
                         for df in date_fields:
                             mapped_fields[df] = get_date(mapped_fields[df])
-                        mapped_fields['_discoveryID'] = job.discovery_id
                         mapped_fields['title'] = layer_name
-                        mapped_fields['geometry_type'] = 'Point'
+                        mapped_fields['geometry_type'] = geometry_type
                         mapped_fields['meta_table_name'] = layer_name
+                        mapped_fields['meta_table_path'] = layer['path']
+                        mapped_fields['meta_table_location'] = os.path.dirname(layer['path'])
                         mapped_fields['format_category'] = 'GIS'
                         mapped_fields['format_type'] = 'Service Layer Feature'
                         mapped_fields['format'] = 'application/vnd.esri.service.layer.record'
+                        mapped_fields['_discoveryID'] = job.discovery_id
                         entry['entry'] = {'geo': geo, 'fields': mapped_fields}
-                        job.send_entry(entry)
-                        if (i % increment) == 0:
-                            status_writer.send_percent(i / row_count, "{0} {1:%}".format(layer_name, int(i) / row_count), 'esri_worker')
-                else:
-                    generalize_value = job.generalize_value
-                    for x, feature in enumerate(features):
-                        try:
-                            geometry = make_feature(feature)  # Catch possible null geometries.
-                        except RuntimeError:
-                            continue
+                    except KeyError:
+                        send_entry(entry)
+                    if (i % increment) == 0:
+                        progress.update(layer_name, i, row_count)
+    progress.update(layer_name, row_count, row_count)
+    return int(i)
 
-                        if generalize_value > 0.9:
-                            geo['xmin'], geo['xmax'] = geometry.extent.XMin, geometry.extent.XMax
-                            geo['ymin'], geo['ymax'] = geometry.extent.YMin, geometry.extent.YMax
-                        elif generalize_value == 0 or generalize_value == 0.0:
-                            geo['wkt'] = geometry.WKT
-                        else:
-                            if geometry_ops:
-                                geo['wkt'] = geometry_ops.generalize_geometry(geometry.WKT, generalize_value)
-                            else:
-                                geo['xmin'], geo['xmax'] = geometry.extent.XMin, geometry.extent.XMax
-                                geo['ymin'], geo['ymax'] = geometry.extent.YMin, geometry.extent.YMax
-
-                        entry['id'] = '{0}_{1}_{2}_{3}'.format(job.location_id, layer_name, int(i), x)
-                        entry['location'] = job.location_id
-                        entry['action'] = job.action_type
-                        mapped_fields = dict(zip(mapped_attributes.keys(), OrderedDict(feature['attributes']).values()))
-                        try:
-                            # Convert longs to datetime.
-                            for df in date_fields:
-                                mapped_fields[df] = get_date(mapped_fields[df])
-                            mapped_fields['title'] = layer_name
-                            mapped_fields['geometry_type'] = geometry.type
-                            mapped_fields['meta_table_name'] = layer_name
-                            mapped_fields['meta_table_path'] = layer['path']
-                            mapped_fields['meta_table_location'] = os.path.dirname(layer['path'])
-                            mapped_fields['format_category'] = 'GIS'
-                            mapped_fields['format_type'] = 'Service Layer Feature'
-                            mapped_fields['format'] = 'application/vnd.esri.service.layer.record'
-                            mapped_fields['_discoveryID'] = job.discovery_id
-                            entry['entry'] = {'geo': geo, 'fields': mapped_fields}
-                        except KeyError:
-                            job.send_entry(entry)
-                        if (i % increment) == 0:
-                            status_writer.send_percent(i / row_count, "{0} {1:%}".format(layer_name, i / row_count), 'esri_worker')
-
-
-def worker(data_path, esri_service=False):
-    """The worker function to index feature data and tabular data."""
+def get_entry_template(dsc, format_type, geometry_type=None):
+    """Return the fields shared by every entry of a table: discovery id, table names, format and new fields."""
+    template = {}
+    template['_discoveryID'] = job.discovery_id
+    template['meta_table_name'] = dsc.name
+    if hasattr(dsc, 'aliasName') and dsc.aliasName:
+        template['meta_table_alias_name'] = dsc.aliasName
+    else:
+        template['meta_table_alias_name'] = dsc.name
+    template['format_category'] = 'GIS'
+    template['format_type'] = format_type
+    if format_type == 'Record':
+        template['format'] = "application/vnd.esri.{0}.record".format(dsc.dataType.lower())
+    else:
+        template['format'] = "application/vnd.esri.{0}.feature".format(dsc.dataType.lower())
+    if geometry_type:
+        template['geometry_type'] = geometry_type
+    for nf in job.new_fields:
+        if nf['name'] == '*' or nf['name'] == dsc.name:
+            for k, v in nf['new_fields'].iteritems():
+                template[k] = v
+    return template
+
+
+def get_row_field_names(mapped_fields, global_id_field):
+    """Return the entry field name of each cursor column, with the global id stored as a meta field."""
+    if not global_id_field:
+        return list(mapped_fields)
+    global_id_name = 'fi_{0}'.format(global_id_field)
+    return [('meta_{0}'.format(global_id_field) if name == global_id_name else name) for name in mapped_fields]
+
+
+def get_shape_token(shape_type, generalize_value, geometry_ops):
+    """Return the cursor shape token that reads only as much of the geometry as will be indexed.
+    Full geometries are read as WKT, geometries to generalize as WKB and geometries reduced to a bbox as the extent.
+    """
+    if generalize_value == 0:
+        return 'SHAPE@WKT'
+    elif not geometry_ops or (shape_type == 'Polygon' and generalize_value > 0.9):
+        return 'SHAPE@EXTENT'
+    else:
+        return 'SHAPE@WKB'
+
+
+def can_read_numpy(dsc, field_types, decode):
+    """Return True if the table can be read in NumPy arrays: only scalar fields and no subtype domains."""
+    if numpy is None or not getattr(dsc, 'hasOID', False) or job.get_join(dsc.name):
+        return False
+    if decode and decode.by_subtype:
+        return False
+    return all(t in NUMPY_NULL_VALUES for t in field_types.values())
+
+
+def numpy_column_values(column, field_type, coded_values=None):
+    """Convert a NumPy column to a list of Python values, with nulls as None and coded values decoded."""
+    null_value = NUMPY_NULL_VALUES[field_type]
+    if field_type in ('Double', 'Single'):
+        nulls = numpy.isnan(column)
+    elif field_type == 'Date':
+        column = column.astype('M8[us]')
+        nulls = column == numpy.datetime64(null_value, 'us')
+    else:
+        nulls = column == null_value
+    if coded_values:
+        # Decode each distinct value once.
+        uniques, inverse = numpy.unique(column, return_inverse=True)
+        values = numpy.array([coded_values.get(u, u) for u in uniques.tolist()], dtype=object)[inverse]
+    else:
+        values = column.astype(object)
+    if nulls.any():
+        values[nulls] = None
+    return values.tolist()
+
+
+def index_numpy(dsc, source, fields, field_types, names, template, expression, row_count, oid_range, decode,
+                id_prefix, report, geo_template=None, sr=None):
+    """Index a table (or point feature class) from NumPy arrays read in ObjectID ranges of NUMPY_CHUNK_SIZE rows.
+    Returns the number of rows indexed.
+    """
+    if oid_range:
+        low, high = oid_range
+    else:
+        # Shapefile FIDs are record numbers, so the range is from the count of all rows, not only those matching.
+        low, high = get_oid_ranges(dsc, int(arcpy.GetCount_management(source).getOutput(0)), 1)[0]
+    coded_values = dict(decode.lookups) if decode else {}
+    null_values = dict((f, NUMPY_NULL_VALUES[field_types[f]]) for f in fields)
+    location_id, action_type = job.location_id, job.action_type
+    metrics = job.metrics
+    i = 0
+    for chunk_low in range(low, high, NUMPY_CHUNK_SIZE):
+        where = get_oid_range_expression(dsc, expression, (chunk_low, min(chunk_low + NUMPY_CHUNK_SIZE, high)))
+        started = metrics.clock()
+        if geo_template is None:
+            array = arcpy.da.TableToNumPyArray(source, fields + ['OID@'], where, null_value=null_values)
+        else:
+            array = arcpy.da.FeatureClassToNumPyArray(source, fields + ['OID@', 'SHAPE@XY'], where, sr, null_value=null_values)
+        metrics.add('fetch', started)
+        if not len(array):
+            continue
+        started = metrics.clock()
+        columns = [numpy_column_values(array[f], field_types[f], coded_values.get(j)) for j, f in enumerate(fields)]
+        oids = array['OID@'].tolist()
+        metrics.add('map', started)
+        if geo_template is None:
+            geos = itertools.repeat(None)
+        else:
+            # Null shapes are read as NaN coordinates and sent without them.
+            started = metrics.clock()
+            geos = [dict(geo_template, lon=x, lat=y) if x == x and y == y else dict(geo_template)
+                    for x, y in array['SHAPE@XY'].tolist()]
+            metrics.add('geometry', started)
+        for oid, geo, row in itertools.izip(oids, geos, itertools.izip(*columns) if columns else itertools.repeat(())):
+            mapped_fields = dict(itertools.izip(names, row))
+            mapped_fields.update(template)
+            if geo is None:
+                entry = {'fields': mapped_fields}
+            else:
+                entry = {'geo': geo, 'fields': mapped_fields}
+            job.send_entry({'id': id_prefix + str(oid), 'location': location_id, 'action': action_type, 'entry': entry})
+        i += len(oids)
+        if report:
+            status_writer.send_percent(i / row_count, "{0} {1:%}".format(dsc.name, i / row_count), 'esri_worker')
+    return i
+
+
+def worker(data_path, esri_service=False, oid_range=None, send_schema=True):
+    """The worker function to index feature data and tabular data.
+    With an ObjectID range (low, high), only that chunk of the table is indexed and progress is left to the caller.
+    """
     if esri_service:
         index_service(job.service_connection)
     else:
         job.connect_to_zmq()
-        geo = {}
-        entry = {}
         schema = {}
+        report = oid_range is None
         dsc = arcpy.Describe(data_path)
+        metrics = job.metrics
+        metrics.table(dsc.name)
 
         try:
             from utils import worker_utils
@@ -406,7 +659,6 @@ def worker(data_path, esri_service=False):
             shape_field_name = None
 
         # Get the table schema.
-        table_entry = {}
         schema['name'] = dsc.name
         try:
             alias = dsc.aliasName
@@ -464,59 +716,46 @@ def worker(data_path, esri_service=False):
                     expression = query
                 else:
                     expression = constraint
+            if oid_range:
+                expression = get_oid_range_expression(dsc, expression, oid_range)
 
             field_types = job.search_fields(table_view)
             fields = field_types.keys()
-            row_count = float(arcpy.GetCount_management(table_view).getOutput(0))
+            table_rows = float(arcpy.GetCount_management(table_view).getOutput(0))
+            row_count = get_row_count(table_view, expression) if expression else table_rows
             if row_count == 0.0:
+                if send_schema and table_rows:
+                    send_table_schema(dsc, schema, table_rows)
                 return
 
-            with arcpy.da.SearchCursor(table_view, fields, expression) as rows:
-                mapped_fields = job.map_fields(dsc.name, fields, field_types)
-                new_fields = job.new_fields
-                ordered_fields = OrderedDict()
-                for f in mapped_fields:
-                    ordered_fields[f] = None
-                increment = job.get_increment(row_count)
-                for i, row in enumerate(rows, 1):
-                    try:
-                        if job.domains:
-                            row = update_row(dsc.fields, rows, list(row))
-                        mapped_fields = dict(zip(ordered_fields.keys(), row))
-                        mapped_fields['_discoveryID'] = job.discovery_id
-                        mapped_fields['meta_table_name'] = dsc.name
-                        if hasattr(dsc, 'aliasName') and dsc.aliasName:
-                            mapped_fields['meta_table_alias_name'] = dsc.aliasName
-                        else:
-                            mapped_fields['meta_table_alias_name'] = dsc.name
-                        mapped_fields['format_category'] = 'GIS'
-                        mapped_fields['format_type'] = "Record"
-                        mapped_fields['format'] = "application/vnd.esri.{0}.record".format(dsc.dataType.lower())
-                        for nf in new_fields:
-                            if nf['name'] == '*' or nf['name'] == dsc.name:
-                                for k, v in nf['new_fields'].iteritems():
-                                    mapped_fields[k] = v
-                        oid_field = filter(lambda x: x in ('FID', 'OID', 'OBJECTID'), rows.fields)
-                        if oid_field:
-                            fld_index = rows.fields.index(oid_field[0])
-                        else:
-                            fld_index = i
-                        if global_id_field:
-                             mapped_fields['meta_{0}'.format(global_id_field)] = mapped_fields.pop('fi_{0}'.format(global_id_field))
-                        entry['id'] = '{0}_{1}_{2}'.format(job.location_id, os.path.basename(data_path), row[fld_index])
-                        entry['location'] = job.location_id
-                        entry['action'] = job.action_type
-                        entry['entry'] = {'fields': mapped_fields}
-                        job.send_entry(entry)
-                        if (i % increment) == 0:
-                            status_writer.send_percent(i / row_count, "{0} {1:%}".format(dsc.name, i / row_count), 'esri_worker')
-                    except (AttributeError, RuntimeError):
-                        continue
+            names = get_row_field_names(job.map_fields(dsc.name, fields, field_types), global_id_field)
+            template = get_entry_template(dsc, 'Record')
+            decode = compile_domains(dsc, fields) if job.domains else None
+            if can_read_numpy(dsc, field_types, decode):
+                id_prefix = '{0}_{1}_'.format(job.location_id, os.path.basename(data_path))
+                index_numpy(dsc, table_view, fields, field_types, names, template, expression, row_count, oid_range,
+                            decode, id_prefix, report)
+            else:
+                with arcpy.da.SearchCursor(table_view, fields + ['OID@'], expression) as rows:
+                    id_prefix = '{0}_{1}_'.format(job.location_id, os.path.basename(data_path))
+                    location_id, action_type = job.location_id, job.action_type
+                    increment = job.get_increment(row_count)
+                    for i, row in enumerate(metrics.timed('fetch', rows), 1):
+                        try:
+                            if decode:
+                                row = decode(row)
+                            mapped_fields = dict(itertools.izip(names, row[:-1]))
+                            mapped_fields.update(template)
+                            job.send_entry({'id': id_prefix + str(row[-1]), 'location': location_id, 'action': action_type,
+                                            'entry': {'fields': mapped_fields}})
+                            if report and (i % increment) == 0:
+                                status_writer.send_percent(i / row_count, "{0} {1:%}".format(dsc.name, i / row_count), 'esri_worker')
+                        except (AttributeError, RuntimeError):
+                            continue
         else:
             generalize_value = job.generalize_value
             sr = arcpy.SpatialReference(4326)
-            geo['spatialReference'] = dsc.spatialReference.name
-            geo['code'] = dsc.spatialReference.factoryCode
+            geo_template = {'spatialReference': dsc.spatialReference.name, 'code': dsc.spatialReference.factoryCode}
 
             # Get join information.
             table_join = job.get_join(dsc.name)
@@ -537,115 +776,157 @@ def worker(data_path, esri_service=False):
                     expression = query
                 else:
                     expression = constraint
+            if oid_range:
+                expression = get_oid_range_expression(dsc, expression, oid_range)
             if dsc.shapeFieldName in fields:
                 fields.remove(dsc.shapeFieldName)
                 field_types.pop(dsc.shapeFieldName)
             elif table_join:
                 fields.remove(arcpy.Describe(lyr).shapeFieldName)
                 field_types.pop(arcpy.Describe(lyr).shapeFieldName)
-            row_count = float(arcpy.GetCount_management(lyr).getOutput(0))
+            table_rows = float(arcpy.GetCount_management(lyr).getOutput(0))
+            row_count = get_row_count(lyr, expression) if expression else table_rows
             if row_count == 0.0:
+                if send_schema and table_rows:
+                    send_table_schema(dsc, schema, table_rows)
                 return
+            names = get_row_field_names(job.map_fields(dsc.name, fields, field_types), global_id_field)
+            location_id, action_type = job.location_id, job.action_type
+            increment = job.get_increment(row_count)
             if dsc.shapeType == 'Point':
-                with arcpy.da.SearchCursor(lyr, ['SHAPE@'] + fields, expression, sr) as rows:
-                    mapped_fields = job.map_fields(dsc.name, list(rows.fields[1:]), field_types)
-                    new_fields = job.new_fields
-                    ordered_fields = OrderedDict()
-                    for f in mapped_fields:
-                        ordered_fields[f] = None
-                    increment = job.get_increment(row_count)
-                    for i, row in enumerate(rows):
-                        try:
-                            if job.domains:
-                                row = update_row(dsc.fields, rows, list(row))
-                            if row[0]:
-                                geo['lon'] = row[0].firstPoint.X
-                                geo['lat'] = row[0].firstPoint.Y
-                            mapped_fields = dict(zip(ordered_fields.keys(), row[1:]))
-                            mapped_fields['_discoveryID'] = job.discovery_id
-                            mapped_fields['meta_table_name'] = dsc.name
-                            if hasattr(dsc, 'aliasName') and dsc.aliasName:
-                                mapped_fields['meta_table_alias_name'] = dsc.aliasName
-                            else:
-                                mapped_fields['meta_table_alias_name'] = dsc.name
-                            mapped_fields['format_category'] = 'GIS'
-                            mapped_fields['geometry_type'] = 'Point'
-                            mapped_fields['format_type'] = 'Feature'
-                            mapped_fields['format'] = "application/vnd.esri.{0}.feature".format(dsc.dataType.lower())
-                            for nf in new_fields:
-                                if nf['name'] == '*' or nf['name'] == dsc.name:
-                                    for k, v in nf['new_fields'].iteritems():
-                                        mapped_fields[k] = v
-                            if global_id_field:
-                                 mapped_fields['meta_{0}'.format(global_id_field)] = mapped_fields.pop('fi_{0}'.format(global_id_field))
-                            entry['id'] = '{0}_{1}_{2}'.format(job.location_id, os.path.basename(data_path), i)
-                            entry['location'] = job.location_id
-                            entry['action'] = job.action_type
-                            entry['entry'] = {'geo': geo, 'fields': mapped_fields}
-                            job.send_entry(entry)
-                            if (i % increment) == 0:
-                                status_writer.send_percent(i / row_count, "{0} {1:%}".format(dsc.name, i / row_count), 'esri_worker')
-                        except (AttributeError, RuntimeError):
-                            continue
+                template = get_entry_template(dsc, 'Feature', 'Point')
+                id_prefix = '{0}_{1}_'.format(job.location_id, os.path.basename(data_path))
+                decode = compile_domains(dsc, fields) if job.domains else None
+                if can_read_numpy(dsc, field_types, decode):
+                    index_numpy(dsc, lyr, fields, field_types, names, template, expression, row_count, oid_range,
+                                decode, id_prefix, report, geo_template, sr)
+                else:
+                    with arcpy.da.SearchCursor(lyr, ['SHAPE@XY'] + fields + ['OID@'], expression, sr) as rows:
+                        decode = compile_domains(dsc, rows.fields) if job.domains else None
+                        for i, row in enumerate(metrics.timed('fetch', rows)):
+                            try:
+                                if decode:
+                                    row = decode(row)
+                                started = metrics.clock()
+                                geo = dict(geo_template)
+                                if row[0][0] is not None:
+                                    geo['lon'], geo['lat'] = row[0]
+                                metrics.add('geometry', started)
+                                mapped_fields = dict(itertools.izip(names, row[1:-1]))
+                                mapped_fields.update(template)
+                                job.send_entry({'id': id_prefix + str(row[-1]), 'location': location_id, 'action': action_type,
+                                                'entry': {'geo': geo, 'fields': mapped_fields}})
+                                if report and (i % increment) == 0:
+                                    status_writer.send_percent(i / row_count, "{0} {1:%}".format(dsc.name, i / row_count), 'esri_worker')
+                            except (AttributeError, RuntimeError):
+                                continue
             else:
-                with arcpy.da.SearchCursor(lyr, ['SHAPE@'] + fields, expression, sr) as rows:
-                    increment = job.get_increment(row_count)
-                    mapped_fields = job.map_fields(dsc.name, list(rows.fields[1:]), field_types)
-                    new_fields = job.new_fields
-                    ordered_fields = OrderedDict()
-                    for f in mapped_fields:
-                        ordered_fields[f] = None
-                    for i, row in enumerate(rows):
+                template = get_entry_template(dsc, 'Feature', dsc.shapeType)
+                id_prefix = '{0}_{1}_'.format(job.location_id, os.path.splitext(os.path.basename(data_path))[0])
+                shape_token = get_shape_token(dsc.shapeType, generalize_value, geometry_ops)
+                with arcpy.da.SearchCursor(lyr, [shape_token] + fields + ['OID@'], expression, sr) as rows:
+                    decode = compile_domains(dsc, rows.fields) if job.domains else None
+                    for i, row in enumerate(metrics.timed('fetch', rows)):
                         try:
-                            if job.domains:
-                                row = update_row(dsc.fields, rows, list(row))
+                            if decode:
+                                row = decode(row)
+                            started = metrics.clock()
+                            geo = dict(geo_template)
                             if row[0]:
-                                if generalize_value == 0 or generalize_value == 0.0:
-                                    geo['wkt'] = row[0].WKT
+                                if shape_token == 'SHAPE@WKT':
+                                    geo['wkt'] = row[0]
+                                elif shape_token == 'SHAPE@WKB':
+                                    geo['wkt'] = geometry_ops.generalize_wkb(row[0], generalize_value)
                                 else:
-                                    if geometry_ops:
-                                        geo['wkt'] = geometry_ops.generalize_geometry(row[0].WKT, generalize_value)
-                                    else:
-                                        geo['xmin'] = row[0].extent.XMin
-                                        geo['xmax'] = row[0].extent.XMax
-                                        geo['ymin'] = row[0].extent.YMin
-                                        geo['ymax'] = row[0].extent.YMax
-                            mapped_fields = dict(zip(ordered_fields.keys(), row[1:]))
-                            mapped_fields['_discoveryID'] = job.discovery_id
-                            mapped_fields['meta_table_name'] = dsc.name
-                            if hasattr(dsc, 'aliasName') and dsc.aliasName:
-                                mapped_fields['meta_table_alias_name'] = dsc.aliasName
-                            else:
-                                mapped_fields['meta_table_alias_name'] = dsc.name
-                            for nf in new_fields:
-                                if nf['name'] == '*' or nf['name'] == dsc.name:
-                                    for k, v in nf['new_fields'].iteritems():
-                                        mapped_fields[k] = v
-                            if global_id_field:
-                                mapped_fields['meta_{0}'.format(global_id_field)] = mapped_fields.pop('fi_{0}'.format(global_id_field))
-                            mapped_fields['geometry_type'] = dsc.shapeType
-                            mapped_fields['format_category'] = 'GIS'
-                            mapped_fields['format_type'] = 'Feature'
-                            mapped_fields['format'] = "application/vnd.esri.{0}.feature".format(dsc.dataType.lower())
-                            entry['id'] = '{0}_{1}_{2}'.format(job.location_id, os.path.splitext(os.path.basename(data_path))[0], i)
-                            entry['location'] = job.location_id
-                            entry['action'] = job.action_type
-                            entry['entry'] = {'geo': geo, 'fields': mapped_fields}
-                            job.send_entry(entry)
-                            if (i % increment) == 0:
+                                    geo['xmin'], geo['xmax'] = row[0].XMin, row[0].XMax
+                                    geo['ymin'], geo['ymax'] = row[0].YMin, row[0].YMax
+                            metrics.add('geometry', started)
+                            mapped_fields = dict(itertools.izip(names, row[1:-1]))
+                            mapped_fields.update(template)
+                            job.send_entry({'id': id_prefix + str(row[-1]), 'location': location_id, 'action': action_type,
+                                            'entry': {'geo': geo, 'fields': mapped_fields}})
+                            if report and (i % increment) == 0:
                                 status_writer.send_percent(i / row_count, "{0} {1:%}".format(dsc.name, i / row_count), 'esri_worker')
                         except (AttributeError, RuntimeError):
                             continue
 
-        # Add and entry for the table and it's schema.
-        schema['rows'] = row_count
-        table_entry['id'] = '{0}_{1}'.format(job.location_id, dsc.name)
-        table_entry['location'] = job.location_id
-        table_entry['action'] = job.action_type
-        table_entry['format_type'] = 'Schema'
-        table_entry['entry'] = {'fields': {'_discoveryID': job.discovery_id, 'name': dsc.name, 'path': dsc.catalogPath, 'format': 'schema'}}
-        table_entry['entry']['fields']['schema'] = schema
-        job.send_entry(table_entry)
+        if send_schema:
+            send_table_schema(dsc, schema, table_rows)
+
+
+def send_table_schema(dsc, schema, row_count):
+    """Add an entry for the table and its schema."""
+    schema['rows'] = row_count
+    table_entry = {}
+    table_entry['id'] = '{0}_{1}'.format(job.location_id, dsc.name)
+    table_entry['location'] = job.location_id
+    table_entry['action'] = job.action_type
+    table_entry['format_type'] = 'Schema'
+    table_entry['entry'] = {'fields': {'_discoveryID': job.discovery_id, 'name': dsc.name, 'path': dsc.catalogPath, 'format': 'schema'}}
+    table_entry['entry']['fields']['schema'] = schema
+    job.send_entry(table_entry)
+
+
+def get_row_count(source, expression):
+    """Return the number of rows of a table, layer or view matching a where clause (such as an ObjectID range)."""
+    view = arcpy.MakeTableView_management(source, 'count_view', expression)
+    try:
+        return float(arcpy.GetCount_management(view).getOutput(0))
+    finally:
+        arcpy.Delete_management(view)
+
+
+def get_oid_ranges(dsc, row_count, chunks):
+    """Split the ObjectIDs of a table into ranges [low, high) of about the same size."""
+    if dsc.dataType in ('ShapeFile', 'Shapefile', 'DbaseTable'):
+        # FIDs are the record numbers.
+        min_oid, max_oid = 0, row_count - 1
+    else:
+        oid_field = arcpy.AddFieldDelimiters(dsc.catalogPath, dsc.OIDFieldName)
+        with arcpy.da.SearchCursor(dsc.catalogPath, ['OID@'], sql_clause=(None, 'ORDER BY {0}'.format(oid_field))) as rows:
+            min_oid = next(rows)[0]
+        with arcpy.da.SearchCursor(dsc.catalogPath, ['OID@'], sql_clause=(None, 'ORDER BY {0} DESC'.format(oid_field))) as rows:
+            max_oid = next(rows)[0]
+    step = max(int(math.ceil((max_oid - min_oid + 1) / chunks)), 1)
+    return [(low, low + step) for low in range(min_oid, max_oid + 1, step)]
+
+
+def get_oid_range_expression(dsc, expression, oid_range, oid_field=None):
+    """Add an ObjectID range [low, high) to a where clause.
+    :param oid_field: the delimited ObjectID field name (default is the OID field of dsc)
+    """
+    if oid_field is None:
+        oid_field = arcpy.AddFieldDelimiters(dsc.catalogPath, dsc.OIDFieldName)
+    range_expression = '{0} >= {1} AND {0} < {2}'.format(oid_field, oid_range[0], oid_range[1])
+    if expression:
+        return '({0}) AND {1}'.format(expression, range_expression)
+    return range_expression
+
+
+def get_chunks(tables, processes):
+    """Return (table, ObjectID range, send schema, weight) tasks, splitting tables larger than the job chunk size.
+    The weight is the share of the rows of all tables in the task.
+    """
+    counts = [int(arcpy.GetCount_management(tbl).getOutput(0)) for tbl in tables]
+    total = float(sum(counts)) or 1.
+    tasks = []
+    for tbl, count in zip(tables, counts):
+        dsc = arcpy.Describe(tbl)
+        if count > job.chunk_size and getattr(dsc, 'hasOID', False):
+            chunks = max(int(math.ceil(count / job.chunk_size)), processes)
+            oid_ranges = get_oid_ranges(dsc, count, chunks)
+            for i, oid_range in enumerate(oid_ranges):
+                tasks.append((tbl, oid_range, i == 0, count / len(oid_ranges) / total))
+        else:
+            tasks.append((tbl, None, True, count / total))
+    return tasks
+
+
+def index_chunk(task):
+    """Index a table or a chunk of a table (runs in a worker process)."""
+    tbl, oid_range, send_schema, weight = task
+    worker(tbl, oid_range=oid_range, send_schema=send_schema)
+    return tbl, weight, job.metrics.collect()
 
 
 def run_job(esri_job):
@@ -662,10 +943,13 @@ def run_job(esri_job):
     dsc = arcpy.Describe(job.path)
     # A single feature class or table.
     if dsc.dataType in ('DbaseTable', 'FeatureClass', 'ShapeFile', 'Shapefile', 'Table'):
-        global_job(job, int(arcpy.GetCount_management(job.path).getOutput(0)))
         job.tables_to_keep()  # This will populate field mapping.
-        worker(job.path)
-        return
+        if not job.multiprocess:
+            global_job(job, int(arcpy.GetCount_management(job.path).getOutput(0)))
+            worker(job.path)
+            return
+        # A large feature class or table is split into ObjectID ranges below.
+        tables = [job.path]
 
     # A folder (for shapefiles).
     elif dsc.dataType == 'Folder':
@@ -734,9 +1018,15 @@ def run_job(esri_job):
         multiprocessing.log_to_stderr()
         logger = multiprocessing.get_logger()
         logger.setLevel(logging.INFO)
-        pool = multiprocessing.Pool(initializer=global_job, initargs=(job,))
-        for i, _ in enumerate(pool.imap_unordered(worker, tables), 1):
-            status_writer.send_percent(i / len(tables), "{0:%}".format(i / len(tables)), 'esri_worker')
+        global_job(job)
+        processes = multiprocessing.cpu_count()
+        tasks = get_chunks(tables, processes)
+        pool = multiprocessing.Pool(processes, initializer=global_job, initargs=(job,))
+        progress = 0.
+        for tbl, weight, chunk_metrics in pool.imap_unordered(index_chunk, tasks):
+            job.metrics.merge(chunk_metrics)
+            progress = min(progress + weight, 1.)
+            status_writer.send_percent(progress, "{0} {1:%}".format(os.path.basename(tbl), progress), 'esri_worker')
         # Synchronize the main process with the job processes to ensure proper cleanup.
         pool.close()
         pool.join()
@@ -11,9 +11,24 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from __future__ import division
+import fnmatch
+import itertools
+import multiprocessing
 import base_job
 import ogr
 import gdalconst
+from utils import status
+from utils import worker_utils
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of features per Arrow record batch.
+ARROW_BATCH_SIZE = 10000
+
+status_writer = status.Writer()
 
 
 def global_job(args):
@@ -22,55 +37,177 @@ def global_job(args):
     job = args
 
 
+def get_layer_fields(job, ldef):
+    """Return the names and type names of the fields to index for a layer definition."""
+    fields_to_keep = [f.lower() for f in job.fields_to_keep]
+    fields_to_skip = [f.lower() for f in job.fields_to_skip or []]
+    fnames = []
+    ftypes = {}
+    for i in range(ldef.GetFieldCount()):
+        fdefn = ldef.GetFieldDefn(i)
+        fn = fdefn.GetName()
+        if not [f for f in fields_to_keep if fnmatch.fnmatch(fn.lower(), f)]:
+            continue
+        if [f for f in fields_to_skip if fnmatch.fnmatch(fn.lower(), f)]:
+            continue
+        fnames.append(fn)
+        ftypes[fn] = fdefn.GetFieldTypeName(fdefn.GetType())
+    return fnames, ftypes
+
+
+def ignore_fields(layer, ldef, fnames):
+    """Tell the driver not to read the fields that are not indexed."""
+    ignored = [ldef.GetFieldDefn(i).GetName() for i in range(ldef.GetFieldCount())]
+    ignored = [fn for fn in ignored if fn not in fnames]
+    ignored.append('OGR_STYLE')
+    layer.SetIgnoredFields(ignored)
+
+
+def get_geo(g):
+    """Return the geo information of an OGR geometry."""
+    geo = {}
+    if g is None:
+        return geo
+    if g.GetGeometryType() == ogr.wkbPoint:
+        geo['lon'] = g.GetX()
+        geo['lat'] = g.GetY()
+    else:
+        e = g.GetEnvelope()
+        geo['xmin'] = e[0]
+        geo['xmax'] = e[1]
+        geo['ymin'] = e[2]
+        geo['ymax'] = e[3]
+    return geo
+
+
+def get_geo_batch(wkbs):
+    """Return the geo information of a batch of WKB geometries.
+    Batches of 2D points are decoded with numpy in one step; other geometries are read with OGR.
+    """
+    if len(wkbs) and all(w is not None and len(w) == 21 for w in wkbs):
+        points = numpy.frombuffer(b''.join(bytes(w) for w in wkbs), dtype=numpy.uint8).reshape(-1, 21)
+        little_endian = points[:, 0] == 1
+        if little_endian.all() and (points[:, 1:5].view('<u4')[:, 0] == ogr.wkbPoint).all():
+            xy = points[:, 5:].copy().view('<f8')
+            return [{'lon': x, 'lat': y} for x, y in xy.tolist()]
+    return [get_geo(ogr.CreateGeometryFromWkb(bytes(w)) if w is not None else None) for w in wkbs]
+
+
+def get_spatial_keys(job, geos):
+    """Return the spatial key fields of a batch of geo information, or None if no keys are configured."""
+    if not job.spatial_keys_enabled:
+        return None
+    if geos and 'xmin' in geos[0]:
+        return job.spatial_keys_envelopes(*[[g.get(c) for g in geos] for c in ('xmin', 'ymin', 'xmax', 'ymax')])
+    return job.spatial_keys_batch([g.get('lon') for g in geos], [g.get('lat') for g in geos])
+
+
+def send_feature(job, ln, fid, geo, fields):
+    """Send an entry for a feature."""
+    entry = {}
+    entry['id'] = '{0}_{1}_{2}'.format(job.location_id, ln, fid)
+    entry['location'] = job.location_id
+    entry['action'] = job.action_type
+    entry['entry'] = {'geo': geo, 'fields': fields}
+    job.send_entry(entry)
+
+
+def index_features(job, layer, ln, fnames, mapped_names):
+    """Index each feature of a layer with the feature API."""
+    metrics = job.metrics
+    for f in metrics.timed('fetch', layer):
+        started = metrics.clock()
+        geo = get_geo(f.GetGeometryRef())
+        metrics.add('geometry', started)
+        started = metrics.clock()
+        fvalues = [f.GetField(fn) for fn in fnames]
+        metrics.add('map', started)
+        send_feature(job, ln, f.GetFID(), geo, dict(zip(mapped_names, fvalues)))
+
+
+def index_arrow_batches(job, layer, ln, fnames, mapped_names):
+    """Index the features of a layer from columnar Arrow record batches.
+    Columns with nulls are read as masked arrays so nulls are sent as None, not as 0 or NaN.
+    """
+    stream = layer.GetArrowStreamAsNumPy(options=['USE_MASKED_ARRAYS=YES',
+                                                  'MAX_FEATURES_IN_BATCH={0}'.format(ARROW_BATCH_SIZE)])
+    fid_column = layer.GetFIDColumn() or 'OGC_FID'
+    geometry_column = layer.GetGeometryColumn() or 'wkb_geometry'
+    metrics = job.metrics
+    for batch in metrics.timed('fetch', stream):
+        fids = batch[fid_column].tolist()
+        started = metrics.clock()
+        if geometry_column in batch:
+            geos = get_geo_batch(batch[geometry_column])
+        else:
+            geos = [{}] * len(fids)
+        keys = get_spatial_keys(job, geos) or itertools.repeat({})
+        metrics.add('geometry', started)
+        started = metrics.clock()
+        columns = [worker_utils.column_values(batch[fn]) for fn in fnames]
+        metrics.add('map', started)
+        for fid, geo, key, fvalues in zip(fids, geos, keys, zip(*columns) if columns else [()] * len(fids)):
+            fields = dict(zip(mapped_names, fvalues))
+            fields.update(key)
+            send_feature(job, ln, fid, geo, fields)
+
+
+def index_layer(job, l):
+    """Index the features of a layer, reading only the fields to keep."""
+    ldef = l.GetLayerDefn()
+    ln = ldef.GetName()
+    job.metrics.table(ln)
+    fnames, ftypes = get_layer_fields(job, ldef)
+    mapped_names = job.map_fields(ln, fnames, ftypes)
+    ignore_fields(l, ldef, fnames)
+
+    # Let drivers with spatial indexes and SQL backends skip the features outside the filters.
+    bbox = job.get_table_bbox(ln)
+    if bbox:
+        l.SetSpatialFilterRect(*bbox)
+    query = job.get_table_query(ln)
+    if query:
+        if not l.SetAttributeFilter(str(query)) == 0:
+            raise ValueError('Invalid attribute filter for {0}: {1}'.format(ln, query))
+    if numpy is not None and hasattr(l, 'GetArrowStreamAsNumPy'):
+        index_arrow_batches(job, l, ln, fnames, mapped_names)
+    else:
+        # GDAL versions before 3.6 have no Arrow stream interface.
+        index_features(job, l, ln, fnames, mapped_names)
+
+
+def layer_worker(ln):
+    """Index one layer of the datasource (runs in a worker process with its own connections)."""
+    if job.zmq_socket is None:
+        job.connect_to_zmq()
+    ds = ogr.Open(job.url, gdalconst.GA_ReadOnly)
+    index_layer(job, ds.GetLayerByName(ln))
+    return ln, job.metrics.collect()
+
+
 def worker():
     """Worker function to index each geometry in each feature in the datasource."""
-    job.connect_to_zmq()
     ds = ogr.Open(job.url, gdalconst.GA_ReadOnly)
-    # Layers
-    for l in ds:
-        # Fields
-        fnames = []
-        ldef = l.GetLayerDefn()
-
-        # Layer name
-        ln = ldef.GetName()
-
-        # process or skip this layer
-        cont = '*' in job.tables_to_keep or ln.lower() in [t.lower() for t in job.tables_to_keep]
-
-        if cont:
-            for i in range(ldef.GetFieldCount()):
-                fn = ldef.GetFieldDefn(i).GetName()
-                if '*' in job.fields_to_keep or fn.lower() in [f.lower() for f in job.fields_to_keep]:
-                    fnames.append(fn)
-
-            # Features
-            for f in l:
-                # Geometry
-                g = f.GetGeometryRef()
-                # Geomtry type
-                t = g.GetGeometryType()
-                geo = {}
-                if t == 1: # point
-                    geo['lon'] = g.GetX()
-                    geo['lat'] = g.GetY()
-                else:
-                    e = g.GetEnvelope()
-                    geo['xmin'] = e[0]
-                    geo['xmax'] = e[1]
-                    geo['ymin'] = e[2]
-                    geo['ymax'] = e[3]
-
-                fvalues = []
-                for i in fnames:
-                    fvalues.append(f.GetField(i))
-
-                entry = {}
-                entry['id'] = '{0}_{1}_{2}'.format(job.location_id, l.GetName(), f.GetFID())
-                entry['location'] = job.location_id
-                entry['action'] = job.action_type
-                entry['entry'] = {'geo': geo, 'fields': dict(zip(job.map_fields(ln, fnames), fvalues))}
-                job.send_entry(entry)
+    tables_to_keep = [t.lower() for t in job.tables_to_keep()] or ['*']
+    # Layers to process or skip
+    layer_names = [l.GetName() for l in ds if '*' in tables_to_keep or l.GetName().lower() in tables_to_keep]
+    processes = min(job.gdal_processes, len(layer_names))
+    if processes > 1:
+        ds = None
+        pool = multiprocessing.Pool(processes, initializer=global_job, initargs=(job,))
+        try:
+            for i, (ln, layer_metrics) in enumerate(pool.imap_unordered(layer_worker, layer_names), 1):
+                job.metrics.merge(layer_metrics)
+                status_writer.send_percent(i / len(layer_names), '{0} {1:%}'.format(ln, i / len(layer_names)), 'gdal_worker')
+        finally:
+            # Synchronize the main process with the job processes to ensure proper cleanup.
+            pool.close()
+            pool.join()
+    else:
+        job.connect_to_zmq()
+        for i, ln in enumerate(layer_names, 1):
+            index_layer(job, ds.GetLayerByName(ln))
+            status_writer.send_percent(i / len(layer_names), '{0} {1:%}'.format(ln, i / len(layer_names)), 'gdal_worker')
 
 
 def run_job(job_info):
@@ -78,3 +215,4 @@ def run_job(job_info):
     job = base_job.Job(job_info)
     global_job(job)
     worker()
+    job.metrics.summary()
@@ -11,10 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from __future__ import division
+import os
+import time
 import decimal
 import json
+import multiprocessing
 import base_job
 import gridfs
+import pymongo
+from bson import json_util
+from bson.objectid import ObjectId
 from utils import status
 from utils import worker_utils
 
@@ -48,136 +55,509 @@ def get_collections(job):
     return collection_names
 
 
-def run_job(mongodb_job):
-    """Worker function to index each document in each collection in the database."""
-    job = mongodb_job
-    job.connect_to_zmq()
-    job.connect_to_database()
-    collection_names = get_collections(job)
+def get_grid_fs(job, collection_name):
+    """Return the GridFS for a .files collection or None."""
+    if job.has_gridfs and collection_name.find('.files') > 0:
+        return gridfs.GridFS(job.db_connection, collection_name.split('.')[0])
+    return None
 
-    grid_fs = None
-    for collection_name in collection_names:
-        if job.has_gridfs:
-            if collection_name.find('.files') > 0:
-                grid_fs = gridfs.GridFS(job.db_connection, collection_name.split('.')[0])
 
-        col = job.db_connection[collection_name]
-        query = job.get_table_query(col)
-        if query:
-            documents = col.find(eval(query))
+def get_id_boundaries(job, col, splits):
+    """Return sorted _id values that split a collection into ranges of a similar size.
+    Uses the splitVector command, then $sample boundaries, then the min/max ObjectId time bounds.
+    :param job: the MongoDB job
+    :param col: the collection
+    :param splits: the number of ranges wanted
+    """
+    method = job.mongodb_split_method
+    boundaries = []
+    if method in ('auto', 'splitVector'):
+        try:
+            stats = job.db_connection.command('collstats', col.name)
+            chunk_size = max(int(stats['size'] / splits), 1024 * 1024)
+            result = job.db_connection.command('splitVector', col.full_name, keyPattern={'_id': 1}, maxChunkSizeBytes=chunk_size)
+            boundaries = [key['_id'] for key in result['splitKeys']]
+        except pymongo.errors.OperationFailure:
+            boundaries = []
+
+    if not boundaries and method in ('auto', 'sample'):
+        try:
+            sample = col.aggregate([{'$sample': {'size': splits * 100}}, {'$project': {'_id': 1}}])
+            if isinstance(sample, dict):
+                sample = sample['result']
+            ids = sorted(doc['_id'] for doc in sample)
+            if ids:
+                boundaries = [ids[len(ids) * k // splits] for k in range(1, splits)]
+        except pymongo.errors.OperationFailure:
+            boundaries = []
+
+    if not boundaries and method in ('auto', 'time'):
+        first = list(col.find({}, {'_id': 1}).sort('_id', pymongo.ASCENDING).limit(1))
+        last = list(col.find({}, {'_id': 1}).sort('_id', pymongo.DESCENDING).limit(1))
+        if first and last and isinstance(first[0]['_id'], ObjectId) and isinstance(last[0]['_id'], ObjectId):
+            start = first[0]['_id'].generation_time
+            step = (last[0]['_id'].generation_time - start) // splits
+            boundaries = [ObjectId.from_datetime(start + step * k) for k in range(1, splits)]
+
+    return sorted(set(boundaries))
+
+
+def get_id_ranges(boundaries):
+    """Return the _id range filters between boundaries (the first and last ranges are open)."""
+    bounds = [None] + boundaries + [None]
+    id_ranges = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        id_range = {}
+        if low is not None:
+            id_range['$gte'] = low
+        if high is not None:
+            id_range['$lt'] = high
+        if id_range:
+            id_ranges.append({'_id': id_range})
         else:
-            documents = col.find()
+            id_ranges.append({})
+    return id_ranges
+
+
+def get_projection(job, grid_fs=None):
+    """Return the MongoDB projection for the fields to keep and skip, or None to return whole documents.
+    Field names with wild cards cannot be pushed down and return whole documents.
+    """
+    fields_to_keep = job.fields_to_keep
+    fields_to_skip = job.fields_to_skip or []
+    if [f for f in fields_to_keep + fields_to_skip if '*' in f and not f == '*']:
+        return None
+    if not fields_to_keep == ['*']:
+        projection = dict((f, 1) for f in fields_to_keep if f not in fields_to_skip)
+        # The geometry and GridFS metadata are read separately from the other fields.
+        projection['loc'] = 1
+        if grid_fs:
+            projection['metadata'] = 1
+        return projection
+    elif fields_to_skip:
+        # An empty projection would return only the _id of each document.
+        return dict((f, 0) for f in fields_to_skip if not f in ('_id', 'loc')) or None
+    else:
+        return None
 
-        # Index each document -- get a suitable base 10 increment for reporting percentage.
+
+def get_documents(job, col, id_range=None, grid_fs=None):
+    """Return a cursor for the documents of a collection, limited to an _id range if given."""
+    query = job.get_table_query(col.name)
+    if query and id_range:
+        spec = {'$and': [eval(query), id_range]}
+    elif query:
+        spec = eval(query)
+    elif id_range:
+        spec = id_range
+    else:
+        spec = {}
+    documents = col.find(spec, get_projection(job, grid_fs))
+    if job.mongodb_batch_size:
+        documents = documents.batch_size(job.mongodb_batch_size)
+    return documents
+
+
+def get_document_count(job, col, documents):
+    """Return the number of documents to index. Without a query, the count is read from the collection stats."""
+    if not job.get_table_query(col.name):
         try:
-            increment = job.get_increment(documents.count())
+            return job.db_connection.command('collstats', col.name)['count']
+        except (pymongo.errors.OperationFailure, KeyError):
+            pass
+    return documents.count()
+
+
+def sample_field_types(job, col, grid_fs=None):
+    """Infer the field types of a collection from a random sample of its documents."""
+    if not job.schema_sample_size:
+        return {}
+    pipeline = []
+    query = job.get_table_query(col.name)
+    if query:
+        pipeline.append({'$match': eval(query)})
+    pipeline.append({'$sample': {'size': job.schema_sample_size}})
+    projection = get_projection(job, grid_fs)
+    if projection:
+        pipeline.append({'$project': projection})
+    sketch = worker_utils.FieldTypeSketch()
+    try:
+        for doc in col.aggregate(pipeline):
+            doc.pop('loc', None)
+            metadata = doc.pop('metadata', None) if grid_fs else None
+            sketch.add(doc)
+            if isinstance(metadata, dict):
+                sketch.add(metadata)
+    except pymongo.errors.OperationFailure:
+        # $sample requires MongoDB 3.2; types are then taken from the first document with each field.
+        return {}
+    return sketch.field_types
+
+
+def index_document(job, col, doc, geometry_ops, field_mapper, grid_fs=None):
+    """Index a document. Returns the geo information of the document."""
+    geo_json_converter = worker_utils.GeoJSONConverter()
+    metrics = job.metrics
+    started = metrics.clock()
+    entry = {}
+    geo = {}
+    if 'loc' in doc:
+        if 'type' in doc['loc']:
+            if 'bbox' in doc['loc']:
+                if job.include_wkt:
+                    wkt = geo_json_converter.convert_to_wkt(doc['loc'], 3)
+                    if job.generalize_value == 0:
+                        geo['wkt'] = wkt
+                    else:
+                        geo['wkt'] = geometry_ops.generalize_geometry(wkt, job.generalize_value)
+                geo['xmin'] = doc['loc']['bbox'][0]
+                geo['ymin'] = doc['loc']['bbox'][1]
+                geo['xmax'] = doc['loc']['bbox'][2]
+                geo['ymax'] = doc['loc']['bbox'][3]
+            elif 'Point' in doc['loc']['type']:
+                if job.include_wkt:
+                    geo['wkt'] = geo_json_converter.convert_to_wkt(doc['loc'], 3)
+                geo['lon'] = doc['loc']['coordinates'][0]
+                geo['lat'] = doc['loc']['coordinates'][1]
+            else:
+                status_writer.send_state(status.STAT_WARNING, 'No bbox information for {0}.'.format(doc['_id']))
+        elif isinstance(doc['loc'][0], float):
+            geo['lon'] = doc['loc'][0]
+            geo['lat'] = doc['loc'][1]
+        else:
+            geo['xmin'] = doc['loc'][0][0]
+            geo['xmax'] = doc['loc'][0][1]
+            geo['ymin'] = doc['loc'][1][0]
+            geo['ymax'] = doc['loc'][1][1]
+        doc.pop('loc')
+    metrics.add('geometry', started)
+    started = metrics.clock()
+    if grid_fs:
+        grid_out = grid_fs.get(doc['_id'])
+        if hasattr(grid_out, 'metadata'):
+            #TODO: Determine how to ingest files stored in the database.
+            #with open(r"c:\temp\{0}".format(grid_out.filename), "wb") as fp:
+                #fp.write(grid_out.read())
+            doc.pop('metadata', None)
+            mapped_fields = field_mapper.map(doc)
+            mapped_fields.update(field_mapper.map(grid_out.metadata))
+        else:
+            mapped_fields = field_mapper.map(doc)
+    else:
+        mapped_fields = field_mapper.map(doc)
+    metrics.add('map', started)
+    mapped_fields['_discoveryID'] = job.discovery_id
+    mapped_fields['title'] = col.name
+    mapped_fields['format_type'] = 'Record'
+    mapped_fields['format'] = 'application/vnd.mongodb.record'
+    entry['id'] = str(doc['_id'])
+    entry['location'] = job.location_id
+    entry['action'] = job.action_type
+    entry['entry'] = {'geo': geo, 'fields': mapped_fields}
+    job.send_entry(entry)
+    return geo
+
+
+def index_documents(job, col, documents, field_mapper, grid_fs=None, report=True):
+    """Index each document from a cursor.
+    Returns the number of documents, the field types of the collection and if documents have geo.
+    """
+    collection_name = col.name
+    has_geo = False
+
+    # Index each document -- get a suitable base 10 increment for reporting percentage.
+    if report:
+        row_count = float(get_document_count(job, col, documents))
+        try:
+            increment = job.get_increment(row_count)
         except ValueError:
             status_writer.send_status('No documents found in collection, {0}'.format(collection_name))
-            continue
-        geometry_ops = worker_utils.GeometryOps()
-        generalize_value = job.generalize_value
-        for i, doc in enumerate(documents):
-            fields = doc.keys()
-            field_types = dict((k, type(v)) for k, v in doc.iteritems())
-            if grid_fs:
-                grid_out = grid_fs.get(doc['_id'])
-                if hasattr(grid_out, 'metadata'):
-                    #TODO: Determine how to ingest files stored in the database.
-                    #with open(r"c:\temp\{0}".format(grid_out.filename), "wb") as fp:
-                        #fp.write(grid_out.read())
-                    fields += grid_out.metadata.keys()
-                    field_types = dict(field_types.items() + dict((k, type(v)) for k, v in grid_out.metadata.iteritems()).items())
-                    values = [doc[k] for k in doc.keys() if not k == 'metadata']
-                    values += grid_out.metadata.values()
-                    fields.remove('metadata')
-            else:
-                values = doc.values()
-            entry = {}
-            geo = {}
-            geo_json_converter = worker_utils.GeoJSONConverter()
-            if 'loc' in doc:
-                if 'type' in doc['loc']:
-                    if 'bbox' in doc['loc']:
-                        if job.include_wkt:
-                            wkt = geo_json_converter.convert_to_wkt(doc['loc'], 3)
-                            if generalize_value == 0:
-                                geo['wkt'] = wkt
-                            else:
-                                geo['wkt'] = geometry_ops.generalize_geometry(wkt, generalize_value)
-                        geo['xmin'] = doc['loc']['bbox'][0]
-                        geo['ymin'] = doc['loc']['bbox'][1]
-                        geo['xmax'] = doc['loc']['bbox'][2]
-                        geo['ymax'] = doc['loc']['bbox'][3]
-                    elif 'Point' in doc['loc']['type']:
-                        if job.include_wkt:
-                            geo['wkt'] = geo_json_converter.convert_to_wkt(doc['loc'], 3)
-                        geo['lon'] = doc['loc']['coordinates'][0]
-                        geo['lat'] = doc['loc']['coordinates'][1]
-                    else:
-                        status_writer.send_state(status.STAT_WARNING, 'No bbox information for {0}.'.format(doc['_id']))
-                elif isinstance(doc['loc'][0], float):
-                    geo['lon'] = doc['loc'][0]
-                    geo['lat'] = doc['loc'][1]
-                else:
-                    geo['xmin'] = doc['loc'][0][0]
-                    geo['xmax'] = doc['loc'][0][1]
-                    geo['ymin'] = doc['loc'][1][0]
-                    geo['ymax'] = doc['loc'][1][1]
-                fields.remove('loc')
-                doc.pop('loc')
-                values = doc.values()
-            mapped_fields = job.map_fields(col.name, fields, field_types)
-            mapped_fields = dict(zip(mapped_fields, values))
-            mapped_fields['_discoveryID'] = job.discovery_id
-            mapped_fields['title'] = col.name
-            mapped_fields['format_type'] = 'Record'
-            mapped_fields['format'] = 'application/vnd.mongodb.record'
-            entry['id'] = str(doc['_id'])
-            entry['location'] = job.location_id
-            entry['action'] = job.action_type
-            entry['entry'] = {'geo': geo, 'fields': mapped_fields}
-            job.send_entry(entry)
-            if (i % increment) == 0:
-                status_writer.send_percent(float(i) / documents.count(),
-                                           '{0}: {1:%}'.format(collection_name, float(i)/documents.count()),
-                                           'MongoDB')
-
-        schema = {}
-        schema['name'] = col.full_name
-        schema['name'] = collection_name
-        schema['rows'] = documents.count()
-        schema_columns = []
-        index_info = col.index_information()
-        indexes = []
-        for v in index_info.values():
-            indexes.append(v['key'][0][0])
-        for n, t in dict(zip(fields, field_types.values())).items():
-            column = {}
-            props = []
-            column['name'] = n
-            column['type'] = t
-            if n in indexes:
-                props.append('INDEXED')
-            if 'ObjectId' in str(t) or n == '_id':
-                props.append('NOTNULLABLE')
-                props.append('PRIMARY KEY')
+            return 0, field_mapper.field_types, has_geo
+    geometry_ops = worker_utils.GeometryOps()
+    i = -1
+    for i, doc in enumerate(job.metrics.timed('fetch', documents)):
+        if index_document(job, col, doc, geometry_ops, field_mapper, grid_fs):
+            has_geo = True
+        if report and (i % increment) == 0:
+            status_writer.send_percent(i / row_count, '{0}: {1:%}'.format(collection_name, i / row_count), 'MongoDB')
+    return i + 1, field_mapper.field_types, has_geo
+
+
+def init_process(job_file):
+    """Create a job with its own client and ZMQ socket in each worker process."""
+    global job
+    job = base_job.Job(job_file)
+    # Load the table queries and field mapping of the location.
+    job.tables_to_keep()
+    job.connect_to_zmq()
+    job.connect_to_database()
+
+
+def index_range(args):
+    """Index the documents of one _id range of a collection (runs in a worker process)."""
+    collection_name, id_range, field_types = args
+    job.metrics.table(collection_name)
+    col = job.db_connection[collection_name]
+    grid_fs = get_grid_fs(job, collection_name)
+    documents = get_documents(job, col, id_range, grid_fs)
+    field_mapper = base_job.FieldMapper(job, collection_name, field_types)
+    count, field_types, has_geo = index_documents(job, col, documents, field_mapper, grid_fs, report=False)
+    return count, field_types, has_geo, job.metrics.collect()
+
+
+def index_collection_ranges(mongodb_job, col, field_types):
+    """Split a collection into _id ranges and index them concurrently in worker processes."""
+    processes = mongodb_job.mongodb_processes
+    row_count = float(get_document_count(mongodb_job, col, get_documents(mongodb_job, col)))
+    if not row_count:
+        status_writer.send_status('No documents found in collection, {0}'.format(col.name))
+        return 0, {}, False
+
+    # Use more ranges than processes so a slow range does not hold up the collection.
+    boundaries = get_id_boundaries(mongodb_job, col, processes * 4)
+    id_ranges = get_id_ranges(boundaries)
+    status_writer.send_status('Indexing {0} in {1} ranges...'.format(col.name, len(id_ranges)))
+
+    processed = 0
+    field_types = dict(field_types)
+    has_geo = False
+    pool = multiprocessing.Pool(processes, initializer=init_process, initargs=(mongodb_job.job_file,))
+    try:
+        for count, range_field_types, range_has_geo, range_metrics in pool.imap_unordered(index_range, [(col.name, r, field_types) for r in id_ranges]):
+            processed += count
+            mongodb_job.metrics.merge(range_metrics)
+            for name, field_type in range_field_types.items():
+                field_types.setdefault(name, field_type)
+            has_geo = has_geo or range_has_geo
+            status_writer.send_percent(processed / row_count, '{0}: {1:%}'.format(col.name, processed / row_count), 'MongoDB')
+    finally:
+        # Synchronize the main process with the job processes to ensure proper cleanup.
+        pool.close()
+        pool.join()
+    return processed, field_types, has_geo
+
+
+def send_schema(job, col, row_count, field_types, has_geo):
+    """Send an entry for the collection itself with its schema."""
+    collection_name = col.name
+    schema = {}
+    schema['name'] = col.full_name
+    schema['name'] = collection_name
+    schema['rows'] = row_count
+    schema_columns = []
+    index_info = col.index_information()
+    indexes = []
+    for v in index_info.values():
+        indexes.append(v['key'][0][0])
+    for n, t in field_types.items():
+        column = {}
+        props = []
+        column['name'] = n
+        column['type'] = t
+        if n in indexes:
+            props.append('INDEXED')
+        if 'ObjectId' in str(t) or n == '_id':
+            props.append('NOTNULLABLE')
+            props.append('PRIMARY KEY')
+        else:
+            props.append('NULLABLE')
+        column['properties'] = props
+        schema_columns.append(column)
+    if has_geo:
+        props = []
+        if 'loc' in indexes:
+            props.append('INDEXED')
+        schema_columns.append({'name': 'loc', 'isGeo': True, 'properties': props})
+    schema['fields'] = schema_columns
+
+    # Add an entry for the table itself with schema.
+    table_entry = {}
+    table_entry['id'] = '{0}_{1}'.format(job.location_id, collection_name)
+    table_entry['location'] = job.location_id
+    table_entry['action'] = job.action_type
+    table_entry['format_type'] = 'Schema'
+    table_entry['entry'] = {'fields': {'_discoveryID': job.discovery_id, 'name': collection_name, 'path': job.mongodb_client_info}}
+    table_entry['entry']['fields']['schema'] = schema
+    job.send_entry(table_entry)
+
+
+def index_collection(job, col):
+    """Index all the documents of a collection and send its schema entry. Returns the field types of the collection."""
+    job.metrics.table(col.name)
+    grid_fs = get_grid_fs(job, col.name)
+    field_types = sample_field_types(job, col, grid_fs)
+    if job.mongodb_processes > 1:
+        row_count, field_types, has_geo = index_collection_ranges(job, col, field_types)
+    else:
+        documents = get_documents(job, col, grid_fs=grid_fs)
+        field_mapper = base_job.FieldMapper(job, col.name, field_types)
+        row_count, field_types, has_geo = index_documents(job, col, documents, field_mapper, grid_fs)
+    if row_count:
+        send_schema(job, col, row_count, field_types, has_geo)
+    return field_types
+
+
+def load_state(job):
+    """Return the saved change positions (resume tokens or oplog timestamps) by collection."""
+    try:
+        with open(job.mongodb_state_file, 'r') as fp:
+            return json_util.loads(fp.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(job, state):
+    """Save the change positions so the next run continues where this one stopped."""
+    temp_file = '{0}.tmp'.format(job.mongodb_state_file)
+    with open(temp_file, 'w') as fp:
+        fp.write(json_util.dumps(state))
+    if os.path.exists(job.mongodb_state_file):
+        os.remove(job.mongodb_state_file)
+    os.rename(temp_file, job.mongodb_state_file)
+
+
+class ChangeStreamReader(object):
+    """Reads the inserts, updates and deletes of a collection from a change stream."""
+    def __init__(self, col, state=None):
+        self._col = col
+        self._pending = None
+        if state:
+            self._stream = col.watch(full_document='updateLookup', resume_after=state['resume_token'], max_await_time_ms=1000)
+            self.state = {'resume_token': self._stream.resume_token}
+        else:
+            self._stream = col.watch(full_document='updateLookup', max_await_time_ms=1000)
+            # The first read sets the resume token. A change it returns is kept for the first changes() call,
+            # and the position saved before it is read (when the server already gave one).
+            resume_token = self._stream.resume_token
+            self._pending = self._stream.try_next()
+            if self._pending is None or resume_token is None:
+                resume_token = self._stream.resume_token
+            self.state = {'resume_token': resume_token}
+
+    def changes(self):
+        """Yield (action, _id, document) for each change currently available."""
+        pending, self._pending = self._pending, None
+        while pending is not None or self._stream.alive:
+            if pending is not None:
+                change, pending = pending, None
             else:
-                props.append('NULLABLE')
-            column['properties'] = props
-            schema_columns.append(column)
-        if geo:
-            props = []
-            if 'loc' in indexes:
-                props.append('INDEXED')
-            schema_columns.append({'name': 'loc', 'isGeo': True, 'properties': props})
-        schema['fields'] = schema_columns
-
-        # Add an entry for the table itself with schema.
-        table_entry = {}
-        table_entry['id'] = '{0}_{1}'.format(job.location_id, collection_name)
-        table_entry['location'] = job.location_id
-        table_entry['action'] = job.action_type
-        table_entry['format_type'] = 'Schema'
-        table_entry['entry'] = {'fields': {'_discoveryID': job.discovery_id, 'name': collection_name, 'path': job.mongodb_client_info}}
-        table_entry['entry']['fields']['schema'] = schema
-        job.send_entry(table_entry)
+                change = self._stream.try_next()
+                self.state = {'resume_token': self._stream.resume_token}
+            if change is None:
+                return
+            operation = change['operationType']
+            if operation in ('insert', 'update', 'replace'):
+                yield 'ADD', change['documentKey']['_id'], change.get('fullDocument')
+            elif operation == 'delete':
+                yield 'DELETE', change['documentKey']['_id'], None
+            elif operation in ('drop', 'rename', 'invalidate'):
+                status_writer.send_state(status.STAT_WARNING, 'Stopped reading changes of {0} ({1}).'.format(self._col.name, operation))
+                return
+
+    def close(self):
+        self._stream.close()
+
+
+class OplogReader(object):
+    """Reads the inserts, updates and deletes of a collection by tailing the replica set oplog."""
+    def __init__(self, col, state=None):
+        self._col = col
+        self._oplog = col.database.client.local['oplog.rs']
+        if state:
+            self.state = {'oplog_ts': state['oplog_ts']}
+        else:
+            last = list(self._oplog.find({}, {'ts': 1}).sort('$natural', pymongo.DESCENDING).limit(1))
+            self.state = {'oplog_ts': last[0]['ts']}
+        self._cursor = None
+
+    def changes(self):
+        """Yield (action, _id, document) for each change currently available."""
+        if self._cursor is None or not self._cursor.alive:
+            self._cursor = self._oplog.find({'ns': self._col.full_name, 'ts': {'$gt': self.state['oplog_ts']}},
+                                            cursor_type=pymongo.CursorType.TAILABLE_AWAIT, oplog_replay=True)
+        for op in self._cursor:
+            self.state = {'oplog_ts': op['ts']}
+            if op['op'] == 'i':
+                yield 'ADD', op['o']['_id'], op['o']
+            elif op['op'] == 'u':
+                yield 'ADD', op['o2']['_id'], self._col.find_one({'_id': op['o2']['_id']})
+            elif op['op'] == 'd':
+                yield 'DELETE', op['o']['_id'], None
+
+    def close(self):
+        if self._cursor:
+            self._cursor.close()
+
+
+def get_change_reader(col, state=None):
+    """Return a change stream reader or an oplog reader when change streams are not supported."""
+    if state and 'oplog_ts' in state:
+        return OplogReader(col, state)
+    try:
+        return ChangeStreamReader(col, state)
+    except (pymongo.errors.OperationFailure, AttributeError):
+        return OplogReader(col, state)
+
+
+def index_changes(job, collection_names):
+    """Index the changes of each collection since the last run (and keep following them in follow mode).
+    Collections without a saved position are fully loaded first.
+    """
+    state = load_state(job)
+    readers = []
+    for collection_name in collection_names:
+        col = job.db_connection[collection_name]
+        try:
+            # Without a saved position, take it before the full load so no change made during the load is missed.
+            reader = get_change_reader(col, state.get(collection_name))
+        except (pymongo.errors.OperationFailure, IndexError) as ex:
+            status_writer.send_state(status.STAT_WARNING, 'Cannot read the changes of {0}: {1}'.format(collection_name, ex))
+            index_collection(job, col)
+            continue
+        grid_fs = get_grid_fs(job, collection_name)
+        if collection_name not in state:
+            field_types = index_collection(job, col)
+            state[collection_name] = reader.state
+            save_state(job, state)
+        else:
+            field_types = sample_field_types(job, col, grid_fs)
+        field_mapper = base_job.FieldMapper(job, collection_name, field_types)
+        readers.append((col, reader, field_mapper, grid_fs))
+
+    geometry_ops = worker_utils.GeometryOps()
+    try:
+        while readers:
+            processed = 0
+            for col, reader, field_mapper, grid_fs in readers:
+                for action, _id, doc in reader.changes():
+                    if action == 'DELETE':
+                        job.send_entry({'id': str(_id), 'location': job.location_id, 'action': 'DELETE'})
+                    elif doc:
+                        index_document(job, col, doc, geometry_ops, field_mapper, grid_fs)
+                    processed += 1
+                state[col.name] = reader.state
+            save_state(job, state)
+            if processed:
+                status_writer.send_status('Indexed {0} changes.'.format(processed))
+            if not job.mongodb_follow:
+                break
+            if not processed:
+                time.sleep(1)
+    finally:
+        for col, reader, field_mapper, grid_fs in readers:
+            reader.close()
+
+
+def run_job(mongodb_job):
+    """Worker function to index each document in each collection in the database."""
+    job = mongodb_job
+    job.connect_to_zmq()
+    job.connect_to_database()
+    collection_names = get_collections(job)
+
+    if job.mongodb_incremental:
+        index_changes(job, collection_names)
+        return
+
+    for collection_name in collection_names:
+        index_collection(job, job.db_connection[collection_name])
@@ -57,8 +57,10 @@ def run_job(mysql_job):
     job.connect_to_zmq()
     job.connect_to_database()
     tables = get_tables(job)
+    metrics = job.metrics
     processed = 0
     for table in tables:
+        metrics.table(table)
         geo = {}
         is_point = False
         has_shape = False
@@ -159,10 +161,12 @@ def run_job(mysql_job):
         # ------------------------------
         # Query the table for the rows.
         # ------------------------------
+        started = metrics.clock()
         if not expression:
             rows = job.db_cursor.execute("select {0} from {1}".format(','.join(columns), table))
         else:
             rows = job.db_cursor.execute("select {0} from {1} where {2}".format(','.join(columns), table, expression))
+        metrics.add('query', started)
 
         # --------------------------------------
         # Remove shape columns from field list.
@@ -198,7 +202,8 @@ def run_job(mysql_job):
         table_entry['entry']['fields']['schema'] = schema
         job.send_entry(table_entry)
 
-        for i, row in enumerate(rows):
+        for i, row in enumerate(metrics.timed('fetch', rows)):
+            started = metrics.clock()
             if has_shape:
                 if is_point:
                     if job.include_wkt:
@@ -231,12 +236,14 @@ def run_job(mysql_job):
                         mapped_cols['geometry_type'] = 'Polygon'
                     else:
                         mapped_cols['geometry_type'] = 'Polyline'
+                metrics.add('geometry', started)
             else:
                 mapped_cols = dict(zip(mapped_fields, row))
                 for nf in new_fields:
                         if nf['name'] == '*' or nf['name'] == table:
                             for k, v in nf['new_fields'].iteritems():
                                 mapped_fields[k] = v
+                metrics.add('map', started)
 
             # Create an entry to send to ZMQ for indexing.
             mapped_cols['title'] = table
@@ -169,6 +169,32 @@ def get_views(job):
     return views
 
 
+def get_sdo_srid(job, srid):
+    """Return the EPSG code of an Oracle (SDO_GEOMETRY) spatial reference ID."""
+    if srid is None:
+        return None
+    try:
+        epsg = job.db_cursor.execute("select sdo_cs.map_oracle_srid_to_epsg({0}) from dual".format(int(srid))).fetchone()
+        if epsg and epsg[0]:
+            return int(epsg[0])
+    except Exception:
+        pass
+    return srid
+
+
+def get_st_srid(job, schema, srid):
+    """Return the EPSG code of an ST_GEOMETRY spatial reference ID."""
+    try:
+        auth_srid = job.db_cursor.execute("select auth_srid from {0}.st_spatial_references where srid = {1}".format(schema, srid)).fetchone()
+        if auth_srid and auth_srid[0]:
+            return int(auth_srid[0])
+    except Exception:
+        pass
+    if srid == 3:
+        return 4326
+    return srid
+
+
 def run_job(oracle_job):
     """Worker function to do the indexing."""
     job = oracle_job
@@ -186,13 +212,16 @@ def run_job(oracle_job):
         return
 
     # Begin indexing.
+    metrics = job.metrics
     for tbl in set(all_tables):
+        metrics.table(tbl)
         geo = {}
         columns = []
         column_types = {}
         is_point = False
         has_shape = False
         geometry_field = None
+        geometry_type = None
         shape_type = None
 
         # ----------------------------------------------------------------------------
@@ -322,42 +351,56 @@ def run_job(oracle_job):
             else:
                 schema = job.db_cursor.execute("select {0} from {1}".format(geometry_field, tbl)).fetchone()[0].type.schema
 
-            # Figure out if geometry type is ST or SDO.
+            # Figure out if geometry type is ST or SDO. Coordinates are read in the native
+            # spatial reference and reprojected client-side (see CoordinateTransformer).
+            # Spatial references OSR does not know are still reprojected by the database.
+            # Geometry columns are: [wkt, x, y] for points and [wkt, xmin, ymin, xmax, ymax] otherwise.
             if geometry_type == 'SDO_GEOMETRY':
-                geo['code'] = job.db_cursor.execute("select c.{0}.SDO_SRID from {1} c".format(geometry_field, tbl)).fetchone()[0]
+                geo['code'] = get_sdo_srid(job, job.db_cursor.execute("select c.{0}.SDO_SRID from {1} c".format(geometry_field, tbl)).fetchone()[0])
+                server_transform = not worker_utils.CoordinateTransformer.supported(geo['code'])
                 # dimension = job.db_cursor.execute("select c.shape.Get_Dims() from {0} c".format(tbl)).fetchone()[0]
                 if not job.db_cursor.execute("select c.{0}.SDO_POINT from {1} c".format(geometry_field, tbl)).fetchone()[0] is None:
                     is_point = True
-                    if geo['code'] == 4326:
-                        columns.insert(0, '{0}.{1}.SDO_POINT.Y'.format(schema, geometry_field))
-                        columns.insert(0, '{0}.{1}.SDO_POINT.X'.format(schema, geometry_field))
+                    if server_transform:
+                        shape = 'sdo_cs.transform({0}, 4326)'.format(geometry_field)
+                        for x in ('sdo_geom.sdo_min_mbr_ordinate({0}, 2)', 'sdo_geom.sdo_min_mbr_ordinate({0}, 1)',
+                                  'sdo_util.to_wktgeometry({0})'):
+                            columns.insert(0, x.format(shape))
                     else:
-                        job.db_cursor.execute("SDO_CS.TRANSFORM({0}.{1}, 4326)".format(schema, geometry_field))
+                        for x in ('SDO_POINT.Y', 'SDO_POINT.X', 'GET_WKT()'):
+                            columns.insert(0, '{0}.{1}.{2}'.format(schema, geometry_field, x))
                 else:
-                    columns.insert(0, "sdo_geom.sdo_mbr({0}).sdo_ordinates".format(geometry_field))
+                    if server_transform:
+                        shape = 'sdo_cs.transform({0}, 4326)'.format(geometry_field)
+                    else:
+                        shape = '{0}.{1}'.format(schema, geometry_field)
+                    for x in ('max_mbr_ordinate({0}, 2)', 'max_mbr_ordinate({0}, 1)',
+                              'min_mbr_ordinate({0}, 2)', 'min_mbr_ordinate({0}, 1)'):
+                        columns.insert(0, 'sdo_geom.sdo_{0}'.format(x.format(shape)))
+                    if server_transform:
+                        columns.insert(0, 'sdo_util.to_wktgeometry({0})'.format(shape))
+                    else:
+                        columns.insert(0, '{0}.GET_WKT()'.format(shape))
             else:  # ST_GEOMETRY
                 shape_type = job.db_cursor.execute("select {0}.ST_GEOMETRYTYPE({1}) from {2}".format(schema, geometry_field, tbl)).fetchone()[0]
-                geo['code'] = int(job.db_cursor.execute("select {0}.ST_SRID({1}) from {2}".format(schema, geometry_field, tbl)).fetchone()[0])
+                srid = int(job.db_cursor.execute("select {0}.ST_SRID({1}) from {2}".format(schema, geometry_field, tbl)).fetchone()[0])
+                geo['code'] = get_st_srid(job, schema, srid)
+                server_transform = not worker_utils.CoordinateTransformer.supported(geo['code'])
+                if server_transform:
+                    shape = '{0}.st_transform({1}, 4326)'.format(schema, geometry_field)
+                else:
+                    shape = geometry_field
                 if 'POINT' in shape_type:
                     is_point = True
-                    if geo['code'] == 4326 or geo['code'] == 3:
-                        for x in ('y', 'x', 'astext'):
-                            columns.insert(0, '{0}.st_{1}({2})'.format(schema, x, geometry_field))
-                    else:
-                        for x in ('y', 'x', 'astext'):
-                            columns.insert(0, '{0}.st_{1}({0}.st_transform({2}, 4326))'.format(schema, x, geometry_field))
+                    for x in ('y', 'x', 'astext'):
+                        columns.insert(0, '{0}.st_{1}({2})'.format(schema, x, shape))
                 else:
-                    if geo['code'] == 4326:
-                        for x in ('maxy', 'maxx', 'miny', 'minx', 'astext'):
-                            columns.insert(0, '{0}.st_{1}({2})'.format(schema, x, geometry_field))
-                    else:
-                        try:
-                            job.db_cursor.execute("select {0}.st_maxy(SDE.st_transform({1}, 4326)) from {2}".format(schema, geometry_field, tbl))
-                            for x in ('maxy', 'maxx', 'miny', 'minx', 'astext'):
-                                columns.insert(0, '{0}.st_{1}({0}.st_transform({2}, 4326))'.format(schema, x, geometry_field))
-                        except Exception:
-                            for x in ('maxy', 'maxx', 'miny', 'minx', 'astext'):
-                                columns.insert(0, '{0}.st_{1}({2})'.format(schema, x, geometry_field))
+                    for x in ('maxy', 'maxx', 'miny', 'minx', 'astext'):
+                        columns.insert(0, '{0}.st_{1}({2})'.format(schema, x, shape))
+            if server_transform:
+                status_writer.send_state(status.STAT_WARNING, 'Spatial reference {0} of {1} cannot be reprojected '
+                                                              'client-side; the database reprojects it.'.format(geo['code'], tbl))
+                geo['code'] = 4326
 
         # -------------------------------------------------
         # Drop astext from columns if WKT is not requested.
@@ -381,6 +424,7 @@ def run_job(oracle_job):
         # ---------------------------
         # Get the rows to be indexed.
         # ---------------------------
+        started = metrics.clock()
         try:
             if geometry_type == 'SDO_GEOMETRY':
                 rows = job.db_cursor.execute("select {0} from {1} {2}".format(','.join(columns), tbl, schema))
@@ -400,6 +444,7 @@ def run_job(oracle_job):
                 rows = job.db_cursor.execute("select {0} from {1} where {2}".format(','.join(columns), tbl, query))
             else:
                 rows = job.db_cursor.execute("select {0} from {1}".format(','.join(columns), tbl))
+        metrics.add('query', started)
 
         # Continue if the table has zero records.
         if not rows:
@@ -428,12 +473,14 @@ def run_job(oracle_job):
         job.send_entry(table_entry)
 
         if not has_shape:
-            for i, row in enumerate(rows):
+            for i, row in enumerate(metrics.timed('fetch', rows)):
                 try:
                     # Map column names to Voyager fields.
+                    started = metrics.clock()
                     mapped_cols = dict(izip(mapped_fields, row))
                     if has_shape:
                         [mapped_cols.pop(name) for name in geom_fields]
+                    metrics.add('map', started)
                     mapped_cols['_discoveryID'] = discovery_id
                     mapped_cols['meta_table_name'] = tbl
                     mapped_cols['format_type'] = 'Record'
@@ -452,59 +499,85 @@ def run_job(oracle_job):
             geom_fields = [name for name in mapped_fields if '{0}'.format(geometry_field) in name]
             geometry_ops = worker_utils.GeometryOps()
             generalize_value = job.generalize_value
-            for i, row in enumerate(rows):
-                try:
-                    # if include_wkt:
+            spatial_keys = job.spatial_keys_enabled
+            transformer = worker_utils.CoordinateTransformer.get(geo['code'])
+            if transformer:
+                geo['code'] = 4326
+            i = -1
+            for batch in metrics.timed('fetch', worker_utils.fetch_batches(rows, job.db_cursor.arraysize)):
+                # Reproject the coordinates of the whole fetch batch at once.
+                if transformer:
+                    started = metrics.clock()
                     if is_point:
-                        geo['lon'] = row[1]
-                        geo['lat'] = row[2]
-                    else:
-                        if generalize_value == 0 or generalize_value == 0.0:
-                            geo['wkt'] = row[0]
-                        elif generalize_value > 0.9:
-                            geo['xmin'] = row[1]
-                            geo['ymin'] = row[2]
-                            geo['xmax'] = row[3]
-                            geo['ymax'] = row[4]
+                        lons, lats = transformer.transform([r[1] for r in batch], [r[2] for r in batch])
+                    elif generalize_value > 0.9:
+                        xmins, ymins, xmaxs, ymaxs = transformer.transform_envelopes(*[[r[c] for r in batch] for c in (1, 2, 3, 4)])
+                    metrics.add('geometry', started)
+                # Compute the spatial keys of the whole fetch batch at once.
+                keys = None
+                if spatial_keys:
+                    started = metrics.clock()
+                    if is_point:
+                        if transformer:
+                            keys = job.spatial_keys_batch(lons, lats)
                         else:
-                            geo['wkt'] = geometry_ops.generalize_geometry(str(row[0]), generalize_value)
-
-                # else:
-                #     if is_point:
-                #         geo['lon'] = row[0]
-                #         geo['lat'] = row[1]
-                #     else:
-                #         if geometry_type == 'SDO_GEOMETRY':
-                #             if dimension == 3:
-                #                 geo['xmin'] = row[0][0]
-                #                 geo['ymin'] = row[0][1]
-                #                 geo['xmax'] = row[0][3]
-                #                 geo['ymax'] = row[0][4]
-                #             elif dimension == 2:
-                #                 geo['xmin'] = row[0][0]
-                #                 geo['ymin'] = row[0][1]
-                #                 geo['xmax'] = row[0][2]
-                #                 geo['ymax'] = row[0][3]
-                #         else:
-                #             geo['xmin'] = row[0]
-                #             geo['ymin'] = row[1]
-                #             geo['xmax'] = row[2]
-                #             geo['ymax'] = row[3]
-
-                    # Map column names to Voyager fields.
-                    mapped_cols = dict(izip(mapped_fields, row))
-                    [mapped_cols.pop(name) for name in geom_fields]
-                    mapped_cols['_discoveryID'] = discovery_id
-                    mapped_cols['meta_table_name'] = tbl
-                    mapped_cols['format_type'] = 'Record'
-                    mapped_cols['format'] = 'application/vnd.oracle.record'
-                    entry['id'] = '{0}_{1}_{2}'.format(location_id, tbl, i)
-                    entry['location'] = location_id
-                    entry['action'] = action_type
-                    entry['entry'] = {'geo': geo, 'fields': mapped_cols}
-                    job.send_entry(entry)
-                    if (i % increment) == 0:
-                        status_writer.send_percent(i / row_count, "{0}: {1:%}".format(tbl, i / row_count), 'oracle_worker')
-                except Exception as ex:
-                    status_writer.send_status(ex)
-                    continue
+                            keys = job.spatial_keys_batch([r[1] for r in batch], [r[2] for r in batch])
+                    elif generalize_value > 0.9:
+                        if transformer:
+                            keys = job.spatial_keys_envelopes(xmins, ymins, xmaxs, ymaxs)
+                        else:
+                            keys = job.spatial_keys_envelopes(*[[r[c] for r in batch] for c in (1, 2, 3, 4)])
+                    metrics.add('geometry', started)
+                for k, row in enumerate(batch):
+                    i += 1
+                    try:
+                        started = metrics.clock()
+                        if is_point:
+                            if transformer:
+                                geo['lon'] = lons[k]
+                                geo['lat'] = lats[k]
+                            else:
+                                geo['lon'] = row[1]
+                                geo['lat'] = row[2]
+                        else:
+                            if generalize_value == 0 or generalize_value == 0.0:
+                                if transformer:
+                                    geo['wkt'] = transformer.transform_wkt(row[0])
+                                else:
+                                    geo['wkt'] = row[0]
+                            elif generalize_value > 0.9:
+                                if transformer:
+                                    geo['xmin'], geo['ymin'], geo['xmax'], geo['ymax'] = xmins[k], ymins[k], xmaxs[k], ymaxs[k]
+                                else:
+                                    geo['xmin'] = row[1]
+                                    geo['ymin'] = row[2]
+                                    geo['xmax'] = row[3]
+                                    geo['ymax'] = row[4]
+                            else:
+                                if transformer:
+                                    geo['wkt'] = geometry_ops.generalize_geometry(transformer.transform_wkt(row[0]), generalize_value)
+                                else:
+                                    geo['wkt'] = geometry_ops.generalize_geometry(str(row[0]), generalize_value)
+                        metrics.add('geometry', started)
+
+                        # Map column names to Voyager fields.
+                        started = metrics.clock()
+                        mapped_cols = dict(izip(mapped_fields, row))
+                        [mapped_cols.pop(name) for name in geom_fields]
+                        if keys:
+                            mapped_cols.update(keys[k])
+                        metrics.add('map', started)
+                        mapped_cols['_discoveryID'] = discovery_id
+                        mapped_cols['meta_table_name'] = tbl
+                        mapped_cols['format_type'] = 'Record'
+                        mapped_cols['format'] = 'application/vnd.oracle.record'
+                        entry['id'] = '{0}_{1}_{2}'.format(location_id, tbl, i)
+                        entry['location'] = location_id
+                        entry['action'] = action_type
+                        entry['entry'] = {'geo': geo, 'fields': mapped_cols}
+                        job.send_entry(entry)
+                        if (i % increment) == 0:
+                            status_writer.send_percent(i / row_count, "{0}: {1:%}".format(tbl, i / row_count), 'oracle_worker')
+                    except Exception as ex:
+                        status_writer.send_status(ex)
+                        continue
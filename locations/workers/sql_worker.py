@@ -57,8 +57,10 @@ def run_job(job):
     job.connect_to_zmq()
     job.connect_to_database()
     tables = get_tables(job)
+    metrics = job.metrics
 
     for tbl in set(tables):
+        metrics.table(tbl)
         geo = {}
         has_shape = False
         is_point = False
@@ -185,6 +187,7 @@ def run_job(job):
         # -----------------------------
         # Query the table for the rows.
         # -----------------------------
+        started = metrics.clock()
         sql_query = job.get_table_query(tbl)
         if not sql_query:
             row_count = float(job.db_cursor.execute("select Count(*) from {0}".format(tbl)).fetchone()[0])
@@ -196,45 +199,92 @@ def run_job(job):
             except Exception:
                 row_count = float(job.db_cursor.execute("select Count(*) {0}".format(q.split('ORDER BY')[0])).fetchone()[0])
             rows = job.execute_query("select {0} {1}".format(','.join(columns + related_columns), q))
+        metrics.add('query', started)
 
-        # -----------------------------------------------------------------------------
-        # Index each row in the table. If there are relates, index the related records.
-        # -----------------------------------------------------------------------------
-        cur_id = -1
-        entry = {}
-        link = {}
-        wkt_col = -1
-        action_type = job.action_type
-        discovery_id = job.discovery_id
-        location_id = job.location_id
-        columns = [c.split('.')[1] for c in columns]
-        mapped_fields = job.map_fields(tbl, columns, column_types)
-        increment = job.get_increment(row_count)
-        if 'WKT' in columns:
-            has_shape = True
-            try:
-                wkt_col = mapped_fields.index('fs_WKT')
-            except ValueError:
-                wkt_col = mapped_fields.index('WKT')
-        geometry_ops = worker_utils.GeometryOps()
-        generalize_value = job.generalize_value
-
+        # Coordinates are in the native SRID of the table, reproject them client-side.
+        transformer = None
+        if shape_field_name:
+            transformer = worker_utils.CoordinateTransformer.get(geo['code'])
+            if transformer:
+                geo['code'] = 4326
+            elif not worker_utils.CoordinateTransformer.supported(geo['code']):
+                status_writer.send_state(status.STAT_WARNING, 'Spatial reference {0} of {1} cannot be reprojected; '
+                                                              'coordinates are sent in the native spatial reference.'.format(geo['code'], tbl))
 
         # -----------------------------------------------
         # Add an entry for the table itself with schema.
         # -----------------------------------------------
-        mapped_cols = {}
         schema['rows'] = row_count
         table_entry = {}
-        table_entry['id'] = '{0}_{1}'.format(location_id, tbl)
-        table_entry['location'] = location_id
-        table_entry['action'] = action_type
+        table_entry['id'] = '{0}_{1}'.format(job.location_id, tbl)
+        table_entry['location'] = job.location_id
+        table_entry['action'] = job.action_type
         table_entry['format_type'] = 'Schema'
-        table_entry['entry'] = {'fields': {'_discoveryID': discovery_id, 'name': tbl, 'path': job.sql_server_connection_str, 'format_type': 'Schema'}}
+        table_entry['entry'] = {'fields': {'_discoveryID': job.discovery_id, 'name': tbl, 'path': job.sql_server_connection_str, 'format_type': 'Schema'}}
         table_entry['entry']['fields']['schema'] = schema
         job.send_entry(table_entry)
 
-        for i, row in enumerate(rows):
+        # -----------------------------------------------------------------------------
+        # Index each row in the table. If there are relates, index the related records.
+        # -----------------------------------------------------------------------------
+        columns = [c.split('.')[1] for c in columns]
+        mapped_fields = job.map_fields(tbl, columns, column_types)
+        index_rows(job, tbl, rows, columns, mapped_fields, row_count, geo, has_shape, is_point, geom_type, transformer)
+
+
+def index_rows(job, tbl, rows, columns, mapped_fields, row_count, geo, has_shape=False, is_point=False,
+               geom_type='', transformer=None):
+    """Index the rows of a table read from a DB-API cursor. If there are relates, index the related records.
+    The geometry is read from the first columns: Y and X of points, or the WKT and envelope of other geometry types.
+    Coordinates are reprojected with the transformer, if given.
+    """
+    metrics = job.metrics
+    cur_id = -1
+    entry = {}
+    link = {}
+    mapped_cols = {}
+    wkt_col = -1
+    action_type = job.action_type
+    discovery_id = job.discovery_id
+    location_id = job.location_id
+    increment = job.get_increment(row_count)
+    if 'WKT' in columns:
+        has_shape = True
+        try:
+            wkt_col = mapped_fields.index('fs_WKT')
+        except ValueError:
+            wkt_col = mapped_fields.index('WKT')
+    geometry_ops = worker_utils.GeometryOps()
+    generalize_value = job.generalize_value
+    spatial_keys = job.spatial_keys_enabled
+
+    i = -1
+    for batch in metrics.timed('fetch', worker_utils.fetch_batches(rows)):
+        # Reproject the coordinates of the whole fetch batch at once.
+        if transformer:
+            started = metrics.clock()
+            if is_point:
+                lons, lats = transformer.transform([r[1] for r in batch], [r[0] for r in batch])
+            elif wkt_col < 0 and generalize_value > 0.9:
+                xmins, ymins, xmaxs, ymaxs = transformer.transform_envelopes(*[[r[c] for r in batch] for c in (1, 2, 3, 4)])
+            metrics.add('geometry', started)
+        # Compute the spatial keys of the whole fetch batch at once.
+        keys = None
+        if spatial_keys and has_shape:
+            started = metrics.clock()
+            if is_point:
+                if transformer:
+                    keys = job.spatial_keys_batch(lons, lats)
+                else:
+                    keys = job.spatial_keys_batch([r[1] for r in batch], [r[0] for r in batch])
+            elif wkt_col < 0 and generalize_value > 0.9:
+                if transformer:
+                    keys = job.spatial_keys_envelopes(xmins, ymins, xmaxs, ymaxs)
+                else:
+                    keys = job.spatial_keys_envelopes(*[[r[c] for r in batch] for c in (1, 2, 3, 4)])
+            metrics.add('geometry', started)
+        for k, row in enumerate(batch):
+            i += 1
             if not cur_id == row[0] or not job.related_tables:
                 if entry:
                     try:
@@ -243,34 +293,43 @@ def run_job(job):
                         entry = {}
                         continue
                     entry = {}
+                started = metrics.clock()
                 if has_shape:
                     if is_point:
-                        geo['lon'] = row[1]
-                        geo['lat'] = row[0]
+                        if transformer:
+                            geo['lon'] = lons[k]
+                            geo['lat'] = lats[k]
+                        else:
+                            geo['lon'] = row[1]
+                            geo['lat'] = row[0]
                         mapped_cols = dict(zip(mapped_fields[2:], row[2:]))
                         mapped_cols['geometry_type'] = 'Point'
                     else:
+                        if wkt_col >= 0:
+                            wkt = row[wkt_col]
+                        else:
+                            wkt = row[0]
+                        if transformer and not (wkt_col < 0 and generalize_value > 0.9):
+                            wkt = transformer.transform_wkt(wkt)
                         if generalize_value == 0 or generalize_value == 0.0:
+                            geo['wkt'] = wkt
                             if wkt_col >= 0:
-                                geo['wkt'] = row[wkt_col]
                                 mapped_cols = dict(zip(mapped_fields, row))
-                            else:
-                                geo['wkt'] = row[0]
                         elif generalize_value > 0.9:
                             if wkt_col >= 0:
-                                geo['wkt'] = row[wkt_col]
+                                geo['wkt'] = wkt
                                 mapped_cols = dict(zip(mapped_fields, row))
+                            elif transformer:
+                                geo['xmin'], geo['ymin'], geo['xmax'], geo['ymax'] = xmins[k], ymins[k], xmaxs[k], ymaxs[k]
                             else:
                                 geo['xmin'] = row[1]
                                 geo['ymin'] = row[2]
                                 geo['xmax'] = row[3]
                                 geo['ymax'] = row[4]
                         else:
+                            geo['wkt'] = geometry_ops.generalize_geometry(str(wkt), generalize_value)
                             if wkt_col >= 0:
-                                geo['wkt'] = geometry_ops.generalize_geometry(str(row[wkt_col]), generalize_value)
                                 mapped_cols = dict(zip(mapped_fields, row))
-                            else:
-                                geo['wkt'] = geometry_ops.generalize_geometry(str(row[0]), generalize_value)
                         if not mapped_cols:
                             mapped_cols = dict(zip(mapped_fields[5:], row[5:]))
                         if 'Polygon' in geom_type:
@@ -279,10 +338,14 @@ def run_job(job):
                             mapped_cols['geometry_type'] = 'Polyline'
                         else:
                             mapped_cols['geometry_type'] = 'Point'
+                    metrics.add('geometry', started)
                 else:
                     mapped_cols = dict(zip(mapped_fields, row))
+                    metrics.add('map', started)
 
                 # Create an entry to send to ZMQ for indexing.
+                if keys:
+                    mapped_cols.update(keys[k])
                 mapped_cols['format_type'] = 'Record'
                 mapped_cols['format'] = 'application/vnd.sqlserver.record'
                 if 'id' in mapped_cols:
@@ -352,6 +415,6 @@ def run_job(job):
             if (i % increment) == 0:
                 status_writer.send_percent(i / row_count, '{0}: {1:%}'.format(tbl, i / row_count), 'sql_server')
 
-        # Send final entry.
-        job.send_entry(entry)
-        status_writer.send_percent(1, '{0}: {1:%}'.format(tbl, 1), 'sql_server')
+    # Send final entry.
+    job.send_entry(entry)
+    status_writer.send_percent(1, '{0}: {1:%}'.format(tbl, 1), 'sql_server')
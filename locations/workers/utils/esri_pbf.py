@@ -0,0 +1,257 @@
+# (C) Copyright 2014 Voyager Search
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decoder for ArcGIS REST query results in the protocol buffer format (f=pbf).
+Results are returned in the same shape as the JSON format (features with attributes and geometry).
+"""
+import struct
+
+GEOMETRY_TYPES = {0: 'esriGeometryPoint',
+                  1: 'esriGeometryMultipoint',
+                  2: 'esriGeometryPolyline',
+                  3: 'esriGeometryPolygon',
+                  4: 'esriGeometryMultiPatch',
+                  127: None}
+
+FIELD_TYPES = {0: 'esriFieldTypeSmallInteger',
+               1: 'esriFieldTypeInteger',
+               2: 'esriFieldTypeSingle',
+               3: 'esriFieldTypeDouble',
+               4: 'esriFieldTypeString',
+               5: 'esriFieldTypeDate',
+               6: 'esriFieldTypeOID',
+               7: 'esriFieldTypeGeometry',
+               8: 'esriFieldTypeBlob',
+               9: 'esriFieldTypeRaster',
+               10: 'esriFieldTypeGUID',
+               11: 'esriFieldTypeGlobalID',
+               12: 'esriFieldTypeXML'}
+
+UPPER_LEFT = 0
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _varint(buf, pos):
+    """Read a varint and return it with the next position."""
+    result = 0
+    shift = 0
+    while True:
+        try:
+            b = buf[pos]
+        except IndexError:
+            raise DecodeError('Truncated varint.')
+        result |= (b & 0x7f) << shift
+        pos += 1
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _messages(buf, start=0, end=None):
+    """Yield (field number, wire type, value) for each field of a message.
+    Length delimited values are returned as (start, end) positions in the buffer.
+    """
+    pos = start
+    end = len(buf) if end is None else end
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise DecodeError('Unsupported wire type {0}.'.format(wire_type))
+        yield number, wire_type, value
+    if pos > end:
+        raise DecodeError('Truncated message.')
+
+
+def _packed_varints(buf, span, wire_type, value):
+    """Return the varints of a packed (or single unpacked) repeated field."""
+    if not wire_type == 2:
+        return [value]
+    values = []
+    pos, end = span
+    while pos < end:
+        v, pos = _varint(buf, pos)
+        values.append(v)
+    return values
+
+
+def _string(buf, span):
+    return bytes(buf[span[0]:span[1]]).decode('utf-8')
+
+
+def _double(data):
+    return struct.unpack('<d', bytes(data))[0]
+
+
+def _float(data):
+    return struct.unpack('<f', bytes(data))[0]
+
+
+def _value(buf, span):
+    """Decode a Value message."""
+    for number, wire_type, value in _messages(buf, *span):
+        if number == 1:
+            return _string(buf, value)
+        elif number == 2:
+            return _float(value)
+        elif number == 3:
+            return _double(value)
+        elif number in (4, 8):
+            return _zigzag(value)
+        elif number in (5, 7):
+            return value
+        elif number == 6:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        elif number == 9:
+            return bool(value)
+    return None
+
+
+def _transform(buf, span):
+    """Decode a Transform message to (origin, x scale, y scale, x translate, y translate)."""
+    origin, scale, translate = UPPER_LEFT, (1.0, 1.0), (0.0, 0.0)
+    for number, wire_type, value in _messages(buf, *span):
+        if number == 1:
+            origin = value
+        elif number in (2, 3):
+            xy = {}
+            for n, w, v in _messages(buf, *value):
+                if n in (1, 2):
+                    xy[n] = _double(v)
+            pair = (xy.get(1, 1.0 if number == 2 else 0.0), xy.get(2, 1.0 if number == 2 else 0.0))
+            if number == 2:
+                scale = pair
+            else:
+                translate = pair
+    return origin, scale[0], scale[1], translate[0], translate[1]
+
+
+def _geometry(buf, span, geometry_type, transform, dimensions):
+    """Decode a Geometry message to the JSON geometry of its type."""
+    lengths = []
+    coords = []
+    for number, wire_type, value in _messages(buf, *span):
+        if number == 2:
+            lengths += _packed_varints(buf, value, wire_type, value)
+        elif number == 3:
+            coords += [_zigzag(v) for v in _packed_varints(buf, value, wire_type, value)]
+    origin, x_scale, y_scale, x_translate, y_translate = transform
+
+    # Coordinates are quantized and delta encoded over the whole geometry.
+    points = []
+    x = y = 0
+    for i in range(0, len(coords) - dimensions + 1, dimensions):
+        x += coords[i]
+        y += coords[i + 1]
+        if origin == UPPER_LEFT:
+            points.append([x * x_scale + x_translate, y_translate - y * y_scale])
+        else:
+            points.append([x * x_scale + x_translate, y * y_scale + y_translate])
+    if not points:
+        return None
+    if geometry_type == 'esriGeometryPoint':
+        return {'x': points[0][0], 'y': points[0][1]}
+    elif geometry_type == 'esriGeometryMultipoint':
+        return {'points': points}
+    parts = []
+    start = 0
+    for length in lengths or [len(points)]:
+        parts.append(points[start:start + length])
+        start += length
+    if geometry_type == 'esriGeometryPolygon':
+        return {'rings': parts}
+    else:
+        return {'paths': parts}
+
+
+def decode_feature_collection(data):
+    """Decode a FeatureCollectionPBuffer into a dictionary shaped like the JSON query result."""
+    buf = bytearray(data)
+    result = None
+    for number, wire_type, value in _messages(buf):
+        if number == 2:
+            for n, w, v in _messages(buf, *value):
+                if n == 1:
+                    result = v
+    if result is None:
+        raise DecodeError('No feature result.')
+
+    rows = {'fields': [], 'features': []}
+    geometry_type = None
+    transform = (UPPER_LEFT, 1.0, 1.0, 0.0, 0.0)
+    has_z = has_m = False
+    features = []
+    for number, wire_type, value in _messages(buf, *result):
+        if number == 1:
+            rows['objectIdFieldName'] = _string(buf, value)
+        elif number == 7:
+            geometry_type = GEOMETRY_TYPES.get(value)
+        elif number == 8:
+            for n, w, v in _messages(buf, *value):
+                if n == 1:
+                    rows['spatialReference'] = {'wkid': v}
+        elif number == 9:
+            rows['exceededTransferLimit'] = bool(value)
+        elif number == 10:
+            has_z = bool(value)
+        elif number == 11:
+            has_m = bool(value)
+        elif number == 12:
+            transform = _transform(buf, value)
+        elif number == 13:
+            field = {}
+            for n, w, v in _messages(buf, *value):
+                if n == 1:
+                    field['name'] = _string(buf, v)
+                elif n == 2:
+                    field['type'] = FIELD_TYPES.get(v)
+                elif n == 3:
+                    field['alias'] = _string(buf, v)
+            rows['fields'].append(field)
+        elif number == 15:
+            features.append(value)
+    if geometry_type:
+        rows['geometryType'] = geometry_type
+
+    names = [f['name'] for f in rows['fields']]
+    dimensions = 2 + has_z + has_m
+    for span in features:
+        values = []
+        feature = {}
+        for n, w, v in _messages(buf, *span):
+            if n == 1:
+                values.append(_value(buf, v))
+            elif n == 2 and geometry_type:
+                feature['geometry'] = _geometry(buf, v, geometry_type, transform, dimensions)
+        feature['attributes'] = dict(zip(names, values))
+        rows['features'].append(feature)
+    return rows
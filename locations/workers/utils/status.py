@@ -14,6 +14,8 @@
 # limitations under the License.
 from __future__ import unicode_literals
 import sys
+import json
+import threading
 
 
 S_SEP = ">>"
@@ -28,6 +30,7 @@ S_KEY_VPID = "V"
 S_KEY_JOBID = "J"
 S_KEY_TIMEOUT = "S"
 S_KEY_STATE = "X"
+S_KEY_METRICS = "R"
 
 STAT_SUCCESS = "SUCCESS"
 STAT_FAILED = "FAILED"
@@ -35,36 +38,39 @@ STAT_IDLE = "IDLE"
 STAT_STOPPING = "STOPPING"
 STAT_WARNING = "WARNING"
 
+# Set by a resident runner to tag every status line with the job it belongs to.
+job_id = None
+
 
 class Writer(object):
     """Writer object with functions to report task status."""
     def __init__(self):
         """Initialize Writer call."""
         self._io = sys.stdout
+        self._local = threading.local()
 
     def __w(self, msg):
         """Write to wrapped output thing. """
         self._io.write(msg)
         self._io.flush()
 
-    def __fl(self):
-        """Send newline and flush wrapped output thing."""
-        self._io.write("\n")
-        self._io.flush()
-
     def __send(self, key, val):
-        """Write a key value pair to output thing. """
+        """Add a key value pair to the status line being written. """
         if val:
-            self.__w("{0}{1}={2}".format(S_SEP, key, val))
+            self._local.parts.append("{0}{1}={2}".format(S_SEP, key, val))
 
     def format_output(func):
-        """Decorator used to wrap the output with markers. """
+        """Decorator used to wrap the output with markers.
+        The status line is written at once so lines from concurrent threads and jobs are not interleaved.
+        """
         def inner(*args, **kwargs):
             inst = args[0]
-            inst.__w(S_FLAG)
+            inst._local.parts = [S_FLAG]
+            if job_id is not None and not func.__name__ == 'job_started':
+                inst.__send(S_KEY_JOBID, job_id)
             func(*args, **kwargs)
-            inst.__w(S_FLAG)
-            inst.__fl()
+            inst._local.parts.append(S_FLAG + "\n")
+            inst.__w("".join(inst._local.parts))
         return inner
 
     @format_output
@@ -98,3 +104,8 @@ class Writer(object):
         self.__send(S_KEY_STATE, statev)
         if msg:
             self.__send(S_KEY_MSG, msg)
+
+    @format_output
+    def send_metrics(self, name, metrics):
+        self.__send(S_KEY_NAME, name)
+        self.__send(S_KEY_METRICS, json.dumps(metrics, sort_keys=True))
@@ -13,25 +13,79 @@
 # limitations under the License.
 import math
 import json
+import importlib
+import collections
 import sys
 import itertools
 import urllib
 import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 from os.path import join, dirname, abspath
 import glob
+import esri_pbf
 
-# Import ogr module.
-dll_path = abspath(join(dirname(dirname(dirname(dirname(__file__)))), '..', 'arch', 'win32_x86'))
-if os.environ['PATH'].endswith(';'):
-    os.environ['PATH'] += dll_path
-else:
-    os.environ['PATH'] += os.pathsep + dll_path
-egg_path = join(dll_path, 'py')
-sys.path.append(egg_path)
-libs = glob.glob(join(egg_path, 'GDAL*.egg'))
-for lib in libs:
-    sys.path.append(lib)
-import ogr
+# OGR and OSR are imported by load_gdal() when geometry code first needs them.
+ogr = None
+osr = None
+# NumPy is imported when keys are first computed for a batch; False if it is not installed.
+numpy = None
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+MAX_GEOHASH_PRECISION = 12
+MAX_TILE_ZOOM = 24
+MAX_MERCATOR_LAT = 85.0511287798
+GEOGRAPHIC_SRIDS = (4326, 8307)
+
+
+class LazyModule(object):
+    """A module that is imported the first time one of its attributes is used."""
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def load_gdal():
+    """Import the OGR and OSR modules, adding the bundled GDAL libraries to the path the first time."""
+    global ogr, osr
+    if ogr is not None:
+        return
+    dll_path = abspath(join(dirname(dirname(dirname(dirname(__file__)))), '..', 'arch', 'win32_x86'))
+    if os.environ['PATH'].endswith(';'):
+        os.environ['PATH'] += dll_path
+    else:
+        os.environ['PATH'] += os.pathsep + dll_path
+    egg_path = join(dll_path, 'py')
+    sys.path.append(egg_path)
+    libs = glob.glob(join(egg_path, 'GDAL*.egg'))
+    for lib in libs:
+        sys.path.append(lib)
+    import osr
+    import ogr
+
+
+def load_numpy():
+    """Return the NumPy module, or None if it is not installed."""
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+# Process-wide ArcGIS tokens by (portal url, instance, user name): (token, expires in epoch seconds, lifetime in seconds).
+_tokens = {}
+_tokens_lock = threading.Lock()
+# Fraction of a token's lifetime left when it is refreshed.
+TOKEN_REFRESH_FRACTION = 0.2
 
 
 class InvalidToken(Exception):
@@ -40,7 +94,8 @@ class InvalidToken(Exception):
 
 class ArcGISServiceHelper(object):
     """ArcGIS Server and Portal helper class."""
-    def __init__(self, portal_url, username, password, referer='', token_expiration=60, instance=''):
+    def __init__(self, portal_url, username, password, referer='', token_expiration=60, instance='',
+                 concurrency=4, retries=3, backoff=0.5, max_requests=0):
         self._username = username
         self._password = password
         self._portal_url = portal_url
@@ -55,11 +110,97 @@ class ArcGISServiceHelper(object):
             self._http = "{0}/arcgis/rest/services".format(self._portal_url)
         else:
             self._http = "{0}/{1}/rest/services".format(self._portal_url, self._instance)
-        self.oid_field_name = 'objectid'
-        self.token = self._generate_token()
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        # Keep-alive connections shared by the concurrent queries.
+        import requests
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, max_requests, 1))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # Caps the requests in flight across every layer queried with this helper.
+        self._request_slots = threading.BoundedSemaphore(max_requests) if max_requests else None
+        self._layer_info = {}
+        self._token_key = (portal_url, instance, username)
+        self._static_token = None
+        self._generate_token()
+
+    @property
+    def token(self):
+        """The token given to find_item_url, else the cached generated token (refreshed before it expires)."""
+        if self._static_token:
+            return self._static_token
+        return self._generate_token()
 
-    def _generate_token(self):
-        """Generates a token required for ArcGIS Online authentication."""
+    @token.setter
+    def token(self, value):
+        # A generated token stays managed by the cache.
+        cached = _tokens.get(self._token_key)
+        if not cached or not value == cached[0]:
+            self._static_token = value
+
+    def _query(self, url, query, pbf=False):
+        """POST a query over the session and return the JSON (or decoded f=pbf) response.
+        Connection errors, timeouts and server errors are retried with exponential backoff.
+        """
+        import requests
+        attempt = 0
+        renewed = False
+        while True:
+            if 'token' in query and not self._static_token:
+                # Long running queries always use the current token.
+                query['token'] = self.token
+            try:
+                if self._request_slots:
+                    with self._request_slots:
+                        response = self._session.post(url, data=query, timeout=300)
+                else:
+                    response = self._session.post(url, data=query, timeout=300)
+                if pbf and response.status_code == 200 and 'json' not in response.headers.get('Content-Type', ''):
+                    return esri_pbf.decode_feature_collection(response.content)
+                if response.status_code < 500 and not response.status_code == 429:
+                    data = response.json()
+                    if 'error' in data and data['error'].get('code') in (498, 499) and not renewed and not self._static_token:
+                        # The token was invalidated on the server before it expired.
+                        self._generate_token(refresh=True)
+                        renewed = True
+                        continue
+                    if not ('error' in data and data['error'].get('code') in (429, 500, 502, 503, 504)):
+                        return data
+                    error = data['error'].get('message', data['error'])
+                else:
+                    error = 'HTTP {0}'.format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = ex
+            if attempt >= self.retries:
+                raise IOError('Query to {0} failed: {1}'.format(url, error))
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _generate_token(self, refresh=False):
+        """Returns a token required for ArcGIS Online authentication.
+        Tokens are shared by every helper of the process for the same portal and user and are
+        generated again when less than TOKEN_REFRESH_FRACTION of their lifetime is left.
+        """
+        if not self._username:
+            return None
+        with _tokens_lock:
+            cached = _tokens.get(self._token_key)
+            if cached and not refresh:
+                token, expires, lifetime = cached
+                if expires - time.time() > lifetime * TOKEN_REFRESH_FRACTION:
+                    return token
+            token = self._request_token()
+            if token:
+                _tokens[self._token_key] = token
+                return token[0]
+            # Do not ask again for a minute after a failure.
+            _tokens[self._token_key] = (token, time.time() + 60, 60)
+            return token
+
+    def _request_token(self):
+        """Requests a new token. Returns (token, expires, lifetime), or None or '' on failure."""
         try:
             query_dict = {'username': self._username,
                           'password': self._password,
@@ -72,7 +213,12 @@ class ArcGISServiceHelper(object):
 
             if "token" not in token:
                return None
-            return token['token']
+            now = time.time()
+            if 'expires' in token:
+                expires = token['expires'] / 1000.
+            else:
+                expires = now + self._token_expiration * 60
+            return token['token'], expires, max(expires - now, 1)
         except ValueError:
             return ''
 
@@ -131,11 +277,45 @@ class ArcGISServiceHelper(object):
         return service_url, items
 
 
-    def get_item_row_count(self, url, layer_id, token):
-        """Returns the row count of a service layer or table.
+    def get_layer_info(self, url, layer_id, token):
+        """Return the metadata of a service layer or table (fields, maxRecordCount, capabilities).
+        :param url: service url
+        :param layer_id: service layer/table ID
+        :param token: token value
+        """
+        key = (url, layer_id)
+        if key not in self._layer_info:
+            if self.token:
+                query = {'token': token, 'f': 'json'}
+            else:
+                query = {'f': 'json'}
+            info = self._query('{0}/{1}'.format(url, layer_id), query)
+            if 'error' in info:
+                if info['error']['message'] == "Invalid Token":
+                    raise InvalidToken(info['error']['message'])
+                else:
+                    raise Exception(info['error']['message'])
+            self._layer_info[key] = info
+        return self._layer_info[key]
+
+    def get_item_count(self, url, layer_id, token):
+        """Returns the row count of a service layer or table without fetching the object ids.
+        :param url: service url
+        :param layer_id: service layer/table ID
+        :param token: token value
+        """
+        if self.token:
+            query = {'where': '1=1', 'returnCountOnly': True, 'token': token, 'f': 'json'}
+        else:
+            query = {'where': '1=1', 'returnCountOnly': True, 'f': 'json'}
+        return self._query('{0}/{1}/query'.format(url, layer_id), query)['count']
+
+    def get_item_row_count(self, url, layer_id, token, group_size=100):
+        """Returns the object id groups, row count and object id field name of a service layer or table.
         :param url: Service url
         :param layer_id: service layer/table ID
         :param token: token value
+        :param group_size: number of object ids per group
         """
         if self.token:
             query = {'where': '1=1', 'returnIdsOnly':True, 'token': token, 'f': 'json'}
@@ -144,12 +324,12 @@ class ArcGISServiceHelper(object):
         response = urllib.urlopen('{0}/{1}/query?'.format(url, layer_id), urllib.urlencode(query))
         data = json.loads(response.read())
         objectids = data['objectIds']
-        self.oid_field_name = data['objectIdFieldName']
+        oid_field_name = data['objectIdFieldName']
         if not objectids:
-            return None, None
-        args = [iter(objectids)] * 100
+            return None, None, oid_field_name
+        args = [iter(objectids)] * group_size
         id_groups = itertools.izip_longest(fillvalue=None, *args)
-        return id_groups, len(objectids)
+        return id_groups, len(objectids), oid_field_name
 
     def get_item_fields(self, url, layer_id, token):
         """Return the fields of a service layer or table.
@@ -157,17 +337,20 @@ class ArcGISServiceHelper(object):
         :param layer_id: service layer/table ID
         :param token: token value
         """
+        info = self.get_layer_info(url, layer_id, token)
+        if info.get('fields'):
+            return info['fields']
         if self.token:
-            query = {'where': '1=1', 'outFields': '*', 'returnGeometry':False, 'token': token, 'f': 'json'}
+            query = {'where': '1=1', 'outFields': '*', 'returnGeometry':False, 'resultRecordCount': 1, 'token': token, 'f': 'json'}
         else:
-            query = {'where': '1=1', 'outFields': '*', 'returnGeometry':False, 'f': 'json'}
+            query = {'where': '1=1', 'outFields': '*', 'returnGeometry':False, 'resultRecordCount': 1, 'f': 'json'}
         response = urllib.urlopen('{0}/{1}/query?'.format(url, layer_id), urllib.urlencode(query))
         data = json.loads(response.read())
         fields = data['fields']
         return fields
 
     def get_item_rows(self, url, layer_id, token, spatial_rel='esriSpatialRelIntersects',
-                 where='1=1', out_fields='*', out_sr=4326, return_geometry=True):
+                 where='1=1', out_fields='*', out_sr=4326, return_geometry=True, pbf=False, **params):
         """Return the rows for a service layer or table.
         :param url: service url
         :param layer_id: service layer/table ID
@@ -177,14 +360,390 @@ class ArcGISServiceHelper(object):
         :param out_fields: output fields (default is *)
         :param out_sr: output spatial reference WKID
         :param return_geometry: boolean to return geometry
+        :param pbf: request the protocol buffer format (falls back to JSON if it cannot be decoded)
+        :param params: other query parameters (i.e. resultOffset)
         """
         if self.token:
             query = {'spatialRel': spatial_rel, 'where': where, 'outFields': out_fields, 'returnGeometry': return_geometry, 'outSR': out_sr, 'token': token, 'f': 'json'}
         else:
             query = {'spatialRel': spatial_rel, 'where': where, 'outFields': out_fields, 'returnGeometry': return_geometry, 'outSR': out_sr, 'f': 'json'}
-        response = urllib.urlopen('{0}/{1}/query?'.format(url, layer_id), urllib.urlencode(query))
-        data = json.loads(response.read())
-        return data
+        query.update(params)
+        if pbf:
+            try:
+                rows = self._query('{0}/{1}/query'.format(url, layer_id), dict(query, f='pbf'), pbf=True)
+                if 'error' not in rows:
+                    return rows
+            except esri_pbf.DecodeError:
+                pass
+        return self._query('{0}/{1}/query'.format(url, layer_id), query)
+
+    def get_item_row_batches(self, url, layer_id, token, **kwargs):
+        """Return the row count of a service layer or table and an iterator of its row batches.
+        Layers supporting pagination are paged with resultOffset in pages of maxRecordCount;
+        other layers are queried by groups of object ids. Rows are requested as f=pbf when supported.
+        :param url: service url
+        :param layer_id: service layer/table ID
+        :param token: token value
+        :param kwargs: other get_item_rows parameters
+        """
+        info = self.get_layer_info(url, layer_id, token)
+        max_records = info.get('maxRecordCount') or 1000
+        kwargs.setdefault('pbf', 'pbf' in info.get('supportedQueryFormats', '').lower())
+        oid_field_name = info.get('objectIdField')
+        if not oid_field_name:
+            oid_fields = [f['name'] for f in info.get('fields') or [] if f['type'] == 'esriFieldTypeOID']
+            oid_field_name = oid_fields[0] if oid_fields else None
+        if oid_field_name and info.get('advancedQueryCapabilities', {}).get('supportsPagination'):
+            row_count = self.get_item_count(url, layer_id, token)
+            pages = [{'resultOffset': offset, 'resultRecordCount': max_records, 'orderByFields': oid_field_name}
+                     for offset in xrange(0, row_count, max_records)]
+            return row_count, self._imap(lambda page: self.get_item_rows(url, layer_id, token, **dict(kwargs, **page)), pages)
+        id_groups, row_count, oid_field_name = self.get_item_row_count(url, layer_id, token, group_size=min(max_records, 1000))
+        if not row_count:
+            return row_count, iter([])
+        return row_count, (rows for group, rows in self.get_item_row_groups(url, layer_id, token, id_groups, oid_field_name, **kwargs))
+
+    def _imap(self, func, items):
+        """Yield func(item) for each item, computed concurrently up to the helper's concurrency, in item order."""
+        if self.concurrency <= 1:
+            for item in items:
+                yield func(item)
+            return
+        pool = ThreadPool(self.concurrency)
+        pending = collections.deque()
+        try:
+            # Results are yielded in item order so progress is reported as if the items were queried one by one.
+            # At most twice the concurrency is outstanding, so rows are not buffered faster than they are consumed.
+            for item in items:
+                pending.append(pool.apply_async(func, (item,)))
+                if len(pending) >= 2 * self.concurrency:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def get_item_row_groups(self, url, layer_id, token, id_groups, oid_field_name, **kwargs):
+        """Yield (object ids, rows) for each group of object ids, in the order of the groups.
+        The groups are queried concurrently, up to the helper's concurrency.
+        :param url: service url
+        :param layer_id: service layer/table ID
+        :param token: token value
+        :param id_groups: iterable of object id groups (None values are ignored)
+        :param oid_field_name: object id field of the layer or table
+        :param kwargs: other get_item_rows parameters
+        """
+        def get_rows(group):
+            group = [oid for oid in group if oid is not None]
+            where = '{0} IN ({1})'.format(oid_field_name, ','.join(str(oid) for oid in group))
+            return group, self.get_item_rows(url, layer_id, token, where=where, **kwargs)
+        return self._imap(get_rows, id_groups)
+
+
+def fetch_batches(cursor, size=1000):
+    """Yield the rows of an executed DB-API cursor in lists of fetchmany batches.
+    :param cursor: an executed database cursor
+    :param size: number of rows per batch
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+
+def column_values(column):
+    """Return the values of a NumPy column (a masked array if it has nulls) as a list.
+    Masked values and NaN are returned as None, as the OGR feature API returns null fields.
+    """
+    values = column.tolist()
+    if column.dtype.kind == 'f':
+        values = [None if v != v else v for v in values]
+    return values
+
+
+class StageMetrics(object):
+    """Cumulative time per stage and the rows and bytes sent per table, reported as status metric records.
+    Stages are query, fetch, map, geometry, encode and send. When disabled, clock() and add() return
+    at once, so instrumented code costs a method call.
+    """
+    STAGES = ('query', 'fetch', 'map', 'geometry', 'encode', 'send')
+
+    def __init__(self, writer, interval=None):
+        """
+        :param writer: the status writer
+        :param interval: seconds between metric records, or None to disable metrics
+        """
+        self.enabled = interval is not None
+        self._writer = writer
+        self._interval = interval
+        self._tables = collections.OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_report = time.time()
+
+    def __str__(self):
+        return "StageMetrics"
+
+    def table(self, name):
+        """Set the table that the stages and rows of the current thread are counted for."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self._tables:
+                stats = dict((stage, 0.0) for stage in self.STAGES)
+                stats.update({'rows': 0, 'bytes': 0, 'start': time.time(), 'end': time.time()})
+                self._tables[name] = stats
+        self._local.table = name
+
+    def _stats(self):
+        name = getattr(self._local, 'table', '')
+        if name not in self._tables:
+            self.table(name)
+        return self._tables[name]
+
+    def clock(self):
+        """Return the start time of a stage, to be passed to add()."""
+        if not self.enabled:
+            return 0
+        return time.time()
+
+    def add(self, stage, started):
+        """Add the time since started to a stage."""
+        if not self.enabled:
+            return
+        self._stats()[stage] += time.time() - started
+
+    def timed(self, stage, iterable):
+        """Yield the items of an iterable, adding the time spent getting each one to a stage."""
+        if not self.enabled:
+            for item in iterable:
+                yield item
+            return
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, started)
+                return
+            self.add(stage, started)
+            yield item
+
+    def sent(self, size):
+        """Count an entry of size bytes sent for the current table and report if the interval has passed."""
+        if not self.enabled:
+            return
+        stats = self._stats()
+        stats['rows'] += 1
+        stats['bytes'] += size
+        stats['end'] = time.time()
+        if stats['end'] - self._last_report >= self._interval:
+            self.report()
+
+    def metrics(self):
+        """Return the metrics of each table with the stage times in seconds and rows per second."""
+        tables = collections.OrderedDict()
+        with self._lock:
+            for name, stats in self._tables.items():
+                elapsed = stats['end'] - stats['start']
+                tables[name] = {'rows': stats['rows'],
+                                'bytes': stats['bytes'],
+                                'seconds': round(elapsed, 3),
+                                'rows_per_sec': round(stats['rows'] / elapsed, 1) if elapsed > 0 else None,
+                                'stages': dict((stage, round(stats[stage], 3)) for stage in self.STAGES)}
+        return tables
+
+    def collect(self):
+        """Return the counts of each table since the last call and start counting again.
+        Pool processes return them with their results so the parent can merge() them into its summary.
+        """
+        if not self.enabled:
+            return {}
+        with self._lock:
+            tables, self._tables = self._tables, collections.OrderedDict()
+        return tables
+
+    def merge(self, tables):
+        """Add the counts collected in another process to the tables of this one."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, counts in tables.items():
+                stats = self._tables.get(name)
+                if stats is None:
+                    self._tables[name] = dict(counts)
+                    continue
+                for key in self.STAGES + ('rows', 'bytes'):
+                    stats[key] += counts[key]
+                stats['start'] = min(stats['start'], counts['start'])
+                stats['end'] = max(stats['end'], counts['end'])
+
+    def report(self, final=False):
+        """Send a metric record for all tables. The final record is the summary of the job."""
+        if not self.enabled or not self._tables:
+            return
+        self._last_report = time.time()
+        self._writer.send_metrics('metrics', {'pid': os.getpid(), 'final': final, 'tables': self.metrics()})
+
+    def summary(self):
+        """Send the final metric record."""
+        self.report(final=True)
+
+
+class FieldTypeSketch(object):
+    """Streaming summary of the value types seen for each field of sampled documents.
+    Memory is bounded by the number of fields tracked and the distinct types per field,
+    not by the number of documents added.
+    """
+    # Types that widen to a single type when a field holds more than one of them.
+    _widening = ((frozenset([int, long]), long),
+                 (frozenset([int, long, float]), float),
+                 (frozenset([str, unicode]), unicode))
+
+    def __init__(self, max_fields=1000):
+        self.max_fields = max_fields
+        self.documents = 0
+        self.skipped_fields = 0
+        self._counts = {}
+        self._order = []
+
+    def add(self, doc):
+        """Count the value type of each field of a document (dictionary)."""
+        self.documents += 1
+        counts = self._counts
+        for name, value in doc.iteritems():
+            if value is None:
+                continue
+            try:
+                type_counts = counts[name]
+            except KeyError:
+                if len(counts) >= self.max_fields:
+                    self.skipped_fields += 1
+                    continue
+                type_counts = counts[name] = {}
+                self._order.append(name)
+            value_type = type(value)
+            type_counts[value_type] = type_counts.get(value_type, 0) + 1
+
+    def merge(self, other):
+        """Merge the counts of another sketch into this one."""
+        self.documents += other.documents
+        self.skipped_fields += other.skipped_fields
+        for name in other._order:
+            if name not in self._counts:
+                if len(self._counts) >= self.max_fields:
+                    self.skipped_fields += 1
+                    continue
+                self._counts[name] = {}
+                self._order.append(name)
+            type_counts = self._counts[name]
+            for value_type, count in other._counts[name].iteritems():
+                type_counts[value_type] = type_counts.get(value_type, 0) + count
+
+    def field_type(self, name):
+        """Return the stable type of a field: the widened type of mixed numbers or strings, else the most common type."""
+        type_counts = self._counts[name]
+        seen = frozenset(type_counts)
+        for types, widened_type in self._widening:
+            if seen <= types and len(seen) > 1:
+                return widened_type
+        return max(type_counts, key=type_counts.get)
+
+    @property
+    def field_types(self):
+        """Dictionary of field names and their stable types, in the order the fields were first seen."""
+        return collections.OrderedDict((name, self.field_type(name)) for name in self._order)
+
+
+class CoordinateTransformer(object):
+    """Reprojects batches of coordinates from a native spatial reference to WGS84 (4326)."""
+    _transformers = {}
+
+    def __init__(self, srid):
+        load_gdal()
+        source = osr.SpatialReference()
+        try:
+            if not source.ImportFromEPSG(int(srid)) == 0:
+                raise ValueError('Unknown spatial reference {0}.'.format(srid))
+        except RuntimeError as ex:
+            raise ValueError(str(ex))
+        target = osr.SpatialReference()
+        target.ImportFromEPSG(4326)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            # GDAL 3 uses the authority axis order (lat, lon) for 4326 unless told otherwise.
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.srid = srid
+        self._transformation = osr.CoordinateTransformation(source, target)
+
+    def __str__(self):
+        return "CoordinateTransformer"
+
+    @classmethod
+    def get(cls, srid):
+        """Return a cached transformer for a spatial reference ID or None if the
+        coordinates are already geographic or the spatial reference is unknown.
+        :param srid: the native spatial reference ID (EPSG code)
+        """
+        if srid is None or srid in GEOGRAPHIC_SRIDS:
+            return None
+        if srid not in cls._transformers:
+            try:
+                cls._transformers[srid] = cls(srid)
+            except (ValueError, TypeError, ImportError):
+                cls._transformers[srid] = None
+        return cls._transformers[srid]
+
+    @classmethod
+    def supported(cls, srid):
+        """Return True if coordinates in a spatial reference are geographic or can be reprojected client-side."""
+        return srid is None or srid in GEOGRAPHIC_SRIDS or cls.get(srid) is not None
+
+    def transform(self, xs, ys):
+        """Return lists of longitudes and latitudes for lists of native x and y coordinates.
+        Null coordinates are returned as None.
+        :param xs: list of x coordinates
+        :param ys: list of y coordinates
+        """
+        lons = [None] * len(xs)
+        lats = [None] * len(ys)
+        valid = [k for k in range(len(xs)) if xs[k] is not None and ys[k] is not None]
+        if valid:
+            points = self._transformation.TransformPoints([(float(xs[k]), float(ys[k])) for k in valid])
+            for k, point in zip(valid, points):
+                lons[k] = point[0]
+                lats[k] = point[1]
+        return lons, lats
+
+    def transform_envelopes(self, xmins, ymins, xmaxs, ymaxs):
+        """Return lists of xmin, ymin, xmax, ymax in WGS84 for lists of native envelopes.
+        All four corners are reprojected so the returned envelopes contain the projected ones.
+        """
+        n = len(xmins)
+        lons, lats = self.transform(list(xmins) + list(xmaxs) + list(xmaxs) + list(xmins),
+                                    list(ymins) + list(ymins) + list(ymaxs) + list(ymaxs))
+        envelopes = ([None] * n, [None] * n, [None] * n, [None] * n)
+        for k in range(n):
+            corner_lons = [lons[k + c * n] for c in range(4) if lons[k + c * n] is not None]
+            corner_lats = [lats[k + c * n] for c in range(4) if lats[k + c * n] is not None]
+            if corner_lons:
+                envelopes[0][k] = min(corner_lons)
+                envelopes[1][k] = min(corner_lats)
+                envelopes[2][k] = max(corner_lons)
+                envelopes[3][k] = max(corner_lats)
+        return envelopes
+
+    def transform_wkt(self, wkt):
+        """Return the well-known text of a native geometry reprojected to WGS84."""
+        if not wkt:
+            return wkt
+        geometry = ogr.CreateGeometryFromWkt(str(wkt))
+        if not geometry:
+            return None
+        geometry.Transform(self._transformation)
+        return geometry.ExportToWkt()
 
 
 class GeoJSONConverter(object):
@@ -329,16 +888,159 @@ class GeometryOps(object):
     def __lookup_degrees_size_for_hash_len(self, hash_length):
         return (self.__hash_len_to_lat_height[hash_length], self.__hash_len_to_lon_width[hash_length])
 
+    def __quantize(self, lon, lat, precision, zoom):
+        """Return the geohash cell bits and the tile column/row of a point at the given precision and zoom."""
+        bits = precision * 5
+        lon_bits = (bits + 1) // 2
+        lat_bits = bits // 2
+        lon_cell = max(min(int((lon + 180.0) / 360.0 * (1 << lon_bits)), (1 << lon_bits) - 1), 0)
+        lat_cell = max(min(int((lat + 90.0) / 180.0 * (1 << lat_bits)), (1 << lat_bits) - 1), 0)
+        hash_bits = 0
+        for i in range(bits):
+            # Bits alternate starting with longitude (most significant bit first).
+            if i % 2 == 0:
+                bit = (lon_cell >> (lon_bits - 1 - i // 2)) & 1
+            else:
+                bit = (lat_cell >> (lat_bits - 1 - i // 2)) & 1
+            hash_bits = (hash_bits << 1) | bit
+
+        lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+        lat_rad = math.radians(lat)
+        n = 1 << zoom
+        tile_x = min(int((lon + 180.0) / 360.0 * n), n - 1)
+        tile_y = min(int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n), n - 1)
+        return hash_bits, max(tile_x, 0), max(tile_y, 0)
+
+    def geohash(self, lon, lat, precision=MAX_GEOHASH_PRECISION):
+        """Return the geohash of a point.
+        :param lon: longitude in decimal degrees
+        :param lat: latitude in decimal degrees
+        :param precision: number of geohash characters
+        """
+        hash_bits = self.__quantize(lon, lat, precision, 0)[0]
+        return ''.join(GEOHASH_BASE32[(hash_bits >> (5 * (precision - 1 - i))) & 31] for i in range(precision))
+
+    def tile_key(self, lon, lat, zoom):
+        """Return the slippy map tile key (zoom/x/y) containing a point.
+        :param lon: longitude in decimal degrees
+        :param lat: latitude in decimal degrees
+        :param zoom: tile zoom level
+        """
+        tile_x, tile_y = self.__quantize(lon, lat, 1, zoom)[1:]
+        return '{0}/{1}/{2}'.format(zoom, tile_x, tile_y)
+
+    def spatial_keys(self, geo, geohash_levels=(), tile_levels=()):
+        """Return the geohash prefix and tile key fields for a point or envelope.
+        The hash and tile are computed once at the finest level and coarser levels are derived from them.
+        :param geo: the geo information of an entry (lon/lat or xmin/ymin/xmax/ymax)
+        :param geohash_levels: geohash precisions to emit
+        :param tile_levels: tile zoom levels to emit
+        """
+        if 'lon' in geo:
+            lon, lat = geo['lon'], geo['lat']
+        elif 'xmin' in geo:
+            lon = (geo['xmin'] + geo['xmax']) / 2.0
+            lat = (geo['ymin'] + geo['ymax']) / 2.0
+        else:
+            return {}
+        if lon is None or lat is None:
+            return {}
+
+        geohash_levels = [p for p in geohash_levels if 0 < p <= MAX_GEOHASH_PRECISION]
+        tile_levels = [z for z in tile_levels if 0 <= z <= MAX_TILE_ZOOM]
+        keys = {}
+        if geohash_levels:
+            max_precision = max(geohash_levels)
+            geohash = self.geohash(lon, lat, max_precision)
+            for precision in geohash_levels:
+                keys['fs_geohash_{0}'.format(precision)] = geohash[:precision]
+        if tile_levels:
+            max_zoom = max(tile_levels)
+            tile_x, tile_y = self.__quantize(lon, lat, 1, max_zoom)[1:]
+            for zoom in tile_levels:
+                shift = max_zoom - zoom
+                keys['fs_tile_{0}'.format(zoom)] = '{0}/{1}/{2}'.format(zoom, tile_x >> shift, tile_y >> shift)
+        return keys
+
+    def spatial_keys_batch(self, lons, lats, geohash_levels=(), tile_levels=()):
+        """Return a list of geohash prefix and tile key fields for arrays of points.
+        Uses NumPy to compute a whole batch at once when available.
+        :param lons: sequence of longitudes in decimal degrees
+        :param lats: sequence of latitudes in decimal degrees
+        :param geohash_levels: geohash precisions to emit
+        :param tile_levels: tile zoom levels to emit
+        """
+        numpy = load_numpy()
+        if numpy is None:
+            return [self.spatial_keys({'lon': x, 'lat': y}, geohash_levels, tile_levels) for x, y in zip(lons, lats)]
+
+        geohash_levels = [p for p in geohash_levels if 0 < p <= MAX_GEOHASH_PRECISION]
+        tile_levels = [z for z in tile_levels if 0 <= z <= MAX_TILE_ZOOM]
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        keys = [{} for _ in range(len(lons))]
+        if geohash_levels:
+            precision = max(geohash_levels)
+            bits = precision * 5
+            lon_bits = (bits + 1) // 2
+            lat_bits = bits // 2
+            lon_cells = numpy.clip(((lons + 180.0) / 360.0 * (1 << lon_bits)).astype(numpy.int64), 0, (1 << lon_bits) - 1)
+            lat_cells = numpy.clip(((lats + 90.0) / 180.0 * (1 << lat_bits)).astype(numpy.int64), 0, (1 << lat_bits) - 1)
+            hash_bits = numpy.zeros(len(lons), dtype=numpy.int64)
+            for i in range(bits):
+                if i % 2 == 0:
+                    bit = (lon_cells >> (lon_bits - 1 - i // 2)) & 1
+                else:
+                    bit = (lat_cells >> (lat_bits - 1 - i // 2)) & 1
+                hash_bits = (hash_bits << 1) | bit
+            alphabet = numpy.array(list(GEOHASH_BASE32), dtype='S1')
+            chars = numpy.empty((len(lons), precision), dtype='S1')
+            for i in range(precision):
+                chars[:, i] = alphabet[(hash_bits >> (5 * (precision - 1 - i))) & 31]
+            geohashes = chars.view('S{0}'.format(precision)).ravel()
+            for key, geohash in zip(keys, geohashes):
+                for p in geohash_levels:
+                    key['fs_geohash_{0}'.format(p)] = geohash[:p].decode('ascii')
+        if tile_levels:
+            zoom = max(tile_levels)
+            n = 1 << zoom
+            lat_rad = numpy.radians(numpy.clip(lats, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+            tile_xs = numpy.clip(((lons + 180.0) / 360.0 * n).astype(numpy.int64), 0, n - 1)
+            tile_ys = numpy.clip(((1.0 - numpy.log(numpy.tan(lat_rad) + 1.0 / numpy.cos(lat_rad)) / math.pi) / 2.0 * n).astype(numpy.int64), 0, n - 1)
+            for z in tile_levels:
+                shift = zoom - z
+                for key, tile_x, tile_y in zip(keys, (tile_xs >> shift).tolist(), (tile_ys >> shift).tolist()):
+                    key['fs_tile_{0}'.format(z)] = '{0}/{1}/{2}'.format(z, tile_x, tile_y)
+        return keys
+
     def generalize_geometry(self, wkt, tolerance):
         """Return a generalized geometry by a given tolerance.
         :param wkt: the well-known text string of the geometry to be generalized
         :param tolerance: a simplification tolerance
         """
+        load_gdal()
+        geometry = ogr.CreateGeometryFromWkt(wkt)
+        if not geometry:
+            geometry = ogr.CreateGeometryFromWkt(eval(wkt))
+        return self.generalize_ogr_geometry(geometry, tolerance)
+
+    def generalize_wkb(self, wkb, tolerance):
+        """Return a generalized geometry (as WKT) from well-known binary by a given tolerance.
+        The binary is parsed directly so the full geometry is never written out as text first.
+        :param wkb: the well-known binary of the geometry to be generalized
+        :param tolerance: a simplification tolerance
+        """
+        load_gdal()
+        return self.generalize_ogr_geometry(ogr.CreateGeometryFromWkb(bytes(wkb)), tolerance)
+
+    def generalize_ogr_geometry(self, geometry, tolerance):
+        """Return a generalized geometry (as WKT) from an OGR geometry by a given tolerance.
+        :param geometry: an OGR geometry
+        :param tolerance: a simplification tolerance
+        """
+        load_gdal()
         try:
             # If Polyline and tolerance is 1, just get the first, mid and last points.
-            geometry = ogr.CreateGeometryFromWkt(wkt)
-            if not geometry:
-                geometry = ogr.CreateGeometryFromWkt(eval(wkt))
             if geometry.GetGeometryName() == 'LINESTRING' and tolerance > 0.9:
                 first_point = "{0:.2f} {1:.2f}".format(geometry.GetPoint()[0], geometry.GetPoint()[1])
                 mid_point = "{0:.2f} {1:.2f}".format(geometry.Centroid().GetPoint()[0], geometry.Centroid().GetPoint()[1])
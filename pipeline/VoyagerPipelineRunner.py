@@ -13,6 +13,7 @@
 # limitations under the License.
 """Executes a Voyager pipeline step."""
 import collections
+import glob
 import json
 import os
 import sys
@@ -41,16 +42,44 @@ def run_pipeline_step(pipeline_name, entry_file, *args):
             sys.exit(1)
 
 
-if __name__ == '__main__':
-    if sys.argv[1] == '--info':
-        pipeline_info = collections.defaultdict(list)
-        for pipeline in steps.__all__:
+def get_pipeline_info(full=False):
+    """Return the availability of each pipeline step.
+    By default the imports of a step are found without loading them and the result is cached in
+    a manifest until the steps or the Python installation change. A full check imports each step.
+    """
+    from steps.utils import module_info
+    steps_dir = os.path.dirname(steps.__file__)
+    files = [steps_dir] + glob.glob(os.path.join(steps_dir, '*.py')) + glob.glob(os.path.join(steps_dir, 'utils', '*.py'))
+    manifest_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.info_manifest.json')
+    if not full:
+        pipeline_info = module_info.read_manifest(manifest_file, files)
+        if pipeline_info is not None:
+            return pipeline_info
+
+    pipeline_info = collections.defaultdict(list)
+    for pipeline in steps.__all__:
+        if full:
             try:
                 __import__(pipeline)
                 pipeline_info['pipeline'].append({'name': pipeline, 'available': True})
             except (ImportError, RuntimeError) as ie:
                 pipeline_info['pipeline'].append({'name': pipeline, 'available': False, 'warning': str(ie)})
+        else:
+            try:
+                missing = module_info.missing_imports(os.path.join(steps_dir, '{0}.py'.format(pipeline)), [steps_dir, os.path.dirname(steps_dir)])
+                if missing:
+                    pipeline_info['pipeline'].append({'name': pipeline, 'available': False, 'warning': 'No module named {0}'.format(', '.join(missing))})
+                else:
+                    pipeline_info['pipeline'].append({'name': pipeline, 'available': True})
+            except SyntaxError as se:
+                pipeline_info['pipeline'].append({'name': pipeline, 'available': False, 'warning': str(se)})
+    module_info.write_manifest(manifest_file, files, pipeline_info)
+    return pipeline_info
 
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--info':
+        pipeline_info = get_pipeline_info('--full' in sys.argv)
         sys.stdout.write(json.dumps(pipeline_info, indent=2))
         sys.stdout.flush()
     else:
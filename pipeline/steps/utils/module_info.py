@@ -0,0 +1,150 @@
+# (C) Copyright 2014 Voyager Search
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks if modules are available without importing them.
+The imports of a module are read from its source and looked up with the import system,
+so packages such as arcpy are found but never loaded. Results are cached in a manifest
+that is used until a module file, a sys.path folder or the Python executable changes.
+"""
+import os
+import sys
+import ast
+import json
+import collections
+try:
+    from importlib.util import find_spec
+except ImportError:
+    import imp
+    find_spec = None
+
+
+def module_available(name):
+    """Return True if a top level module or package can be found on sys.path."""
+    if name in sys.modules or name in sys.builtin_module_names:
+        return True
+    if find_spec:
+        try:
+            return find_spec(name) is not None
+        except (ImportError, ValueError):
+            return False
+    try:
+        fp = imp.find_module(name)[0]
+        if fp:
+            fp.close()
+        return True
+    except ImportError:
+        return False
+
+
+def _local_file(name, folders):
+    """Return the source file of a module in one of the folders or None."""
+    for folder in folders:
+        for path in (os.path.join(folder, name + '.py'), os.path.join(folder, name, '__init__.py')):
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def _optional(node):
+    """Return True if a try statement handles ImportError, in which case its imports are optional."""
+    for handler in getattr(node, 'handlers', []):
+        if handler.type is None:
+            return True
+        names = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+        if any(isinstance(n, ast.Name) and n.id in ('ImportError', 'Exception') for n in names):
+            return True
+    return False
+
+
+def _module_imports(nodes):
+    """Yield the import statements run when a module is loaded (not those in functions or optional blocks)."""
+    for node in nodes:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            yield node
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        elif _optional(node):
+            continue
+        else:
+            for field in ('body', 'orelse', 'finalbody'):
+                for child in _module_imports(getattr(node, field, None) or []):
+                    yield child
+
+
+def missing_imports(source_file, folders, checked=None):
+    """Return the modules imported by a source file (and the local modules it imports) that can not be found.
+    :param source_file: the module source file
+    :param folders: folders searched for local modules, after the folder of the source file
+    :param checked: source files already checked
+    """
+    checked = set() if checked is None else checked
+    if source_file in checked:
+        return []
+    checked.add(source_file)
+    with open(source_file, 'rb') as fp:
+        tree = ast.parse(fp.read(), source_file)
+    folders = [os.path.dirname(source_file)] + list(folders)
+
+    missing = []
+    for node in _module_imports(tree.body):
+        if isinstance(node, ast.Import):
+            names = [(alias.name.split('.')[0], []) for alias in node.names]
+        elif node.level or node.module == '__future__':
+            continue
+        else:
+            names = [(node.module.split('.')[0], node.module.split('.')[1:] + [alias.name]) for alias in node.names]
+        for name, parts in names:
+            local_file = _local_file(name, folders)
+            if local_file:
+                # Follow imports of local modules and of submodules imported from local packages.
+                missing += missing_imports(local_file, folders[1:], checked)
+                package_folder = os.path.dirname(local_file)
+                if parts and local_file.endswith('__init__.py'):
+                    sub_file = _local_file(parts[0], [package_folder])
+                    if sub_file:
+                        missing += missing_imports(sub_file, folders[1:], checked)
+            elif not module_available(name):
+                missing.append(name)
+    return sorted(set(missing))
+
+
+def _manifest_key(files):
+    """Return what the cached information depends on."""
+    mtimes = {}
+    for path in list(files) + [p for p in sys.path if p and os.path.isdir(p)]:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            mtimes[path] = None
+    return {'executable': sys.executable, 'version': sys.version, 'mtimes': mtimes}
+
+
+def read_manifest(manifest_file, files):
+    """Return the cached information if the manifest is still valid for the files, otherwise None."""
+    try:
+        with open(manifest_file, 'r') as fp:
+            manifest = json.load(fp, object_pairs_hook=collections.OrderedDict)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('key') == json.loads(json.dumps(_manifest_key(files))):
+        return manifest.get('info')
+    return None
+
+
+def write_manifest(manifest_file, files, info):
+    """Cache information for the files. The manifest is skipped if it can not be written."""
+    try:
+        with open(manifest_file, 'w') as fp:
+            json.dump({'key': _manifest_key(files), 'info': info}, fp)
+    except (IOError, OSError):
+        pass
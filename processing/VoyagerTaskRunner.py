@@ -13,6 +13,7 @@
 # limitations under the License.
 """Executes a Voyager processing task."""
 import os
+import glob
 import collections
 import json
 import sys
@@ -34,30 +35,45 @@ def run_task(json_file):
             sys.exit(1)
 
 
-if __name__ == '__main__':
-    if sys.argv[1] == '--info':
-        # Metadata GP tools do not work in Python with ArcGIS 10.0
-        task_info = collections.defaultdict(list)
-        info_dir = os.path.join(os.path.dirname(__file__), 'info')
-        for task in tasks.__all__:
-            # Validate the .info.json file.
-            task_properties = collections.OrderedDict()
-            task_properties['name'] = task
-            task_properties['available'] = True
-            fp = None
-            try:
-                fp = open(os.path.join(info_dir, '{0}.info.json'.format(task)))
-                d = json.load(fp)
-            except ValueError as ve:
-                task_properties['available'] = False
-                task_properties['JSON syntax error'] = str(ve)
-            except IOError:
-                continue
-            finally:
-                if fp:
-                    fp.close()
+def get_task_info(full=False):
+    """Return the availability of each task.
+    By default the imports of a task are found without loading them and the result is cached in
+    a manifest until the tasks, info files or the Python installation change. A full check imports
+    each task, which also validates licenses.
+    """
+    from tasks.utils import module_info
+    tasks_dir = os.path.dirname(tasks.__file__)
+    info_dir = os.path.join(os.path.dirname(__file__), 'info')
+    files = [tasks_dir, info_dir] + glob.glob(os.path.join(tasks_dir, '*.py')) + \
+            glob.glob(os.path.join(tasks_dir, 'utils', '*.py')) + glob.glob(os.path.join(info_dir, '*.info.json'))
+    manifest_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.info_manifest.json')
+    if not full:
+        task_info = module_info.read_manifest(manifest_file, files)
+        if task_info is not None:
+            return task_info
 
-            # Validate the Python code.
+    # Metadata GP tools do not work in Python with ArcGIS 10.0
+    task_info = collections.defaultdict(list)
+    for task in tasks.__all__:
+        # Validate the .info.json file.
+        task_properties = collections.OrderedDict()
+        task_properties['name'] = task
+        task_properties['available'] = True
+        fp = None
+        try:
+            fp = open(os.path.join(info_dir, '{0}.info.json'.format(task)))
+            d = json.load(fp)
+        except ValueError as ve:
+            task_properties['available'] = False
+            task_properties['JSON syntax error'] = str(ve)
+        except IOError:
+            continue
+        finally:
+            if fp:
+                fp.close()
+
+        # Validate the Python code.
+        if full:
             try:
                 __import__(task)
             except task_utils.LicenseError as le:
@@ -83,8 +99,28 @@ if __name__ == '__main__':
             except SyntaxError as se:
                 task_properties['available'] = False
                 task_properties['Python syntax error'] = str(se)
+        else:
+            try:
+                missing = module_info.missing_imports(os.path.join(tasks_dir, '{0}.py'.format(task)), [tasks_dir])
+            except SyntaxError as se:
+                task_properties['available'] = False
+                task_properties['Python syntax error'] = str(se)
+            else:
+                if 'arcpy' in missing:
+                    task_properties['available'] = False
+                    task_properties['Import error'] = 'No module named arcpy. Requires ArcGIS'
+                elif missing:
+                    task_properties['available'] = False
+                    task_properties['Import error'] = 'No module named {0}'.format(', '.join(missing))
 
-            task_info['tasks'].append(task_properties)
+        task_info['tasks'].append(task_properties)
+    module_info.write_manifest(manifest_file, files, task_info)
+    return task_info
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--info':
+        task_info = get_task_info('--full' in sys.argv)
         sys.stdout.write(json.dumps(task_info, indent=2))
         sys.stdout.flush()
     elif sys.argv[1] == '--license':